@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Measures how long a worker takes to boot and which modules it spends that time importing.
+
+A worker boots by loading the WSGI application, its middleware, the installed apps' models and the URLconf, which is what
+happens before it answers its first request. Every import is timed; the modules are listed by the time spent importing them,
+excluding the modules they import in turn. The script exits with status 1 if the boot takes longer than the budget, which is
+settings.BOOT_TIME_BUDGET seconds unless --budget is given.
+
+Usage: python boottime.py [--budget SECONDS] [--top N]
+"""
+
+import __builtin__
+import os
+import sys
+import time
+from optparse import OptionParser
+
+
+class ImportTimer:
+  """Times every import made while it is installed."""
+
+  def __init__(self):
+    self.self_times = {} # Module names to the seconds spent importing them, excluding nested imports.
+    self.stack = [] # The seconds spent in nested imports, for each import in progress.
+    self.original_import = __builtin__.__import__
+
+  def install(self):
+    __builtin__.__import__ = self.timed_import
+
+  def uninstall(self):
+    __builtin__.__import__ = self.original_import
+
+  def timed_import(self, name, globals=None, locals=None, fromlist=None, level=-1):
+    if name in sys.modules:
+      return self.original_import(name, globals, locals, fromlist, level)
+    self.stack.append(0)
+    start = time.time()
+    try:
+      return self.original_import(name, globals, locals, fromlist, level)
+    finally:
+      elapsed = time.time() - start
+      nested = self.stack.pop()
+      if self.stack:
+        self.stack[-1] += elapsed
+      self.self_times[name] = self.self_times.get(name, 0) + elapsed - nested
+
+
+def boot():
+  """Boots the web app the way a worker does before its first request."""
+  from think_web_app.wsgi import application
+  from django.db.models.loading import get_apps
+  from django.core import urlresolvers
+  application.load_middleware()
+  get_apps()
+  urlresolvers.get_resolver(None).url_patterns
+
+def main():
+  parser = OptionParser(usage='%prog [--budget SECONDS] [--top N]')
+  parser.add_option('--budget', type='float', default=None, help='The maximum number of seconds the boot may take.')
+  parser.add_option('--top', type='int', default=20, help='The number of modules to list.')
+  options, args = parser.parse_args()
+
+  sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+  os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'think_web_app.settings')
+  timer = ImportTimer()
+  timer.install()
+  start = time.time()
+  try:
+    boot()
+  finally:
+    timer.uninstall()
+  total = time.time() - start
+
+  from django.conf import settings
+  budget = options.budget if options.budget != None else getattr(settings, 'BOOT_TIME_BUDGET', None)
+  for name, seconds in sorted(timer.self_times.items(), key=lambda item: -item[1])[:options.top]:
+    print '%8.1f ms  %s' % (seconds * 1000, name)
+  print '%8.1f ms  total (%d modules)' % (total * 1000, len(timer.self_times))
+  if budget != None and total > budget:
+    print 'The boot took longer than the budget of %.1f ms.' % (budget * 1000)
+    return 1
+  return 0
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -7,7 +7,6 @@ if __name__ == "__main__":
 
     from django.core.management import execute_from_command_line
 
-    import think.server as server
-    #server.initialise_server()
+    # Run 'manage.py initialiseserver' to seed the database; see think/server.py.
 
     execute_from_command_line(sys.argv)
@@ -0,0 +1,380 @@
+"""
+Exports every Thought a user can modify as an archive of one JSON or OPML file per thought, for backups and for moving maps to
+other applications.
+
+The archive is produced as it is sent: the thoughts are read a page at a time, each thought is encoded a chunk of nodes at a
+time, and the archive writers below turn the encoded pieces into archive bytes without ever seeking back. Neither the archive
+nor the list of thoughts is held in memory, and a response streamed from iter_thought_archive starts at once, so exporting an
+account with thousands of thoughts does not time out a worker.
+
+Each thought is first spooled into a temporary file, which is kept in memory until it grows past SPOOL_SIZE: a tar header gives
+the size of its entry before the entry, and a zip entry is compressed into the spool so that its size is known before any of
+it is sent. A zip archive without the Zip64 extensions holds at most MAX_ZIP_ENTRIES files of at most 4 GiB in all, so once
+the next thought would not fit, the archive is ended early with an INCOMPLETE.txt file that says so; the archive is still
+valid. Large accounts should be exported as tar archives, which have neither limit.
+"""
+
+
+import calendar
+import struct
+import tarfile
+import tempfile
+import zipfile
+import zlib
+from xml.sax.saxutils import escape, quoteattr
+
+from django.template.defaultfilters import slugify
+from django.utils import timezone
+
+from think.models import Thought, Node, Connection, permit_modify
+from think.misc import iter_value_chunks
+from think.thought import STREAM_CHUNK_SIZE, RevisionConflictError, iter_encoded_thought, check_thought_revision
+
+
+# Constants
+JSON_FORMAT = 'json'
+OPML_FORMAT = 'opml'
+FORMATS = [JSON_FORMAT, OPML_FORMAT]
+ZIP_ARCHIVE = 'zip'
+TAR_ARCHIVE = 'tar'
+GZIP_TAR_ARCHIVE = 'tgz'
+ARCHIVE_CONTENT_TYPES = {
+  ZIP_ARCHIVE: 'application/zip',
+  TAR_ARCHIVE: 'application/x-tar',
+  GZIP_TAR_ARCHIVE: 'application/gzip',
+}
+ARCHIVE_EXTENSIONS = {
+  ZIP_ARCHIVE: 'zip',
+  TAR_ARCHIVE: 'tar',
+  GZIP_TAR_ARCHIVE: 'tar.gz',
+}
+EXPORT_PAGE_SIZE = 100 # The number of thoughts read at a time.
+SPOOL_SIZE = 1024 * 1024 # The size in bytes of the largest tar entry that is spooled in memory rather than on disk.
+READ_SIZE = 65536
+COMPRESSION_LEVEL = 6
+MAX_ZIP_ENTRIES = 0xFFFF # Zip archives without the Zip64 extensions hold at most this many entries of at most 4 GiB in all.
+MAX_ZIP_SIZE = 0xFFFFFFFF
+INCOMPLETE_ENTRY_NAME = 'INCOMPLETE.txt'
+INCOMPLETE_RESERVE = 4096 # The bytes kept free at the end of a zip archive for the INCOMPLETE.txt file.
+MAX_ENTRY_ATTEMPTS = 3 # The number of times a thought that is modified while it is encoded is encoded.
+
+
+class ArchiveError(Exception):
+  """Raised when the thoughts do not fit in an archive of the requested type, before any of the archive is written."""
+  pass
+
+
+def get_exported_thoughts(user, page_size=EXPORT_PAGE_SIZE):
+  """Gets the Thoughts a user can modify in the order of their ids, reading them a page at a time.
+
+     Args:
+       user: the user.
+       page_size: the number of thoughts read by each query.
+
+     Returns: a generator of thought models.
+  """
+  query = Thought.objects.filter(permission__user=user, permission__type=permit_modify).distinct().order_by('id')
+  last_id = None
+  while True:
+    page = query
+    if last_id != None:
+      page = page.filter(id__gt=last_id)
+    thoughts = list(page[:page_size])
+    for thought in thoughts:
+      yield thought
+    if len(thoughts) < page_size:
+      return
+    last_id = thoughts[-1].id
+
+def count_exported_thoughts(user):
+  """Counts the Thoughts a user can modify."""
+  return Thought.objects.filter(permission__user=user, permission__type=permit_modify).distinct().count()
+
+def check_thought_archive(user, archive):
+  """Checks that the Thoughts of a user fit in an archive, which callers do before they start streaming it.
+
+     Only the number of files is checked: the size of a zip archive is only known once it is written, so one that would grow
+     past 4 GiB is ended early instead (see iter_thought_archive).
+
+     Args:
+       user: the user.
+       archive: ZIP_ARCHIVE, TAR_ARCHIVE or GZIP_TAR_ARCHIVE.
+
+     Raises:
+       ArchiveError: there are too many thoughts for a zip archive.
+  """
+  if archive == ZIP_ARCHIVE and count_exported_thoughts(user) >= MAX_ZIP_ENTRIES:
+    raise ArchiveError('There are too many thoughts for a zip archive; export a tar archive instead.')
+
+def iter_opml_thought(thought):
+  """Encodes a Thought as an OPML outline.
+
+     An outline is a tree, so each node is written once, under the first node connected to it, and the nodes that no node is
+     connected to are the top level outlines. The children of a node are ordered by their position, top to bottom and then
+     left to right, so the outline reads like the map. Connections that would repeat a node or close a cycle are left out.
+     The nodes of the thought are held in memory while it is written, as the outline is not in the order they are read in.
+
+     Args:
+       thought: the thought model.
+
+     Returns: a generator of UTF-8 strings which, joined together, are the OPML document.
+
+     Raises:
+       RevisionConflictError: the thought was modified while it was read.
+  """
+  nodes = {}
+  for chunk in iter_value_chunks(Node.objects.filter(thought=thought), ['id', 'x', 'y', 'text'], STREAM_CHUNK_SIZE):
+    for id, x, y, text in chunk:
+      nodes[id] = (y, x, text)
+  children = {}
+  connected = set()
+  for chunk in iter_value_chunks(Connection.objects.filter(thought=thought), ['node_one_id', 'node_two_id'], STREAM_CHUNK_SIZE):
+    for node_one_id, node_two_id in chunk:
+      children.setdefault(node_one_id, []).append(node_two_id)
+      connected.add(node_two_id)
+  check_thought_revision(thought)
+  order = lambda id: nodes[id][:2] + (id,)
+
+  yield '<?xml version="1.0" encoding="UTF-8"?>\n<opml version="2.0">\n<head><title>%s</title></head>\n<body>\n' % escape(thought.name).encode('utf-8')
+  # Nodes in cycles that no other node is connected to are visited after the top level nodes, as further top level outlines.
+  roots = sorted((id for id in nodes if id not in connected), key=order) + sorted(nodes, key=order)
+  visited = set()
+  lines = []
+  for root in roots:
+    if root in visited:
+      continue
+    visited.add(root)
+    stack = [(root, 0)]
+    while stack:
+      id, depth = stack.pop()
+      if id == None:
+        lines.append('%s</outline>\n' % (' ' * depth))
+        continue
+      child_ids = sorted((child_id for child_id in set(children.get(id, [])) if child_id not in visited), key=order)
+      visited.update(child_ids)
+      line = '%s<outline text=%s' % (' ' * depth, quoteattr(nodes[id][2] or ''))
+      if child_ids:
+        lines.append(line + '>\n')
+        stack.append((None, depth))
+        stack.extend((child_id, depth + 1) for child_id in reversed(child_ids))
+      else:
+        lines.append(line + '/>\n')
+      if len(lines) >= STREAM_CHUNK_SIZE:
+        yield ''.join(lines).encode('utf-8')
+        lines = []
+  yield ''.join(lines).encode('utf-8') + '</body>\n</opml>\n'
+
+def iter_json_thought(thought):
+  """Encodes a Thought as the JSON object sent by ThoughtView.get, which the importer reads back."""
+  for piece in iter_encoded_thought(thought):
+    yield piece.encode('utf-8') if isinstance(piece, unicode) else piece
+
+ENCODERS = {
+  JSON_FORMAT: iter_json_thought,
+  OPML_FORMAT: iter_opml_thought,
+}
+
+def iter_thought_entry(writer, thought, format):
+  """Writes the entry of a Thought into an archive.
+
+     The archive writers spool an entry before they write any of it, so a thought that is modified while it is encoded is
+     loaded and encoded again, up to MAX_ENTRY_ATTEMPTS times. A thought that is deleted meanwhile is left out.
+
+     Args:
+       writer: the ZipWriter or TarWriter.
+       thought: the thought model.
+       format: one of FORMATS.
+
+     Returns: a generator of strings.
+
+     Raises:
+       RevisionConflictError: the thought was modified during every attempt.
+  """
+  for attempt in range(MAX_ENTRY_ATTEMPTS):
+    entry = writer.write_entry(get_entry_name(thought, format), thought.last_modified, ENCODERS[format](thought))
+    try:
+      data = entry.next()
+    except StopIteration:
+      return
+    except RevisionConflictError, e:
+      if attempt == MAX_ENTRY_ATTEMPTS - 1:
+        raise
+      thoughts = list(Thought.objects.filter(id=thought.id)[:1])
+      if not thoughts:
+        return
+      thought = thoughts[0]
+      continue
+    yield data
+    for data in entry:
+      yield data
+    return
+
+def get_entry_name(thought, format):
+  """Gets the name of the file of a Thought in an archive, which is unique because it starts with the id of the thought."""
+  return '%s-%s.%s' % (thought.id, slugify(thought.name) or 'thought', format)
+
+
+class ZipWriter:
+  """Writes a zip archive as a stream of strings."""
+
+  def __init__(self):
+    self.offset = 0 # The number of bytes written so far.
+    self.entries = [] # (name, DOS date, DOS time, CRC-32, compressed size, size, offset) tuples for the central directory.
+    self.directory_size = 0 # The size of the records of the entries in the central directory.
+
+  def write_entry(self, name, modified, pieces, last=False):
+    """Writes a deflated entry.
+
+       Args:
+         name: the name of the entry.
+         modified: the time the entry was modified, as a datetime.
+         pieces: an iterable of the strings of the content of the entry.
+         last: whether the entry ends the archive early, in which case it may use the room kept for it.
+
+       Returns: a generator of strings.
+
+       Raises:
+         ArchiveError: the entry would not leave room for the INCOMPLETE.txt file within the limits of a zip archive without
+           the Zip64 extensions. It is raised before any of the entry is written, so the archive can still be ended.
+    """
+    name = name.encode('utf-8')
+    dos_time = (modified.hour << 11) | (modified.minute << 5) | (modified.second // 2)
+    dos_date = (max(modified.year - 1980, 0) << 9) | (modified.month << 5) | modified.day
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    try:
+      compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+      crc = 0
+      size = 0
+      for piece in pieces:
+        crc = zlib.crc32(piece, crc)
+        size += len(piece)
+        spool.write(compressor.compress(piece))
+      spool.write(compressor.flush())
+      crc &= 0xFFFFFFFF
+      compressed_size = spool.tell()
+
+      # The entry, its record in the central directory and the end of the archive must all lie within MAX_ZIP_SIZE.
+      end = self.offset + 30 + len(name) + compressed_size + 16 + self.directory_size + 46 + len(name) + 22
+      if not last and (len(self.entries) + 2 > MAX_ZIP_ENTRIES or end + INCOMPLETE_RESERVE > MAX_ZIP_SIZE):
+        raise ArchiveError('A zip archive can hold at most %d files of at most 4 GiB in all.' % MAX_ZIP_ENTRIES)
+
+      # Bit 3 of the flags says the checksum and sizes are in the data descriptor after the data.
+      header = struct.pack('<IHHHHHIIIHH', 0x04034b50, 20, 0x08, zipfile.ZIP_DEFLATED, dos_time, dos_date, 0, 0, 0, len(name), 0) + name
+      start = self.offset
+      yield self.count(header)
+      spool.seek(0)
+      while True:
+        data = spool.read(READ_SIZE)
+        if not data:
+          break
+        yield self.count(data)
+      yield self.count(struct.pack('<IIII', 0x08074b50, crc, compressed_size, size))
+      self.entries.append((name, dos_date, dos_time, crc, compressed_size, size, start))
+      self.directory_size += 46 + len(name)
+    finally:
+      spool.close()
+
+  def close(self):
+    """Writes the central directory, which ends the archive.
+
+       Returns: a generator of strings.
+    """
+    start = self.offset
+    records = []
+    for name, dos_date, dos_time, crc, compressed_size, size, offset in self.entries:
+      records.append(struct.pack('<IHHHHHHIIIHHHHHII', 0x02014b50, 20, 20, 0x08, zipfile.ZIP_DEFLATED, dos_time, dos_date, crc,
+        compressed_size, size, len(name), 0, 0, 0, 0, 0644 << 16, offset) + name)
+    directory = ''.join(records)
+    yield self.count(directory)
+    yield self.count(struct.pack('<IHHHHIIH', 0x06054b50, 0, 0, len(self.entries), len(self.entries), len(directory), start, 0))
+
+  def count(self, data):
+    self.offset += len(data)
+    return data
+
+
+class TarWriter:
+  """Writes a tar archive, optionally compressed with gzip, as a stream of strings."""
+
+  def __init__(self, compress=False):
+    self.compressor = None
+    self.size = 0 # The number of bytes of the uncompressed archive written so far.
+    if compress:
+      # Window bits above 16 make zlib write a gzip header and trailer.
+      self.compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+  def write_entry(self, name, modified, pieces, last=False):
+    """Writes an entry. See ZipWriter.write_entry; a tar archive has no limits, so it never raises ArchiveError."""
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+    try:
+      for piece in pieces:
+        spool.write(piece)
+      info = tarfile.TarInfo(name)
+      info.size = spool.tell()
+      info.mtime = calendar.timegm(modified.utctimetuple())
+      info.mode = 0644
+      yield self.compress(info.tobuf(tarfile.PAX_FORMAT, 'utf-8', 'strict'))
+      spool.seek(0)
+      while True:
+        data = spool.read(READ_SIZE)
+        if not data:
+          break
+        yield self.compress(data)
+      blocks, remainder = divmod(info.size, tarfile.BLOCKSIZE)
+      if remainder:
+        yield self.compress(tarfile.NUL * (tarfile.BLOCKSIZE - remainder))
+    finally:
+      spool.close()
+
+  def close(self):
+    """Writes the end of the archive, padded to a whole record as tarfile does. See ZipWriter.close."""
+    end = tarfile.NUL * (tarfile.BLOCKSIZE * 2)
+    remainder = (self.size + len(end)) % tarfile.RECORDSIZE
+    if remainder:
+      end += tarfile.NUL * (tarfile.RECORDSIZE - remainder)
+    yield self.compress(end)
+    if self.compressor != None:
+      yield self.compressor.flush()
+
+  def compress(self, data):
+    self.size += len(data)
+    if self.compressor == None:
+      return data
+    return self.compressor.compress(data)
+
+
+ARCHIVE_WRITERS = {
+  ZIP_ARCHIVE: ZipWriter,
+  TAR_ARCHIVE: lambda: TarWriter(),
+  GZIP_TAR_ARCHIVE: lambda: TarWriter(compress=True),
+}
+
+
+def iter_thought_archive(user, format=JSON_FORMAT, archive=ZIP_ARCHIVE):
+  """Writes every Thought a user can modify into an archive, one file per thought.
+
+     Args:
+       user: the user.
+       format: one of FORMATS.
+       archive: ZIP_ARCHIVE, TAR_ARCHIVE or GZIP_TAR_ARCHIVE.
+
+     Returns: a generator of strings which, joined together, are the archive. Empty strings are skipped, so that each one
+       that is sent is a chunk of a streamed response. If the thoughts outgrow a zip archive, which callers cannot know before
+       it is written, the archive ends with the thoughts that fit and an INCOMPLETE.txt file that says to export a tar archive.
+  """
+  writer = ARCHIVE_WRITERS[archive]()
+  count = 0
+  try:
+    for thought in get_exported_thoughts(user):
+      for data in iter_thought_entry(writer, thought, format):
+        if data:
+          yield data
+      count += 1
+  except ArchiveError, e:
+    note = 'Only the first %d thoughts were exported. %s Export a tar archive to get every thought.\n' % (count, e)
+    for data in writer.write_entry(INCOMPLETE_ENTRY_NAME, timezone.now(), [note], last=True):
+      if data:
+        yield data
+  for data in writer.close():
+    if data:
+      yield data
@@ -0,0 +1,195 @@
+"""
+A cache of encoded Thoughts built on Django's cache framework.
+
+Entries are keyed by the id and the revision of a Thought. Every write to a Thought increments its revision, so a stale entry
+is never read again and is left for the cache to evict. The cache used is the 'thoughts' cache in settings.CACHES, which
+defaults to the bounded LRUCache below and can be pointed at a shared backend such as memcached.
+"""
+
+
+from __future__ import with_statement
+
+import threading
+import time
+from collections import OrderedDict
+try:
+  import cPickle as pickle
+except ImportError:
+  import pickle
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.core.cache.backends.base import BaseCache
+
+
+# Constants
+THOUGHT_CACHE_NAME = 'thoughts'
+THOUGHT_CACHE_KEY_FORMAT = 'thought:%s:%s:%s' # The thought id, revision and last modified time.
+
+# Global in-memory store of LRUCache data. Keyed by location, because Django creates a new backend instance for each get_cache call.
+_caches = {}
+_locks = {}
+_evictions = {}
+
+
+class LRUCache(BaseCache):
+  """A thread-safe local-memory cache backend that evicts the least recently used entry when it holds MAX_ENTRIES entries."""
+
+  def __init__(self, location, params):
+    BaseCache.__init__(self, params)
+    self._location = location
+    self._cache = _caches.setdefault(location, OrderedDict())
+    self._lock = _locks.setdefault(location, threading.Lock())
+    _evictions.setdefault(location, 0)
+
+  @property
+  def evictions(self):
+    """The number of entries evicted to make room for new entries."""
+    return _evictions[self._location]
+
+  def _get_entry(self, key):
+    """Gets the (expiry time, pickled value) entry for the key and marks it as the most recently used, or returns None. The lock must be held."""
+    entry = self._cache.pop(key, None)
+    if entry == None:
+      return None
+    if entry[0] <= time.time():
+      return None
+    self._cache[key] = entry
+    return entry
+
+  def _set(self, key, value, timeout):
+    """Stores the value, evicting the least recently used entries if the cache is full. The lock must be held."""
+    if timeout == None:
+      timeout = self.default_timeout
+    self._cache.pop(key, None)
+    while len(self._cache) >= self._max_entries:
+      self._cache.popitem(last=False)
+      _evictions[self._location] += 1
+    self._cache[key] = (time.time() + timeout, pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+  def add(self, key, value, timeout=None, version=None):
+    key = self.make_key(key, version=version)
+    self.validate_key(key)
+    with self._lock:
+      if self._get_entry(key) != None:
+        return False
+      self._set(key, value, timeout)
+      return True
+
+  def get(self, key, default=None, version=None):
+    key = self.make_key(key, version=version)
+    self.validate_key(key)
+    with self._lock:
+      entry = self._get_entry(key)
+    if entry == None:
+      return default
+    return pickle.loads(entry[1])
+
+  def set(self, key, value, timeout=None, version=None):
+    key = self.make_key(key, version=version)
+    self.validate_key(key)
+    with self._lock:
+      self._set(key, value, timeout)
+
+  def delete(self, key, version=None):
+    key = self.make_key(key, version=version)
+    self.validate_key(key)
+    with self._lock:
+      self._cache.pop(key, None)
+
+  def has_key(self, key, version=None):
+    key = self.make_key(key, version=version)
+    self.validate_key(key)
+    with self._lock:
+      return self._get_entry(key) != None
+
+  def clear(self):
+    with self._lock:
+      self._cache.clear()
+
+
+class Statistics:
+  """Counts the lookups of the thought cache in this process."""
+
+  hits = 0
+  misses = 0
+
+
+_thought_cache = None
+_statistics_lock = threading.Lock()
+
+def get_thought_cache():
+  """Gets the cache that encoded Thoughts are stored in.
+
+     Returns: the 'thoughts' cache if it is configured, otherwise the default cache.
+  """
+  global _thought_cache
+  if _thought_cache == None:
+    if THOUGHT_CACHE_NAME in settings.CACHES:
+      _thought_cache = get_cache(THOUGHT_CACHE_NAME)
+    else:
+      _thought_cache = get_cache('default')
+  return _thought_cache
+
+def get_thought_cache_key(thought_id, revision, last_modified):
+  """Gets the cache key of a revision of a Thought.
+
+     The database may reuse the id of a deleted thought, and a new thought starts again at revision 0, so the time the
+     revision was made is part of the key too.
+
+     Args:
+       thought_id: the id of the thought.
+       revision: the revision of the thought.
+       last_modified: the last modified time of the thought.
+
+     Returns: a string.
+  """
+  return THOUGHT_CACHE_KEY_FORMAT % (thought_id, revision, last_modified.isoformat())
+
+def get_cached_thought(thought_id, revision, last_modified, create):
+  """Gets an encoded Thought from the cache, creating and caching it on a miss.
+
+     Args:
+       thought_id: the id of the thought.
+       revision: the revision of the thought.
+       last_modified: the last modified time of the thought.
+       create: a function without arguments that returns the encoded thought.
+
+     Returns: the encoded thought.
+  """
+  cache = get_thought_cache()
+  key = get_thought_cache_key(thought_id, revision, last_modified)
+  encoded_thought = cache.get(key)
+  with _statistics_lock:
+    if encoded_thought == None:
+      Statistics.misses += 1
+    else:
+      Statistics.hits += 1
+  if encoded_thought == None:
+    encoded_thought = create()
+    cache.set(key, encoded_thought)
+  return encoded_thought
+
+def delete_cached_thought(thought_id, revision, last_modified):
+  """Deletes the latest revision of a deleted Thought from the cache, to free its memory.
+
+     Only the latest revision is deleted: earlier revisions are no longer read and are evicted in time, and the keys of a new
+     thought that reuses the id never match them, since they include the last modified time.
+
+     Args:
+       thought_id: the id of the thought.
+       revision: the latest revision of the thought.
+       last_modified: the last modified time of the thought.
+  """
+  get_thought_cache().delete(get_thought_cache_key(thought_id, revision, last_modified))
+
+def get_cache_statistics():
+  """Gets the counters of the thought cache.
+
+     Returns: a dictionary with the keys hits, misses and evictions. The evictions are None if the cache backend does not count them.
+  """
+  return {
+    'hits': Statistics.hits,
+    'misses': Statistics.misses,
+    'evictions': getattr(get_thought_cache(), 'evictions', None),
+  }
@@ -0,0 +1,126 @@
+"""
+Compact columnar encodings of Thoughts.
+
+Instead of a list of node dictionaries, the nodes are sent as parallel arrays of ids, x values, y values and texts, and each
+connection is a pair of indexes into those arrays. There are two encodings:
+
+  JSON: the thought's properties plus 'nodes': {'ids': [...], 'x': [...], 'y': [...], 'text': [...]} and
+    'connections': [node one index, node two index, ...].
+
+  Binary: all integers are little-endian.
+    4 bytes      the magic string 'THK1'.
+    uint32       the length of the header, followed by the header: the thought's properties encoded as UTF-8 JSON.
+    uint32       the number of nodes n, followed by n uint32 ids, n int32 x values, n int32 y values, n uint32 text
+                 lengths and the texts encoded as UTF-8.
+    uint32       the number of connections m, followed by 2m uint32 node indexes.
+"""
+
+
+import struct
+
+from django.utils import simplejson
+
+from think.models import Node, Connection
+
+
+# Constants
+COLUMNAR_JSON_CONTENT_TYPE = 'application/vnd.think.columnar+json'
+COLUMNAR_BINARY_CONTENT_TYPE = 'application/vnd.think.columnar'
+BINARY_MAGIC = 'THK1'
+
+
+def get_thought_columns(thought):
+  """Loads the nodes and connections of a Thought as columns using one query for each.
+
+     Args:
+       thought: the thought model.
+
+     Returns: a tuple of the node ids, x values, y values and texts, and a flat list of connection node indexes.
+  """
+  node_values = Node.objects.filter(thought=thought).order_by('id').values_list('id', 'x', 'y', 'text')
+  if node_values:
+    ids, xs, ys, texts = [list(column) for column in zip(*node_values)]
+  else:
+    ids, xs, ys, texts = [], [], [], []
+  ids_to_indexes = dict((id, i) for i, id in enumerate(ids))
+
+  connection_indexes = []
+  for node_one_id, node_two_id in Connection.objects.filter(thought=thought).values_list('node_one_id', 'node_two_id'):
+    connection_indexes.append(ids_to_indexes[node_one_id])
+    connection_indexes.append(ids_to_indexes[node_two_id])
+  return ids, xs, ys, texts, connection_indexes
+
+def encode_columnar_json(thought, properties):
+  """Encodes a Thought in the columnar JSON encoding.
+
+     Args:
+       thought: the thought model.
+       properties: a dictionary of the thought's other properties, e.g. name and theme.
+
+     Returns: a JSON string.
+  """
+  ids, xs, ys, texts, connection_indexes = get_thought_columns(thought)
+  data = dict(properties)
+  data['nodes'] = {'ids': ids, 'x': xs, 'y': ys, 'text': texts}
+  data['connections'] = connection_indexes
+  return simplejson.JSONEncoder().encode(data)
+
+def encode_columnar_binary(thought, properties):
+  """Encodes a Thought in the columnar binary encoding.
+
+     Args:
+       thought: the thought model.
+       properties: a dictionary of the thought's other properties, e.g. name and theme.
+
+     Returns: a byte string.
+  """
+  ids, xs, ys, texts, connection_indexes = get_thought_columns(thought)
+  header = simplejson.dumps(properties).encode('utf-8')
+  encoded_texts = [text.encode('utf-8') for text in texts]
+  n = len(ids)
+  return ''.join([
+    BINARY_MAGIC,
+    struct.pack('<I', len(header)),
+    header,
+    struct.pack('<I%dI%di%di%dI' % (n, n, n, n), n, *(ids + xs + ys + [len(text) for text in encoded_texts])),
+    ''.join(encoded_texts),
+    struct.pack('<I%dI' % len(connection_indexes), len(connection_indexes) / 2, *connection_indexes),
+  ])
+
+def decode_columnar_binary(data):
+  """Decodes a Thought in the columnar binary encoding.
+
+     Args:
+       data: the byte string.
+
+     Returns: a dictionary identical to the one encoded by encode_columnar_json.
+
+     Raises:
+       ValueError: the data is not in the columnar binary encoding.
+  """
+  if data[:4] != BINARY_MAGIC:
+    raise ValueError('The data is not a columnar thought.')
+  offset = 4
+
+  def unpack(format, count):
+    values = struct.unpack_from('<%d%s' % (count, format), data, offset)
+    return list(values), offset + struct.calcsize('<%d%s' % (count, format))
+
+  (header_length,), offset = unpack('I', 1)
+  thought = simplejson.loads(data[offset:offset + header_length].decode('utf-8'))
+  offset += header_length
+  (n,), offset = unpack('I', 1)
+  ids, offset = unpack('I', n)
+  xs, offset = unpack('i', n)
+  ys, offset = unpack('i', n)
+  text_lengths, offset = unpack('I', n)
+  texts = []
+  for length in text_lengths:
+    texts.append(data[offset:offset + length].decode('utf-8'))
+    offset += length
+  (m,), offset = unpack('I', 1)
+  connection_indexes, offset = unpack('I', 2 * m)
+
+  thought['nodes'] = {'ids': ids, 'x': xs, 'y': ys, 'text': texts}
+  thought['connections'] = connection_indexes
+  return thought
@@ -3,9 +3,6 @@ A collection of methods relating to the Connection model.
 """
 
 
-from think.node import get_node_id
-
-
 def connection_to_dict(connection):
   """Converts the connection to a dictionary.
      
@@ -15,4 +12,18 @@ def connection_to_dict(connection):
      Returns:
        a dictionary.
   """
-  return {'nodeOne': get_node_id(connection.node_one), 'nodeTwo': get_node_id(connection.node_two)}
+  # Use the foreign key ids so that the nodes are not fetched from the database.
+  return connection_ids_to_dict(connection.node_one_id, connection.node_two_id)
+
+def connection_ids_to_dict(node_one_id, node_two_id):
+  """Converts the node ids of a connection to a dictionary, so connections can be serialized without creating Connection models.
+     
+     Args:
+       node_one_id: the id of the first node.
+       node_two_id: the id of the second node.
+     
+     Returns:
+       a dictionary identical to the one returned by connection_to_dict.
+  """
+  return {'nodeOne': str(node_one_id), 'nodeTwo': str(node_two_id)}
+
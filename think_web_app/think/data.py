@@ -1,131 +1,100 @@
 """
 This script contains one method, main, which sets up the Tutorial thought and the administration data.
+
+The data is declared below and written with a handful of bulk inserts in one transaction. main is idempotent: data that
+already exists is not written again.
 """
 
-from think.models import *
 
+from think.models import *
+from think.misc import bulk_create_in_batches, commit_on_success_with_hooks
+from think.search import index_thought
+from think.theme import get_registered_default_theme, invalidate_theme_registry
+
+
+# Constants
+TUTORIAL_THOUGHT_NAME = "Tutorial"
+ADMIN_USERNAME = "admin"
+
+# (x, y, text) tuples of the nodes of the Tutorial thought.
+TUTORIAL_NODES = [
+  (529, 145, "Drag a node to move it"),
+  (410, 263, "Welcome to Think, an online Mind Mapping Web App"),
+  (712, 281, "Click a node to select it."),
+  (548, 391, "Click the 'green plus' button on a selected node to create another node"),
+  (280, 174, "Double click a node to edit its text"),
+  (704, 94, "Click the red x button on a selected node to delete it"),
+  (402, 508, "When you are familar with Think, register an account to have the ability to save and load your own thoughts(mind maps)."),
+  (910, 394, "Click the 'Grey connection' button to connect a node. Your next click must be the other node in order to successfully connect."),
+  (163, 326, "The thought menu is in the top left corner"),
+  (152, 189, "Where you can close the thought"),
+  (287, 390, "Where you can save the thought"),
+  (57, 401, "Where you can export the thought as an image"),
+  (406, 98, "Drag the background to change the view"),
+]
+
+# (node one, node two) tuples of indexes into TUTORIAL_NODES.
+TUTORIAL_CONNECTIONS = [
+  (0, 1), (1, 2), (2, 3), (1, 4), (2, 5), (2, 7), (12, 1), (6, 1), (10, 8), (11, 8), (11, 9), (11, 10), (9, 10), (9, 8), (8, 1), (3, 5), (7, 5), (7, 3), (7, 2),
+]
+
+ORIGINAL_THEME = {
+  'name': 'Think - Original',
+  'backgroundTopColor': '#abccff',
+  'backgroundBottomColor': '#000000',
+  'nodeOuterColor': '#000000',
+  'nodeInnerColor': '#555555',
+  'nodeTextColor': '#FFFFFF',
+  'connectionOuterColor': '#111111',
+  'connectionInnerColor': '#CCCCCC',
+  'connectionTextColor': '#FFFFFF',
+}
+
+
+@commit_on_success_with_hooks
 def main():
-  """Create the Tutorial Thought and set up some administration data."""
+  """Create the Tutorial Thought and set up some administration data, unless they already exist."""
+  if not Thought.objects.filter(name=TUTORIAL_THOUGHT_NAME).exists():
+    create_tutorial_thought()
   
-  thought = Thought(name="Tutorial")
+  if not MetaData.objects.exists():
+    original_theme = Theme(**ORIGINAL_THEME)
+    original_theme.save()
+    
+    theme_permission = Permission(theme=original_theme, type=permit_all_view)
+    theme_permission.save()
+    
+    md = MetaData(original_theme=original_theme)
+    md.save()
+    invalidate_theme_registry()
+
+def create_tutorial_thought():
+  """Creates the Tutorial Thought with bulk inserts. It can be viewed by all and modified by the admin user, if there is one."""
+  from think.thought import take_thought_snapshot # think.thought imports this module.
+  thought = Thought(name=TUTORIAL_THOUGHT_NAME)
   thought.save()
-
-  permission = Permission(thought=thought, user=None, type=permit_all_view)
-  permission.save()
-
-  node0 = Node(x=529,y=145,text="Drag a node to move it",thought = thought)
-  node0.save()
-
-  node1 = Node(x=410,y=263,text="Welcome to Think, an online Mind Mapping Web App",thought = thought)
-  node1.save()
-
-  node2 = Node(x=712,y=281,text="Click a node to select it.",thought = thought)
-  node2.save()
-
-  node3 = Node(x=548,y=391,text="Click the 'green plus' button on a selected node to create another node",thought = thought)
-  node3.save()
-
-  node4 = Node(x=280,y=174,text="Double click a node to edit its text",thought = thought)
-  node4.save()
-
-  node5 = Node(x=704,y=94,text="Click the red x button on a selected node to delete it",thought = thought)
-  node5.save()
-
-  node6 = Node(x=402,y=508,text="When you are familar with Think, register an account to have the ability to save and load your own thoughts(mind maps).",thought = thought)
-  node6.save()
-
-  node7 = Node(x=910,y=394,text="Click the 'Grey connection' button to connect a node. Your next click must be the other node in order to successfully connect.",thought = thought)
-  node7.save()
-
-  node8 = Node(x=163,y=326,text="The thought menu is in the top left corner",thought = thought)
-  node8.save()
-
-  node9 = Node(x=152,y=189,text="Where you can close the thought",thought = thought)
-  node9.save()
-
-  node10 = Node(x=287,y=390,text="Where you can save the thought",thought = thought)
-  node10.save()
-
-  node11 = Node(x=57,y=401,text="Where you can export the thought as an image",thought = thought)
-  node11.save()
-
-  node12 = Node(x=406,y=98,text="Drag the background to change the view",thought = thought)
-  node12.save()
-
-  c = Connection(node_one=node0, node_two=node1, thought=thought)
-  c.save()
-
-  c = Connection(node_one=node1, node_two=node2, thought=thought)
-  c.save()
-
-  c = Connection(node_one=node2, node_two=node3, thought=thought)
-  c.save()
-
-  c = Connection(node_one=node1, node_two=node4, thought=thought)
-  c.save()
-
-  c = Connection(node_one=node2, node_two=node5, thought=thought)
-  c.save()
-
-  c = Connection(node_one=node2, node_two=node7, thought=thought)
-  c.save()
-
-  c = Connection(node_one=node12, node_two=node1, thought=thought)
-  c.save()
-
-  c = Connection(node_one=node6, node_two=node1, thought=thought)
-  c.save()
-
-  c = Connection(node_one=node10, node_two=node8, thought=thought)
-  c.save()
-
-  c = Connection(node_one=node11, node_two=node8, thought=thought)
-  c.save()
-
-  c = Connection(node_one=node11, node_two=node9, thought=thought)
-  c.save()
-
-  c = Connection(node_one=node11, node_two=node10, thought=thought)
-  c.save()
-
-  c = Connection(node_one=node9, node_two=node10, thought=thought)
-  c.save()
-
-  c = Connection(node_one=node9, node_two=node8, thought=thought)
-  c.save()
-
-  c = Connection(node_one=node8, node_two=node1, thought=thought)
-  c.save()
-
-  c = Connection(node_one=node3, node_two=node5, thought=thought)
-  c.save()
-
-  c = Connection(node_one=node7, node_two=node5, thought=thought)
-  c.save()
-
-  c = Connection(node_one=node7, node_two=node3, thought=thought)
-  c.save()
-
-  c = Connection(node_one=node7, node_two=node2, thought=thought)
-  c.save()
-  
-  u = User.objects.filter(username="admin").get()
-  u.save()
-  
-  p = Permission(thought=thought, type=permit_modify, user=u)
-  p.save()
   
-  original_theme = Theme(name='Think - Original', backgroundTopColor='#abccff', backgroundBottomColor='#000000', nodeOuterColor='#000000', nodeInnerColor='#555555', nodeTextColor='#FFFFFF', connectionOuterColor='#111111', connectionInnerColor='#CCCCCC', connectionTextColor='#FFFFFF')
-  original_theme.save()
+  permissions = [Permission(thought=thought, user=None, type=permit_all_view)]
+  for admin in User.objects.filter(username=ADMIN_USERNAME)[:1]:
+    permissions.append(Permission(thought=thought, type=permit_modify, user=admin))
+  bulk_create_in_batches(Permission, permissions)
   
-  theme_permission = Permission(theme=original_theme, type=permit_all_view)
-  theme_permission.save()
-  
-  md = MetaData(original_theme=original_theme)
-  md.save()
+  bulk_create_in_batches(Node, [Node(x=x, y=y, text=text, thought=thought) for x, y, text in TUTORIAL_NODES])
+  # The bulk insert does not set the ids of the nodes, so they are read back in insertion order.
+  node_ids = list(Node.objects.filter(thought=thought).order_by('id').values_list('id', flat=True))
+  connections = []
+  for node_one, node_two in TUTORIAL_CONNECTIONS:
+    connections.append(Connection(node_one_id=node_ids[node_one], node_two_id=node_ids[node_two], thought=thought))
+  bulk_create_in_batches(Connection, connections)
+  index_thought(thought.id)
+  # The history of the thought starts at this snapshot of revision 0.
+  take_thought_snapshot(thought, [(id,) + values for id, values in zip(node_ids, TUTORIAL_NODES)],
+    [(connection.node_one_id, connection.node_two_id) for connection in connections], True)
 
 
 def get_default_theme():
   """Gets the Default Theme.
+  
+     Returns: a Theme model, which must not be modified, or None if the server has not been initialised.
   """
-  return MetaData.all().get().original_theme
+  return get_registered_default_theme()
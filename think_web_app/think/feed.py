@@ -0,0 +1,107 @@
+"""
+A feed of the changes made to Thoughts, so collaborators can follow each other's edits without reloading the whole thought.
+
+Every save of a thought records the operations it applied as a ThoughtChange for the new revision (see
+think.thought.record_thought_change). The feed sends those records to subscribers: a subscriber gives the revision it has
+loaded, its cursor, and receives the records of every later revision, each as a compact JSON dictionary of the revision and its
+operations. If a later revision was not recorded as operations, e.g. because the thought was deleted, or there are too many
+changes to catch up with, the subscriber is told to reload the thought instead.
+
+ChangeFeed keeps the subscribers of many thoughts and checks for new revisions of all of them with one query; it is served by
+the feed server in think.feedserver, so that waiting subscribers do not hold Django worker threads. The rights of subscribers
+are checked against the database on every publish, with one more query, so a subscriber who can no longer view a thought
+stops receiving its changes at once.
+"""
+
+
+from think.models import Thought, ThoughtChange
+from think.permission import load_thought_acls, get_acl_rights
+
+
+# Constants
+MAX_FEED_CHANGES = 100 # Beyond this many changes, reloading the thought is cheaper than applying them.
+RELOAD_RECORD = '{"reload": true}'
+
+
+def get_encoded_changes(thought_id, since, revision):
+  """Gets the records of the changes made to a Thought after a revision, encoded as JSON.
+
+     The operations are stored as JSON, so the records are put together without decoding them.
+
+     Args:
+       thought_id: the id of the thought.
+       since: the revision the subscriber has loaded.
+       revision: the current revision of the thought.
+
+     Returns: a list of (revision, JSON string) tuples in the order of revision, or None if the subscriber must reload the
+       thought.
+  """
+  if revision - since > MAX_FEED_CHANGES or since > revision:
+    return None
+  if revision == since:
+    return []
+  rows = list(ThoughtChange.objects.filter(thought=thought_id, revision__gt=since, revision__lte=revision).order_by('revision').values_list('revision', 'operations'))
+  if len(rows) != revision - since:
+    return None
+  return [(change_revision, '{"revision": %d, "operations": %s}' % (change_revision, operations)) for change_revision, operations in rows]
+
+
+class ChangeFeed:
+  """The subscribers to the changes of Thoughts.
+
+     A subscriber is any object with the methods:
+       send_changes(records): given a list of (revision, JSON string) tuples. Returns True to stay subscribed.
+       send_reload(): called when the subscriber must reload the thought; it is then unsubscribed.
+  """
+
+  def __init__(self):
+    self.subscribers = {} # Thought ids to dicts of subscribers to the revisions they have received.
+    self.user_ids = {} # (thought id, subscriber) tuples to the ids of the users of the subscribers, or None if anonymous.
+
+  def subscribe(self, subscriber, thought_id, since, user_id=None):
+    """Subscribes a user, or an anonymous user if user_id is None, to the changes of a Thought made after the revision since."""
+    self.subscribers.setdefault(thought_id, {})[subscriber] = since
+    self.user_ids[(thought_id, subscriber)] = user_id
+
+  def unsubscribe(self, subscriber, thought_id):
+    """Stops sending the changes of a Thought to a subscriber."""
+    subscribers = self.subscribers.get(thought_id, {})
+    subscribers.pop(subscriber, None)
+    self.user_ids.pop((thought_id, subscriber), None)
+    if not subscribers:
+      self.subscribers.pop(thought_id, None)
+
+  def __len__(self):
+    return sum(len(subscribers) for subscribers in self.subscribers.values())
+
+  def publish(self):
+    """Sends the changes made since the last publish to the subscribers, using one query for the revisions of every thought,
+       one query for their permissions and one query for the changes of each thought that changed. Subscribers who can no
+       longer view their thought are told to reload it, which the thought's view then refuses.
+    """
+    if not self.subscribers:
+      return
+    revisions = dict(Thought.all_objects.filter(id__in=self.subscribers.keys(), deleted=False).values_list('id', 'revision'))
+    acls = load_thought_acls(self.subscribers.keys())
+    for thought_id, subscribers in self.subscribers.items():
+      for subscriber in subscribers.keys():
+        if not get_acl_rights(acls[thought_id], self.user_ids.get((thought_id, subscriber))).view:
+          self.unsubscribe(subscriber, thought_id)
+          subscriber.send_reload()
+      revision = revisions.get(thought_id)
+      stale = [(subscriber, since) for subscriber, since in subscribers.items() if revision == None or since != revision]
+      if not stale:
+        continue
+      # Subscribers too far behind, or ahead of a thought that was recreated with the same id, reload it.
+      reachable = [since for subscriber, since in stale if revision != None and revision - MAX_FEED_CHANGES <= since <= revision]
+      changes = None
+      if reachable:
+        changes = get_encoded_changes(thought_id, min(reachable), revision)
+      for subscriber, since in stale:
+        if changes == None or since not in reachable:
+          self.unsubscribe(subscriber, thought_id)
+          subscriber.send_reload()
+        elif subscriber.send_changes([change for change in changes if change[0] > since]):
+          subscribers[subscriber] = revision
+        else:
+          self.unsubscribe(subscriber, thought_id)
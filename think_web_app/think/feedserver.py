@@ -0,0 +1,214 @@
+"""
+A single threaded HTTP server of the change feed of think.feed, run by the runfeedserver command next to the Django workers.
+
+Each subscriber is an open connection that waits for changes, so the connections are multiplexed on one asyncore event loop
+rather than each holding a thread. Between the events of the loop the server publishes the changes of every subscribed thought
+with the few queries of ChangeFeed.publish.
+
+GET /thought/feed?id=<thought id>&since=<revision> subscribes to a thought. If the request accepts text/event-stream the
+changes are sent as Server-Sent Events whose ids are revisions, so a browser's EventSource resumes from the Last-Event-ID it
+received; otherwise the request is a long poll, answered with {"changes": [...]} as soon as there are changes or with no
+changes after LONG_POLL_TIMEOUT seconds. Either way, {"reload": true} tells the client to reload the thought. The server is
+meant to be reached through the front end that serves Django, so that requests carry the Django session cookie.
+"""
+
+
+import asynchat
+import asyncore
+import cgi
+import logging
+import socket
+import time
+import urlparse
+from Cookie import SimpleCookie
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY
+from django.contrib.auth.models import User
+from django.db import connection, reset_queries
+from django.utils.importlib import import_module
+
+from think.feed import RELOAD_RECORD, ChangeFeed
+from think.permission import get_thought_rights
+from think.thought import Names
+
+
+# Constants
+FEED_PATH = '/thought/feed'
+EVENT_STREAM_CONTENT_TYPE = 'text/event-stream'
+LONG_POLL_TIMEOUT = 25 # Seconds; less than the idle timeouts of common proxies.
+KEEP_ALIVE_INTERVAL = 15 # Seconds between the comments sent on idle event streams, so proxies do not close them.
+DEFAULT_PUBLISH_INTERVAL = 0.5 # Seconds between the checks for new revisions.
+MAX_REQUEST_SIZE = 8192
+
+
+def get_session_user_id(cookie_header):
+  """Gets the id of the user logged in to a Django session.
+
+     Args:
+       cookie_header: the Cookie header of the request, or None.
+
+     Returns: the user id, or None for an anonymous user.
+  """
+  if cookie_header == None:
+    return None
+  cookie = SimpleCookie()
+  try:
+    cookie.load(cookie_header)
+  except Exception, e:
+    return None
+  if settings.SESSION_COOKIE_NAME not in cookie:
+    return None
+  engine = import_module(settings.SESSION_ENGINE)
+  return engine.SessionStore(cookie[settings.SESSION_COOKIE_NAME].value).get(SESSION_KEY)
+
+
+class FeedConnection(asynchat.async_chat):
+  """A connection to the feed server, which reads one request and then subscribes to a thought until it is answered."""
+
+  def __init__(self, server, sock):
+    asynchat.async_chat.__init__(self, sock)
+    self.server = server
+    self.request = []
+    self.thought_id = None
+    self.event_stream = False
+    self.deadline = None # The time a long poll is answered with no changes, or the next keep alive of an event stream.
+    self.set_terminator('\r\n\r\n')
+
+  def collect_incoming_data(self, data):
+    self.request.append(data)
+    if sum(len(part) for part in self.request) > MAX_REQUEST_SIZE:
+      self.respond('413 Request Entity Too Large')
+
+  def found_terminator(self):
+    self.set_terminator(None)
+    lines = ''.join(self.request).split('\r\n')
+    headers = {}
+    for line in lines[1:]:
+      name, separator, value = line.partition(':')
+      headers[name.strip().lower()] = value.strip()
+    try:
+      method, target, version = lines[0].split()
+    except ValueError, e:
+      return self.respond('400 Bad Request')
+    url = urlparse.urlparse(target)
+    params = dict(cgi.parse_qsl(url.query))
+    if method != 'GET' or url.path != FEED_PATH:
+      return self.respond('404 Not Found')
+    since = headers.get('last-event-id', params.get(Names.since))
+    try:
+      self.thought_id = int(params[Names.id])
+      since = int(since)
+    except (KeyError, TypeError, ValueError), e:
+      return self.respond('400 Bad Request')
+
+    # The rights are checked against the database when the subscription starts, and again by every publish.
+    user = None
+    user_id = get_session_user_id(headers.get('cookie'))
+    if user_id != None:
+      users = list(User.objects.filter(id=user_id)[:1])
+      if users:
+        user = users[0]
+    if not get_thought_rights(user, self.thought_id).view:
+      return self.respond('403 Forbidden')
+
+    self.event_stream = EVENT_STREAM_CONTENT_TYPE in headers.get('accept', '')
+    if self.event_stream:
+      self.push('HTTP/1.1 200 OK\r\nContent-Type: %s\r\nCache-Control: no-cache\r\nConnection: keep-alive\r\n\r\n' % EVENT_STREAM_CONTENT_TYPE)
+      self.deadline = time.time() + KEEP_ALIVE_INTERVAL
+    else:
+      self.deadline = time.time() + LONG_POLL_TIMEOUT
+    self.server.feed.subscribe(self, self.thought_id, since, user_id)
+
+  def push(self, data):
+    # The operations read from the database are unicode, but only bytes may be sent.
+    if isinstance(data, unicode):
+      data = data.encode('utf-8')
+    asynchat.async_chat.push(self, data)
+
+  def respond(self, status, body=''):
+    """Sends a response and closes the connection."""
+    self.deadline = None
+    if isinstance(body, unicode):
+      body = body.encode('utf-8')
+    self.push('HTTP/1.1 %s\r\nContent-Type: application/json\r\nContent-Length: %d\r\nCache-Control: no-cache\r\nConnection: close\r\n\r\n%s'
+      % (status, len(body), body))
+    self.close_when_done()
+
+  def send_changes(self, records):
+    """Sends changes as events, or as the response to a long poll."""
+    if not records:
+      return True
+    if self.event_stream:
+      self.push(''.join('id: %d\ndata: %s\n\n' % record for record in records))
+      self.deadline = time.time() + KEEP_ALIVE_INTERVAL
+      return True
+    self.respond('200 OK', '{"changes": [%s]}' % ', '.join(encoded for revision, encoded in records))
+    return False
+
+  def send_reload(self):
+    """Tells the client to reload the thought and closes the connection."""
+    if self.event_stream:
+      self.push('event: reload\ndata: %s\n\n' % RELOAD_RECORD)
+      self.close_when_done()
+    else:
+      self.respond('200 OK', RELOAD_RECORD)
+
+  def check_deadline(self, now):
+    """Answers a long poll that has timed out or keeps an idle event stream open."""
+    if self.deadline == None or now < self.deadline:
+      return
+    if self.event_stream:
+      self.push(':\n\n')
+      self.deadline = now + KEEP_ALIVE_INTERVAL
+    else:
+      self.server.feed.unsubscribe(self, self.thought_id)
+      self.respond('200 OK', '{"changes": []}')
+
+  def handle_close(self):
+    if self.thought_id != None:
+      self.server.feed.unsubscribe(self, self.thought_id)
+    self.close()
+
+
+class FeedServer(asyncore.dispatcher):
+  """Accepts the connections of subscribers to the change feed."""
+
+  def __init__(self, host, port):
+    asyncore.dispatcher.__init__(self)
+    self.feed = ChangeFeed()
+    self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.set_reuse_addr()
+    self.bind((host, port))
+    self.listen(128)
+
+  def handle_accept(self):
+    pair = self.accept()
+    if pair != None:
+      FeedConnection(self, pair[0])
+
+  def serve_forever(self, publish_interval=DEFAULT_PUBLISH_INTERVAL):
+    """Runs the event loop, publishing the changes of the subscribed thoughts every publish_interval seconds."""
+    next_publish = time.time()
+    while True:
+      asyncore.loop(timeout=max(0, next_publish - time.time()), count=1)
+      now = time.time()
+      if now < next_publish:
+        continue
+      self.tick(now)
+      next_publish = now + publish_interval
+
+  def tick(self, now):
+    """Publishes the changes of the subscribed thoughts and answers the long polls that have timed out."""
+    try:
+      self.feed.publish()
+    except Exception, e:
+      # E.g. the database is locked or the connection was dropped. The subscribers wait for the next publish, which
+      # reconnects.
+      logging.exception('The change feed could not be published.')
+      connection.close()
+    for feed_connection in asyncore.socket_map.values():
+      if isinstance(feed_connection, FeedConnection):
+        feed_connection.check_deadline(now)
+    # DEBUG keeps every query in memory, which would grow without bound in a long running process.
+    reset_queries()
@@ -0,0 +1,202 @@
+"""
+Graph analytics of the nodes and connections of a Thought.
+
+A thought's connections are loaded once into a ThoughtGraph, an undirected graph in compressed sparse row (CSR) form: the
+neighbours of the node at index i are indices[indptr[i]:indptr[i + 1]]. The graphs are built with NumPy and kept in memory
+for each revision of a thought, and the analytics work on whole arrays at a time rather than on models.
+"""
+
+
+from __future__ import with_statement
+
+import threading
+from collections import OrderedDict
+
+from think.models import Node, Connection
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+# Constants
+GRAPH_CACHE_SIZE = 50 # The maximum number of graphs kept in memory by each process.
+DEFAULT_HUB_LIMIT = 10
+
+
+class GraphError(Exception):
+  """Raised when a graph cannot be built or a node is not in it."""
+  pass
+
+
+class ThoughtGraph:
+  """An undirected graph of the nodes of a Thought in compressed sparse row form."""
+
+  def __init__(self, node_ids, node_one_ids, node_two_ids):
+    """Builds the graph.
+
+       Args:
+         node_ids: an array of the ids of the nodes, in ascending order.
+         node_one_ids: an array of the node one ids of the connections.
+         node_two_ids: an array of the node two ids of the connections, in the same order.
+    """
+    self.node_ids = node_ids
+    n = len(node_ids)
+    # Each connection is stored once in each direction.
+    sources = numpy.concatenate([numpy.searchsorted(node_ids, node_one_ids), numpy.searchsorted(node_ids, node_two_ids)])
+    targets = numpy.concatenate([sources[len(node_one_ids):], sources[:len(node_one_ids)]])
+    order = numpy.argsort(sources, kind='mergesort')
+    self.indices = targets[order].astype(numpy.int32)
+    self.indptr = numpy.zeros(n + 1, dtype=numpy.int64)
+    numpy.cumsum(numpy.bincount(sources, minlength=n), out=self.indptr[1:])
+
+  def __len__(self):
+    return len(self.node_ids)
+
+  def get_index(self, node_id):
+    """Gets the index of a node.
+
+       Args:
+         node_id: the id of the node.
+
+       Returns: the index.
+
+       Raises:
+         GraphError: the node is not in the graph.
+    """
+    index = numpy.searchsorted(self.node_ids, node_id)
+    if index >= len(self.node_ids) or self.node_ids[index] != node_id:
+      raise GraphError('The node %s is not in the thought.' % node_id)
+    return int(index)
+
+  def get_degrees(self):
+    """Gets the number of connections of every node.
+
+       Returns: an array of degrees, in the order of node_ids.
+    """
+    return numpy.diff(self.indptr)
+
+  def get_neighbours(self, indexes):
+    """Gets the neighbours of a set of nodes.
+
+       Args:
+         indexes: an array of node indexes.
+
+       Returns: a tuple of an array of neighbour indexes and an array of the index each neighbour was reached from.
+    """
+    starts, lengths = self.indptr[indexes], self.indptr[indexes + 1] - self.indptr[indexes]
+    total = int(lengths.sum())
+    if total == 0:
+      return numpy.zeros(0, dtype=numpy.int32), numpy.zeros(0, dtype=numpy.int32)
+    # The positions of the neighbours in indices: each node's run of positions starts at its start.
+    run_starts = numpy.cumsum(lengths) - lengths
+    positions = numpy.arange(total) + numpy.repeat(starts - run_starts, lengths)
+    return self.indices[positions], numpy.repeat(indexes, lengths)
+
+  def get_connected_components(self):
+    """Labels the connected components of the graph.
+
+       Components are found by hooking the roots of the two ends of every connection to the smaller root, and shortcutting
+       every node to its root, until no connection joins two roots.
+
+       Returns: an array of labels in the order of node_ids; nodes have the same label if and only if they are connected.
+    """
+    labels = numpy.arange(len(self.node_ids))
+    sources = numpy.repeat(numpy.arange(len(self.node_ids)), self.get_degrees())
+    targets = self.indices
+    while True:
+      source_labels, target_labels = labels[sources], labels[targets]
+      joined = source_labels != target_labels
+      if not joined.any():
+        return labels
+      numpy.minimum.at(labels, numpy.maximum(source_labels[joined], target_labels[joined]),
+        numpy.minimum(source_labels[joined], target_labels[joined]))
+      while True:
+        shortcut = labels[labels]
+        if (shortcut == labels).all():
+          break
+        labels = shortcut
+
+  def get_shortest_path(self, source, target):
+    """Finds a shortest path between two nodes with a breadth first search that visits a whole level at a time.
+
+       Args:
+         source: the index of the first node.
+         target: the index of the last node.
+
+       Returns: a list of node indexes from source to target, or None if they are not connected.
+    """
+    parents = numpy.full(len(self.node_ids), -1, dtype=numpy.int64)
+    parents[source] = source
+    frontier = numpy.array([source])
+    while parents[target] == -1 and len(frontier):
+      neighbours, reached_from = self.get_neighbours(frontier)
+      unvisited = parents[neighbours] == -1
+      neighbours, first = numpy.unique(neighbours[unvisited], return_index=True)
+      parents[neighbours] = reached_from[unvisited][first]
+      frontier = neighbours
+    if parents[target] == -1:
+      return None
+    path = [target]
+    while path[-1] != source:
+      path.append(int(parents[path[-1]]))
+    path.reverse()
+    return path
+
+  def get_hubs(self, limit=DEFAULT_HUB_LIMIT):
+    """Gets the nodes with the most connections.
+
+       Args:
+         limit: the maximum number of nodes.
+
+       Returns: an array of node indexes, from the most connected down; ties are in the order of node_ids.
+    """
+    return numpy.argsort(-self.get_degrees(), kind='mergesort')[:limit]
+
+
+_graphs = OrderedDict() # (thought id, revision, last modified) keys to ThoughtGraphs, from least to most recently used.
+_lock = threading.Lock()
+
+def build_thought_graph(thought):
+  """Builds the graph of a Thought with one query for its nodes and one for its connections.
+
+     Args:
+       thought: the thought model.
+
+     Returns: a ThoughtGraph.
+
+     Raises:
+       GraphError: NumPy is not installed.
+  """
+  if numpy == None:
+    raise GraphError('Graphs cannot be built without NumPy.')
+  node_ids = numpy.fromiter(Node.objects.filter(thought=thought).order_by('id').values_list('id', flat=True), dtype=numpy.int64)
+  connections = numpy.array(list(Connection.objects.filter(thought=thought).values_list('node_one_id', 'node_two_id')), dtype=numpy.int64)
+  connections = connections.reshape((-1, 2))
+  return ThoughtGraph(node_ids, connections[:, 0], connections[:, 1])
+
+def get_cached_graph(thought):
+  """Gets the graph of the current revision of a Thought, building it if it is not in memory.
+
+     Args:
+       thought: the thought model.
+
+     Returns: a ThoughtGraph, which must not be modified.
+
+     Raises:
+       GraphError: NumPy is not installed.
+  """
+  # The last modified time distinguishes a thought from an earlier deleted thought with the same id and revision.
+  key = (thought.id, thought.revision, thought.last_modified)
+  with _lock:
+    graph = _graphs.pop(key, None)
+    if graph != None:
+      _graphs[key] = graph
+      return graph
+  graph = build_thought_graph(thought)
+  with _lock:
+    _graphs[key] = graph
+    while len(_graphs) > GRAPH_CACHE_SIZE:
+      _graphs.popitem(last=False)
+  return graph
@@ -0,0 +1,402 @@
+"""
+Imports mind maps from FreeMind (.mm), OPML and Think JSON files as new Thoughts.
+
+The files are read with streaming parsers that produce the nodes and connections of a map one at a time, so a file is never
+loaded whole: the XML formats are read with iterparse, clearing every element once it has been handled, and the JSON format is
+read one element of its node and connection lists at a time. ThoughtImporter buffers the nodes and connections and writes them
+with the bulk inserts of think.misc, a batch at a time. The XML formats are trees, so only the ids of the ancestors of the
+current node are kept; JSON connections may refer to any node, so an index of node keys to ids is kept for them. XML files
+with a document type declaration are rejected, since expat would expand the entities it declares.
+
+The nodes of the tree formats are laid out as an outline: each node is a row below the previous one, indented by its depth.
+Once a thought is written, a snapshot of it is taken as the start of its history (see think.journal); that reads the thought
+back, so it is the one step whose memory grows with the size of the map.
+"""
+
+
+from __future__ import with_statement
+
+import codecs
+import os
+from xml.etree import cElementTree
+
+from django.db import DatabaseError, transaction
+from django.utils import simplejson
+
+from think.models import Thought, Node, Connection, Permission, permit_modify
+from think.misc import BULK_INSERT_BATCH_SIZE, bulk_create_in_batches
+from think.node import get_node_key
+from think.search import index_thought
+from think.spatial import MIN_COORDINATE, MAX_COORDINATE
+from think.thought import Names, get_json_node_key, take_thought_snapshot
+
+
+# Constants
+FREEMIND_FORMAT = 'mm'
+OPML_FORMAT = 'opml'
+JSON_FORMAT = 'json'
+FORMATS = [FREEMIND_FORMAT, OPML_FORMAT, JSON_FORMAT]
+OUTLINE_INDENT = 200 # The x distance between a node and its children in an outline, in pixels.
+OUTLINE_ROW_HEIGHT = 60
+READ_SIZE = 65536
+DEFAULT_IMPORT_PROCESSES = 4 # SQLite allows one writer at a time, so the importthoughts command imports one file at a time there.
+DOCTYPE_DECLARATION = '<!DOCTYPE'
+
+
+class MapImportError(Exception):
+  """Raised when a file is not a mind map of its format."""
+  pass
+
+
+def get_file_format(file_name):
+  """Gets the format of a file from its extension.
+
+     Args:
+       file_name: the name of the file.
+
+     Returns: one of FORMATS, or None if the extension is unknown.
+  """
+  extension = os.path.splitext(file_name)[1].lower().lstrip('.')
+  return extension if extension in FORMATS else None
+
+
+class ThoughtImporter:
+  """Writes the nodes and connections of a new Thought in batches as they are parsed."""
+
+  def __init__(self, user, name):
+    self.thought = Thought(name=name)
+    self.thought.save()
+    Permission(thought=self.thought, user=user, type=permit_modify).save()
+    self.pending_nodes = [] # (key, Node) tuples waiting to be inserted.
+    self.pending_connections = [] # (node one key, node two key) tuples waiting for the ids of their nodes.
+    self.node_ids = {} # Node keys to the ids of inserted nodes.
+    self.forgotten_keys = [] # The keys of nodes whose ids can be dropped once the pending connections are inserted.
+    self.last_node_id = 0
+    self.node_count = 0
+    self.connection_count = 0
+
+  def add_node(self, key, x, y, text):
+    """Adds a node, which later connections refer to by its key.
+
+       Raises:
+         MapImportError: x or y is not an integer within the range of the columns.
+    """
+    try:
+      x, y = int(x), int(y)
+    except (TypeError, ValueError, OverflowError), e:
+      raise MapImportError('The position of a node is not a number.')
+    if not (MIN_COORDINATE <= x <= MAX_COORDINATE and MIN_COORDINATE <= y <= MAX_COORDINATE):
+      raise MapImportError('The position of a node is out of range.')
+    # The text is stored as unicode, so it has to be unicode to match the row read back by flush_nodes.
+    self.pending_nodes.append((key, Node(x=x, y=y, text=unicode(text), thought=self.thought)))
+    if len(self.pending_nodes) >= BULK_INSERT_BATCH_SIZE:
+      self.flush_nodes()
+
+  def add_connection(self, node_one_key, node_two_key):
+    """Adds a connection between two nodes, which may not have been added yet."""
+    self.pending_connections.append((node_one_key, node_two_key))
+    if len(self.pending_connections) >= BULK_INSERT_BATCH_SIZE:
+      self.flush_connections()
+
+  def forget_node(self, key):
+    """Drops the id of a node that no connection added later refers to, to bound the memory used."""
+    self.forgotten_keys.append(key)
+
+  def flush_nodes(self):
+    """Inserts the pending nodes and finds their ids."""
+    if not self.pending_nodes:
+      return
+    Node.objects.bulk_create([node for key, node in self.pending_nodes])
+    # The bulk insert does not set the ids, so the new rows are matched to the pending nodes by their values.
+    keys_by_values = {}
+    for key, node in self.pending_nodes:
+      keys_by_values.setdefault(get_node_key(node.x, node.y, node.text), []).append(key)
+    for id, x, y, text in Node.objects.filter(thought=self.thought, id__gt=self.last_node_id).order_by('id').values_list('id', 'x', 'y', 'text'):
+      key = keys_by_values[get_node_key(x, y, text)].pop(0)
+      if key not in self.node_ids: # If several nodes share a key, connections refer to the first one.
+        self.node_ids[key] = id
+      self.last_node_id = id
+    self.node_count += len(self.pending_nodes)
+    self.pending_nodes = []
+
+  def flush_connections(self, final=False):
+    """Inserts the pending connections whose nodes have been inserted.
+
+       Args:
+         final: whether every node has been added; connections to nodes that were never added are then dropped.
+    """
+    self.flush_nodes()
+    connections = []
+    waiting = []
+    for node_one_key, node_two_key in self.pending_connections:
+      if node_one_key in self.node_ids and node_two_key in self.node_ids:
+        connections.append(Connection(node_one_id=self.node_ids[node_one_key], node_two_id=self.node_ids[node_two_key], thought=self.thought))
+      elif not final:
+        waiting.append((node_one_key, node_two_key))
+    bulk_create_in_batches(Connection, connections)
+    self.connection_count += len(connections)
+    self.pending_connections = waiting
+    for key in self.forgotten_keys:
+      self.node_ids.pop(key, None)
+    self.forgotten_keys = []
+
+  def finish(self, name=None):
+    """Writes what is still pending, indexes the text of the nodes and takes the first snapshot of the thought.
+
+       Args:
+         name: the name of the thought, if it was only found at the end of the file.
+
+       Returns: the Thought.
+    """
+    self.flush_connections(final=True)
+    if name:
+      self.thought.name = name
+      Thought.objects.filter(id=self.thought.id).update(name=name)
+    index_thought(self.thought.id)
+    take_thought_snapshot(self.thought, public=False)
+    return self.thought
+
+
+class DoctypeRejectingStream:
+  """Wraps the file like object of an XML file, raising MapImportError when a document type declaration is read.
+
+     Expat expands the internal entities a DOCTYPE declares, so a few nested entity declarations (the "billion laughs") would
+     expand to gigabytes of text, and cElementTree has no hook to refuse them. Maps never need a DOCTYPE, so the bytes are
+     checked as they are read. That only works for encodings that are supersets of ASCII, so UTF-16 and UTF-32 files, which
+     expat recognises by their first bytes, are rejected too.
+  """
+
+  def __init__(self, stream):
+    self.stream = stream
+    self.tail = None # The end of the bytes read so far, in case a declaration is split between reads.
+
+  def read(self, size=-1):
+    data = self.stream.read(size)
+    if self.tail == None:
+      if data[:2] in (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE) or '\x00' in data[:4]:
+        raise MapImportError('The file is not encoded in UTF-8.')
+      self.tail = ''
+    if DOCTYPE_DECLARATION in self.tail + data:
+      raise MapImportError('Files with a document type declaration are not imported.')
+    self.tail = (self.tail + data)[-(len(DOCTYPE_DECLARATION) - 1):]
+    return data
+
+
+def iter_xml_tree(stream, node_tag, get_text):
+  """Parses the nodes of an XML tree, clearing every element once it has been parsed.
+
+     Args:
+       stream: a file like object.
+       node_tag: the tag of the elements that are nodes.
+       get_text: a function that gets the text of a node element.
+
+     Returns: an iterator of ('start', element, text) tuples when a node starts, ('end', element, None) tuples when it ends
+       and ('other', element, None) tuples when any other element ends.
+
+     Raises:
+       MapImportError: the file is not valid XML, or has a document type declaration.
+  """
+  ancestors = []
+  try:
+    for event, element in cElementTree.iterparse(DoctypeRejectingStream(stream), events=('start', 'end')):
+      if event == 'start':
+        if element.tag == node_tag:
+          yield 'start', element, get_text(element)
+        ancestors.append(element)
+      else:
+        ancestors.pop()
+        yield ('end' if element.tag == node_tag else 'other'), element, None
+        element.clear()
+        if ancestors:
+          ancestors[-1].remove(element)
+  except SyntaxError, e:
+    raise MapImportError('The file is not valid XML: %s' % e)
+
+def import_tree(importer, stream, node_tag, get_text):
+  """Imports the nodes of an XML tree, connecting each node to its parent and laying them out as an outline.
+
+     Args:
+       importer: the ThoughtImporter.
+       stream: a file like object.
+       node_tag: the tag of the elements that are nodes.
+       get_text: a function that gets the text of a node element.
+
+     Returns: the text of the first node, or the text of the <title> element if there is one.
+  """
+  ancestors = [] # The keys of the nodes that contain the current element.
+  title = None
+  row = 0
+  for event, element, text in iter_xml_tree(stream, node_tag, get_text):
+    if event == 'start':
+      key = row
+      importer.add_node(key, len(ancestors) * OUTLINE_INDENT, row * OUTLINE_ROW_HEIGHT, text)
+      if ancestors:
+        importer.add_connection(ancestors[-1], key)
+      elif title == None:
+        title = text
+      ancestors.append(key)
+      row += 1
+    elif event == 'end':
+      # Once a node ends, only its parent can be connected to again.
+      importer.forget_node(ancestors.pop())
+    elif element.tag == 'title' and element.text:
+      title = element.text.strip()
+  return title
+
+def get_freemind_text(element):
+  """Gets the text of a FreeMind node element."""
+  return element.get('TEXT', '')
+
+def get_opml_text(element):
+  """Gets the text of an OPML outline element."""
+  return element.get('text', element.get('title', ''))
+
+def iter_json_members(stream):
+  """Parses the members of a JSON object, yielding the elements of its list values one at a time.
+
+     Args:
+       stream: a file like object.
+
+     Returns: an iterator of (key, value) tuples for members that are not lists and of (key, element) tuples for each
+       element of the members that are lists.
+
+     Raises:
+       MapImportError: the file is not a JSON object, or is not encoded in UTF-8.
+  """
+  decoder = simplejson.JSONDecoder()
+  text_decoder = codecs.getincrementaldecoder('utf-8')() # A read may end in the middle of a character.
+  state = {'buffer': u'', 'position': 0, 'eof': False}
+
+  def skip(characters):
+    while True:
+      buffer, position = state['buffer'], state['position']
+      while position < len(buffer) and buffer[position] in characters:
+        position += 1
+      state['position'] = position
+      if position < len(buffer) or not read():
+        return buffer[position:position + 1]
+
+  def read():
+    if state['eof']:
+      return False
+    data = stream.read(READ_SIZE)
+    if not data:
+      state['eof'] = True
+      return False
+    try:
+      text = text_decoder.decode(data)
+    except UnicodeDecodeError, e:
+      raise MapImportError('The file is not encoded in UTF-8.')
+    state['buffer'] = state['buffer'][state['position']:] + text
+    state['position'] = 0
+    return True
+
+  def decode():
+    while True:
+      try:
+        value, end = decoder.raw_decode(state['buffer'], state['position'])
+        # A number may continue past the end of the buffer.
+        if end < len(state['buffer']) or state['eof']:
+          state['position'] = end
+          return value
+      except ValueError, e:
+        pass
+      if not read():
+        raise MapImportError('The file is not valid JSON.')
+
+  whitespace = ' \t\r\n'
+  if skip(whitespace) != '{':
+    raise MapImportError('The file is not a JSON object.')
+  state['position'] += 1
+  while skip(whitespace + ',') not in ('}', ''):
+    key = decode()
+    if skip(whitespace) != ':':
+      raise MapImportError('The file is not valid JSON.')
+    state['position'] += 1
+    if skip(whitespace) == '[':
+      state['position'] += 1
+      while skip(whitespace + ',') not in (']', ''):
+        yield key, decode()
+      state['position'] += 1
+    else:
+      yield key, decode()
+
+def get_json_node_reference(json_node):
+  """Gets the key of the node a JSON node dictionary refers to: its id if it has one, or else its values."""
+  if isinstance(json_node, dict) and Names.id in json_node:
+    return str(json_node[Names.id])
+  return get_json_node_key(json_node)
+
+def import_json(importer, stream):
+  """Imports a Think JSON Thought dictionary, as sent by the client or returned by ThoughtView.get.
+
+     Args:
+       importer: the ThoughtImporter.
+       stream: a file like object.
+
+     Returns: the name of the thought.
+  """
+  name = None
+  for key, value in iter_json_members(stream):
+    try:
+      if key == Names.name:
+        name = value
+      elif key == Names.nodes:
+        importer.add_node(get_json_node_reference(value), value[Names.x], value[Names.y], value.get(Names.text) or u'')
+      elif key == Names.connections:
+        if isinstance(value, dict):
+          # The form returned by ThoughtView.get: the ids of the nodes.
+          importer.add_connection(str(value['nodeOne']), str(value['nodeTwo']))
+        else:
+          importer.add_connection(get_json_node_reference(value[0]), get_json_node_reference(value[1]))
+    except (KeyError, IndexError, TypeError, ValueError, OverflowError), e:
+      raise MapImportError('The %s of the thought are malformed.' % key)
+  return name
+
+@transaction.commit_on_success
+def import_thought(stream, format, user, name):
+  """Imports a mind map as a new Thought.
+
+     Args:
+       stream: a file like object of the map.
+       format: one of FORMATS.
+       user: the author of the thought.
+       name: the name of the thought if the map does not have one, e.g. the name of the file.
+
+     Returns: a tuple of the Thought and the numbers of nodes and connections imported.
+
+     Raises:
+       MapImportError: the file is not a map of the format. Nothing is imported.
+  """
+  importer = ThoughtImporter(user, name)
+  if format == FREEMIND_FORMAT:
+    title = import_tree(importer, stream, 'node', get_freemind_text)
+  elif format == OPML_FORMAT:
+    title = import_tree(importer, stream, 'outline', get_opml_text)
+  elif format == JSON_FORMAT:
+    title = import_json(importer, stream)
+  else:
+    raise MapImportError('Unknown format: %s' % format)
+  thought = importer.finish(title)
+  return thought, importer.node_count, importer.connection_count
+
+def import_file(path, username):
+  """Imports a file as a Thought of a user, in a process of a pool started by the importthoughts command.
+
+     Args:
+       path: the path of the file.
+       username: the username of the author.
+
+     Returns: a tuple of the path, the id of the thought or None, and an error message or None. A database error, e.g. a
+       locked SQLite database, fails only the file it happened in.
+  """
+  from django.contrib.auth.models import User
+  format = get_file_format(path)
+  if format == None:
+    return path, None, 'Unknown file format.'
+  try:
+    with open(path, 'rb') as stream:
+      thought, nodes, connections = import_thought(stream, format, User.objects.get(username=username), os.path.splitext(os.path.basename(path))[0])
+  except (IOError, MapImportError, DatabaseError), e:
+    return path, None, str(e)
+  return path, thought.id, None
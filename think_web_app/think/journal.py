@@ -0,0 +1,154 @@
+"""
+The history of Thoughts, read from their journal of changes and their snapshots.
+
+Every write to a thought appends a ThoughtChange with the operations it applied and never updates or deletes earlier ones, and
+every SNAPSHOT_INTERVAL revisions a ThoughtSnapshot of the whole thought is taken (see think.thought.record_thought_change). A
+past revision is rebuilt by loading the nearest snapshot at or before it and replaying at most SNAPSHOT_INTERVAL changes onto
+it, so reading any revision costs two queries whatever the age of the thought.
+"""
+
+
+from django.utils import simplejson
+
+from think.models import ThoughtChange, ThoughtSnapshot
+from think.node import node_values_to_dict
+from think.connection import connection_ids_to_dict
+from think.thought import Names, Operations
+
+
+# Constants
+DEFAULT_HISTORY_LIMIT = 50
+MAX_HISTORY_LIMIT = 500
+
+
+class HistoryError(Exception):
+  """Raised when a revision of a Thought cannot be rebuilt from its journal."""
+  pass
+
+
+class ThoughtState:
+  """The content of a Thought at a revision, as it is rebuilt in memory."""
+
+  def __init__(self, revision, content):
+    """Creates the state of a snapshot.
+
+       Args:
+         revision: the revision of the snapshot.
+         content: the decoded content of the snapshot; see think.thought.take_thought_snapshot.
+    """
+    self.revision = revision
+    self.name = content[Names.name]
+    self.theme = content[Names.theme]
+    self.public = content[Names.is_public]
+    self.nodes = dict((id, (x, y, text)) for id, x, y, text in content[Names.nodes]) # Node ids to (x, y, text) tuples.
+    self.connections = set(tuple(ids) for ids in content[Names.connections]) # (node one id, node two id) tuples.
+
+  def apply(self, operations):
+    """Applies the operations of a change. The node ids of the operations are all ids; see think.thought.patchThought.
+
+       Args:
+         operations: a list of operation dictionaries.
+    """
+    for operation in operations:
+      op = operation[Names.op]
+      if op == Operations.add_node:
+        self.nodes[int(operation[Names.id])] = (operation[Names.x], operation[Names.y], operation[Names.text])
+      elif op == Operations.move_node:
+        x, y, text = self.nodes[int(operation[Names.id])]
+        self.nodes[int(operation[Names.id])] = (operation[Names.x], operation[Names.y], text)
+      elif op == Operations.set_node_text:
+        x, y, text = self.nodes[int(operation[Names.id])]
+        self.nodes[int(operation[Names.id])] = (x, y, operation[Names.text])
+      elif op == Operations.remove_node:
+        node_id = int(operation[Names.id])
+        del self.nodes[node_id]
+        self.connections = set(ids for ids in self.connections if node_id not in ids)
+      elif op == Operations.add_connection:
+        self.connections.add((int(operation[Names.node_one][Names.id]), int(operation[Names.node_two][Names.id])))
+      elif op == Operations.remove_connection:
+        self.connections.discard((int(operation[Names.node_one][Names.id]), int(operation[Names.node_two][Names.id])))
+      elif op == Operations.rename:
+        self.name = operation[Names.name]
+      elif op == Operations.set_theme:
+        self.theme = operation[Names.theme]
+      elif op == Operations.set_public:
+        self.public = operation[Names.is_public]
+      else:
+        raise HistoryError('Unknown operation: %s' % op)
+
+  def to_dict(self, thought_id):
+    """Converts the state into a dictionary in the form of think.thought.thought_to_dict.
+
+       Args:
+         thought_id: the id of the thought.
+
+       Returns: a dictionary.
+    """
+    return {
+      'name': self.name,
+      'connections': [connection_ids_to_dict(node_one_id, node_two_id) for node_one_id, node_two_id in sorted(self.connections)],
+      'nodes': [node_values_to_dict(id, x, y, text) for id, (x, y, text) in sorted(self.nodes.items())],
+      'id': str(thought_id),
+      'revision': self.revision,
+      'theme': self.theme,
+      Names.is_public: self.public,
+    }
+
+
+def get_thought_at_revision(thought, revision):
+  """Rebuilds a past revision of a Thought from the nearest snapshot and the changes after it.
+
+     Args:
+       thought: the thought model.
+       revision: the revision, which is at most the current revision of the thought.
+
+     Returns: a ThoughtState.
+
+     Raises:
+       HistoryError: the revision is older than the first snapshot of the thought, or a change since the snapshot was not
+         recorded.
+  """
+  if revision > thought.revision or revision < 0:
+    raise HistoryError('The thought has no revision %s.' % revision)
+  snapshots = list(ThoughtSnapshot.objects.filter(thought=thought, revision__lte=revision).order_by('-revision').values_list('revision', 'content')[:1])
+  if not snapshots:
+    raise HistoryError('The revision %s is older than the history of the thought.' % revision)
+  snapshot_revision, content = snapshots[0]
+  state = ThoughtState(snapshot_revision, simplejson.loads(content))
+  changes = list(ThoughtChange.objects.filter(thought=thought, revision__gt=snapshot_revision, revision__lte=revision).order_by('revision').values_list('revision', 'operations'))
+  if len(changes) != revision - snapshot_revision:
+    raise HistoryError('A change to the thought before revision %s was not recorded.' % revision)
+  for change_revision, operations in changes:
+    state.apply(simplejson.loads(operations))
+    state.revision = change_revision
+  return state
+
+def get_thought_history(thought, before=None, limit=DEFAULT_HISTORY_LIMIT):
+  """Gets a page of the changes of a Thought, the most recent first.
+
+     Args:
+       thought: the thought model.
+       before: only changes to revisions before this one are returned; None for the most recent changes.
+       limit: the maximum number of changes; at most MAX_HISTORY_LIMIT.
+
+     Returns: a list of dictionaries of the revision, the username of the user who made the change or None, the time of the
+       change in ISO format and the list of operations.
+
+     Raises:
+       ValueError: the limit is invalid.
+  """
+  limit = int(limit)
+  if limit < 1 or limit > MAX_HISTORY_LIMIT:
+    raise ValueError('The limit must be between 1 and %d.' % MAX_HISTORY_LIMIT)
+  query = ThoughtChange.objects.filter(thought=thought)
+  if before != None:
+    query = query.filter(revision__lt=before)
+  history = []
+  for revision, username, created, operations in query.order_by('-revision').values_list('revision', 'user__username', 'created', 'operations')[:limit]:
+    history.append({
+      Names.revision: revision,
+      'user': username,
+      'created': created.isoformat(),
+      Names.operations: simplejson.loads(operations),
+    })
+  return history
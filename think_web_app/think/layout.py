@@ -0,0 +1,157 @@
+"""
+Automatic layout of the nodes of a Thought.
+
+The layout is force directed (Fruchterman-Reingold): connected nodes attract each other and all nodes repel each other, and
+the nodes are moved a shrinking distance each iteration until they settle. The forces are computed with NumPy over whole
+arrays of nodes and connections at a time. Nodes are bucketed into a grid whose cells are twice the spacing wide: nodes only
+repel the other nodes of their own cell individually and the nodes of the neighbouring cells as a group, so an iteration
+costs time proportional to the number of nodes rather than its square, which keeps thoughts with tens of thousands of nodes
+fast to lay out.
+"""
+
+
+from django.db import transaction
+
+from think.models import Node
+from think.graph import GraphError, get_cached_graph
+from think.misc import bulk_update_in_batches
+from think.thought import Names, Operations, RevisionConflictError, bump_thought_revision, record_thought_change
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+
+# Constants
+DEFAULT_ITERATIONS = 50
+MAX_ITERATIONS = 500
+DEFAULT_SPACING = 150 # The ideal length of a connection, in pixels.
+LAYOUT_SEED = 0 # The seed of the initial placement, so that laying out the same thought twice gives the same result.
+
+
+def get_repulsion(positions, spacing):
+  """Computes the repulsion of spacing^2 / distance on every node, using a grid of cells twice the spacing wide.
+
+     Nodes in the same cell repel each other individually. The nodes of each of the eight neighbouring cells repel a node
+     together, from their centroid, and nodes further away are ignored.
+
+     Args:
+       positions: an n by 2 array of node positions.
+       spacing: the ideal length of a connection.
+
+     Returns: an n by 2 array of the repulsion on each node.
+  """
+  n = len(positions)
+  cells = numpy.floor((positions - positions.min(axis=0)) / (2 * spacing)).astype(numpy.int64)
+  stride = cells[:, 1].max() + 3 # Leaves room for the neighbouring cells on either side of a column.
+  keys = (cells[:, 0] + 1) * stride + cells[:, 1] + 1
+  cell_keys, cell_indexes, counts = numpy.unique(keys, return_inverse=True, return_counts=True)
+  centroids = numpy.column_stack([numpy.bincount(cell_indexes, weights=positions[:, axis]) for axis in (0, 1)]) / counts[:, None]
+  repulsion = numpy.zeros((n, 2))
+  
+  # The nodes sorted by cell are a run for each cell; pair every node with each node in its run.
+  order = numpy.argsort(cell_indexes, kind='mergesort')
+  lengths = counts[cell_indexes]
+  run_starts = numpy.cumsum(lengths) - lengths
+  cell_starts = (numpy.cumsum(counts) - counts)[cell_indexes]
+  targets = order[numpy.arange(int(lengths.sum())) + numpy.repeat(cell_starts - run_starts, lengths)]
+  sources = numpy.repeat(numpy.arange(n), lengths)
+  distinct = sources != targets
+  sources, targets = sources[distinct], targets[distinct]
+  delta = positions[sources] - positions[targets]
+  distance_squared = numpy.maximum((delta ** 2).sum(axis=1), 0.01)
+  add_forces(repulsion, sources, delta * (spacing ** 2 / distance_squared)[:, None])
+  
+  for dx in (-1, 0, 1):
+    for dy in (-1, 0, 1):
+      if dx == 0 and dy == 0:
+        continue
+      neighbour_keys = keys + dx * stride + dy
+      neighbours = numpy.minimum(numpy.searchsorted(cell_keys, neighbour_keys), len(cell_keys) - 1)
+      found = cell_keys[neighbours] == neighbour_keys
+      neighbours = neighbours[found]
+      delta = positions[found] - centroids[neighbours]
+      distance_squared = numpy.maximum((delta ** 2).sum(axis=1), 0.01)
+      repulsion[found] += delta * (counts[neighbours] * spacing ** 2 / distance_squared)[:, None]
+  return repulsion
+
+def add_forces(displacement, indexes, forces):
+  """Adds forces to the displacements of nodes; a node may appear in indexes any number of times.
+
+     Args:
+       displacement: an n by 2 array of the displacements of the nodes, which is modified.
+       indexes: an array of node indexes.
+       forces: an array of forces, one row for each index.
+  """
+  # bincount sums the forces of repeated indexes much faster than numpy.add.at.
+  for axis in (0, 1):
+    displacement[:, axis] += numpy.bincount(indexes, weights=forces[:, axis], minlength=len(displacement))
+
+def layout_graph(graph, iterations=DEFAULT_ITERATIONS, spacing=DEFAULT_SPACING):
+  """Lays out a graph with a force directed layout.
+
+     Args:
+       graph: a ThoughtGraph.
+       iterations: the number of times the nodes are moved.
+       spacing: the ideal length of a connection.
+
+     Returns: an n by 2 array of node positions in the order of graph.node_ids, whose centroid is at the origin.
+  """
+  n = len(graph)
+  if n == 0:
+    return numpy.zeros((0, 2))
+  side = spacing * numpy.sqrt(n)
+  positions = numpy.random.RandomState(LAYOUT_SEED).uniform(-side / 2, side / 2, (n, 2))
+  sources = numpy.repeat(numpy.arange(n), graph.get_degrees())
+  targets = graph.indices
+  temperature = side / 10.0
+  cooling = temperature / (iterations + 1)
+  for i in range(iterations):
+    displacement = get_repulsion(positions, spacing)
+    # Attraction of distance^2 / spacing along each connection; every connection is stored in both directions.
+    delta = positions[targets] - positions[sources]
+    distance = numpy.sqrt((delta ** 2).sum(axis=1))
+    add_forces(displacement, sources, delta * (distance / spacing)[:, None])
+    # Move each node at most the temperature.
+    length = numpy.maximum(numpy.sqrt((displacement ** 2).sum(axis=1)), 0.01)
+    positions += displacement * (numpy.minimum(length, temperature) / length)[:, None]
+    temperature -= cooling
+  return positions - positions.mean(axis=0)
+
+@transaction.commit_on_success
+def layout_thought(thought, iterations=DEFAULT_ITERATIONS, spacing=DEFAULT_SPACING, user=None):
+  """Lays out the nodes of a Thought and saves their positions with one bulk update.
+
+     The layout is centred on the centroid of the nodes' current positions, so the thought stays where it was on screen.
+
+     Args:
+       thought: the thought model.
+       iterations: the number of times the nodes are moved.
+       spacing: the ideal length of a connection, in pixels.
+       user: the user who laid out the thought, or None.
+
+     Returns: a list of moveNode operations, one for each node that moved.
+
+     Raises:
+       GraphError: NumPy is not installed.
+       RevisionConflictError: the thought was modified while it was laid out.
+  """
+  revision = thought.revision
+  graph = get_cached_graph(thought)
+  current = numpy.array(list(Node.objects.filter(thought=thought).order_by('id').values_list('x', 'y')), dtype=numpy.float64)
+  if len(current) != len(graph):
+    raise RevisionConflictError(revision)
+  if len(graph) == 0:
+    return []
+  positions = numpy.rint(layout_graph(graph, iterations, spacing) + current.mean(axis=0)).astype(numpy.int64)
+  moved = (positions != current).any(axis=1)
+  rows = [(node_id, x, y) for node_id, (x, y) in zip(graph.node_ids[moved].tolist(), positions[moved].tolist())]
+  if not rows:
+    return []
+  # The revision is checked before writing, so that edits made during the layout are not overwritten.
+  bump_thought_revision(thought, revision)
+  bulk_update_in_batches(Node, ['x', 'y'], rows)
+  operations = [{Names.op: Operations.move_node, Names.id: str(node_id), Names.x: x, Names.y: y} for node_id, x, y in rows]
+  record_thought_change(thought, operations, user)
+  return operations
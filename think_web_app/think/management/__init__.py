@@ -0,0 +1,23 @@
+"""
+Creates the composite indexes of think.schema and the search index of think.search after syncdb creates the tables of the think app.
+"""
+
+
+from django.db import transaction
+from django.db.models.signals import post_syncdb
+
+import think.models
+from think.schema import create_missing_indexes
+from think.search import create_search_index
+
+
+def create_indexes(sender, verbosity=1, **kwargs):
+  """Creates the indexes that are missing after syncdb."""
+  for name in create_missing_indexes():
+    if verbosity >= 1:
+      print 'Creating index %s' % name
+  if create_search_index() and verbosity >= 1:
+    print 'Creating the search index'
+  transaction.commit_unless_managed()
+
+post_syncdb.connect(create_indexes, sender=think.models)
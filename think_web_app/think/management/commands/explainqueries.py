@@ -0,0 +1,19 @@
+"""
+Prints the query plans of the lookups the app makes most often, to check that they use the indexes of think.schema.
+"""
+
+
+from django.core.management.base import NoArgsCommand
+
+from think.schema import HOT_QUERIES, explain_query
+
+
+class Command(NoArgsCommand):
+  help = 'Prints the query plan of each hot query of the think app.'
+
+  def handle_noargs(self, **options):
+    for description, get_queryset in HOT_QUERIES:
+      queryset = get_queryset()
+      self.stdout.write('%s\n  %s\n' % (description, queryset.query))
+      for row in explain_query(queryset):
+        self.stdout.write('    %s\n' % ' '.join(unicode(value) for value in row))
@@ -0,0 +1,47 @@
+"""
+Exports every thought a user can modify as a zip or tar archive of one JSON or OPML file per thought.
+"""
+
+
+from __future__ import with_statement
+
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+
+from think.archive import FORMATS, JSON_FORMAT, ZIP_ARCHIVE, ARCHIVE_WRITERS, ArchiveError, check_thought_archive, iter_thought_archive
+
+
+class Command(BaseCommand):
+  args = '<archive file, or - for stdout>'
+  help = 'Exports the thoughts a user can modify as an archive.'
+  option_list = BaseCommand.option_list + (
+    make_option('--user', help='The username of the user whose thoughts are exported.'),
+    make_option('--format', default=JSON_FORMAT, choices=FORMATS, help='The format of each thought: json or opml.'),
+    make_option('--archive', default=ZIP_ARCHIVE, choices=sorted(ARCHIVE_WRITERS), help='The type of archive: zip, tar or tgz. A zip archive holds at most 4 GiB, so use tar for large accounts.'),
+  )
+
+  def handle(self, *args, **options):
+    if len(args) != 1:
+      raise CommandError('Give the path of the archive to write.')
+    username = options.get('user')
+    users = list(User.objects.filter(username=username)[:1])
+    if not users:
+      raise CommandError('Unknown user: %s' % username)
+    
+    archive_type = options.get('archive') or ZIP_ARCHIVE
+    try:
+      check_thought_archive(users[0], archive_type)
+    except ArchiveError, e:
+      raise CommandError(str(e))
+    
+    archive = iter_thought_archive(users[0], options.get('format') or JSON_FORMAT, archive_type)
+    if args[0] == '-':
+      for data in archive:
+        sys.stdout.write(data)
+    else:
+      with open(args[0], 'wb') as output:
+        for data in archive:
+          output.write(data)
@@ -0,0 +1,62 @@
+"""
+Imports FreeMind, OPML and Think JSON files as Thoughts of a user, in a pool of processes.
+"""
+
+
+import multiprocessing
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.models import User
+from django.db import connection
+
+from think.importer import DEFAULT_IMPORT_PROCESSES, import_file
+
+
+def close_connection():
+  """Closes the database connection inherited from the parent process, so that each process opens its own."""
+  connection.close()
+
+def import_file_in_pool(arguments):
+  """Imports a file given a (path, username) tuple, since a pool passes a single argument."""
+  return import_file(*arguments)
+
+
+class Command(BaseCommand):
+  args = '<file> [<file> ...]'
+  help = 'Imports mind map files (.mm, .opml or .json) as thoughts of a user.'
+  option_list = BaseCommand.option_list + (
+    make_option('--user', help='The username of the author of the thoughts.'),
+    make_option('--processes', type='int', help='The number of files imported at a time: 1 on SQLite, which allows one writer at a time, and %d otherwise.' % DEFAULT_IMPORT_PROCESSES),
+  )
+
+  def handle(self, *paths, **options):
+    username = options.get('user')
+    processes = options.get('processes')
+    if not processes:
+      processes = 1 if connection.vendor == 'sqlite' else DEFAULT_IMPORT_PROCESSES
+    if not paths:
+      raise CommandError('No files were given.')
+    if username == None or not User.objects.filter(username=username).exists():
+      raise CommandError('Unknown user: %s' % username)
+    
+    if processes == 1 or len(paths) == 1:
+      results = [import_file(path, username) for path in paths]
+    else:
+      close_connection()
+      pool = multiprocessing.Pool(min(processes, len(paths)), initializer=close_connection)
+      try:
+        results = pool.map(import_file_in_pool, [(path, username) for path in paths])
+      finally:
+        pool.close()
+        pool.join()
+    
+    failures = 0
+    for path, thought_id, error in results:
+      if error != None:
+        failures += 1
+        self.stderr.write('%s: %s\n' % (path, error))
+      elif int(options.get('verbosity', 1)) >= 1:
+        self.stdout.write('%s: imported as thought %s\n' % (path, thought_id))
+    if failures:
+      raise CommandError('%d of %d files could not be imported.' % (failures, len(paths)))
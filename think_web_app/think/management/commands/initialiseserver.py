@@ -0,0 +1,27 @@
+"""
+Initialises the database with the Tutorial thought and the administration data, or checks that it has been initialised.
+"""
+
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand, CommandError
+
+from think.server import initialise_server, has_server_been_initialised
+
+
+class Command(NoArgsCommand):
+  help = 'Initialises the database of the think app if it has not been initialised.'
+  option_list = NoArgsCommand.option_list + (
+    make_option('--check-only', action='store_true', dest='check_only', default=False,
+      help='Do not write anything; exit with an error if the database has not been initialised.'),
+  )
+
+  def handle_noargs(self, check_only=False, **options):
+    if check_only:
+      if not has_server_been_initialised():
+        raise CommandError('The database has not been initialised.')
+      self.stdout.write('The database has been initialised.\n')
+    else:
+      initialise_server()
+      self.stdout.write('The database is initialised.\n')
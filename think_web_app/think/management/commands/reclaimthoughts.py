@@ -0,0 +1,34 @@
+"""
+Deletes the rows of Thoughts that were deleted asynchronously, a chunk at a time so that no transaction runs for long.
+"""
+
+
+import time
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from think.thought import RECLAIM_CHUNK_SIZE, reclaim_deleted_thoughts
+
+
+class Command(NoArgsCommand):
+  help = 'Deletes the nodes, connections and changes of deleted thoughts in chunks.'
+  option_list = NoArgsCommand.option_list + (
+    make_option('--chunk-size', type='int', default=RECLAIM_CHUNK_SIZE, help='The maximum number of rows deleted by each transaction.'),
+    make_option('--pause', type='float', default=0, help='The number of seconds to wait between chunks, to limit the load on the database.'),
+    make_option('--poll', type='float', default=None, help='Keep running, checking for deleted thoughts every POLL seconds once all have been reclaimed.'),
+  )
+
+  def handle_noargs(self, chunk_size=RECLAIM_CHUNK_SIZE, pause=0, poll=None, **options):
+    total = 0
+    while True:
+      count = reclaim_deleted_thoughts(chunk_size)
+      total += count
+      if count == 0:
+        if poll == None:
+          break
+        time.sleep(poll)
+      elif pause:
+        time.sleep(pause)
+    if int(options.get('verbosity', 1)) >= 1:
+      self.stdout.write('Reclaimed %d rows\n' % total)
@@ -0,0 +1,25 @@
+"""
+Runs the server of the change feed of Thoughts; see think.feedserver.
+"""
+
+
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+
+from think.feedserver import DEFAULT_PUBLISH_INTERVAL, FeedServer
+
+
+class Command(NoArgsCommand):
+  help = 'Serves the changes made to thoughts as Server-Sent Events and long polls.'
+  option_list = NoArgsCommand.option_list + (
+    make_option('--host', default='127.0.0.1', help='The address to listen on.'),
+    make_option('--port', type='int', default=8001, help='The port to listen on.'),
+    make_option('--interval', type='float', default=DEFAULT_PUBLISH_INTERVAL, help='The number of seconds between checks for changes.'),
+  )
+
+  def handle_noargs(self, host='127.0.0.1', port=8001, interval=DEFAULT_PUBLISH_INTERVAL, **options):
+    server = FeedServer(host, port)
+    if int(options.get('verbosity', 1)) >= 1:
+      self.stdout.write('Serving the change feed on %s:%d\n' % (host, port))
+    server.serve_forever(interval)
@@ -0,0 +1,23 @@
+"""
+Upgrades a database created by an earlier version of the app. Run syncdb first to create any new tables.
+"""
+
+
+from django.db import transaction
+from django.core.management.base import NoArgsCommand
+
+from think.schema import add_missing_columns, create_missing_indexes
+from think.search import create_search_index
+
+
+class Command(NoArgsCommand):
+  help = 'Adds the columns and creates the indexes and search index of the think app that are missing from an existing database.'
+
+  def handle_noargs(self, **options):
+    for column in add_missing_columns():
+      self.stdout.write('Added column %s\n' % column)
+    for name in create_missing_indexes():
+      self.stdout.write('Created index %s\n' % name)
+    if create_search_index():
+      self.stdout.write('Built the search index\n')
+    transaction.commit_unless_managed()
@@ -3,6 +3,19 @@ A collection of miscellaneous methods.
 """
 
 
+import threading
+from functools import wraps
+
+from django.db import connection, transaction
+
+from utilities import chunk_list
+
+
+# SQLite limits a statement to 999 variables and a compound SELECT to 500 terms, so bulk inserts are split into batches.
+BULK_INSERT_BATCH_SIZE = 100
+
+_after_commit = threading.local() # The functions waiting for the transaction of this thread to end.
+
 def get_id(model):
   """Gets the model's id.
      
@@ -12,3 +25,136 @@ def get_id(model):
      Returns: a string representing the model's id.
   """
   return str(model.id)
+
+def bulk_create_in_batches(model_class, models):
+  """Inserts the models into the database using as few INSERT statements as possible.
+     
+     Args:
+       model_class: the class of the models.
+       models: a list of unsaved models. Their ids are not set by this method.
+  """
+  for batch in chunk_list(models, BULK_INSERT_BATCH_SIZE):
+    model_class.objects.bulk_create(batch)
+
+def bulk_update_in_batches(model_class, field_names, rows):
+  """Updates many models of the same class using one UPDATE statement per batch.
+     
+     Each batch is written as UPDATE ... SET field = CASE id WHEN ... END ... WHERE id IN (...).
+     
+     Args:
+       model_class: the class of the models.
+       field_names: the names of the fields to update.
+       rows: a list of tuples; each tuple is the id of a model followed by its new values in the order of field_names.
+  """
+  quote_name = connection.ops.quote_name
+  table = quote_name(model_class._meta.db_table)
+  columns = [quote_name(model_class._meta.get_field(name).column) for name in field_names]
+  cursor = connection.cursor()
+  for batch in chunk_list(rows, BULK_INSERT_BATCH_SIZE):
+    assignments = []
+    params = []
+    for i, column in enumerate(columns):
+      assignments.append('%s = CASE id %s END' % (column, ' '.join(['WHEN %s THEN %s'] * len(batch))))
+      for row in batch:
+        params.extend([row[0], row[i + 1]])
+    ids = [row[0] for row in batch]
+    params.extend(ids)
+    sql = 'UPDATE %s SET %s WHERE id IN (%s)' % (table, ', '.join(assignments), ', '.join(['%s'] * len(ids)))
+    cursor.execute(sql, params)
+
+def bulk_delete_in_batches(model_class, ids):
+  """Deletes many models of the same class using one DELETE statement per batch.
+     
+     Unlike QuerySet.delete, related models are not collected first, so the caller must delete them beforehand.
+     
+     Args:
+       model_class: the class of the models.
+       ids: a list of the ids of the models to delete.
+  """
+  table = connection.ops.quote_name(model_class._meta.db_table)
+  cursor = connection.cursor()
+  for batch in chunk_list(ids, BULK_INSERT_BATCH_SIZE):
+    cursor.execute('DELETE FROM %s WHERE id IN (%s)' % (table, ', '.join(['%s'] * len(batch))), batch)
+
+def delete_where(model_class, field_name, value):
+  """Deletes every model of a class whose field has a value using one DELETE statement.
+     
+     Unlike QuerySet.delete, the models are not loaded and related models are not collected first, so the caller must delete them beforehand.
+     
+     Args:
+       model_class: the class of the models.
+       field_name: the name of the field, e.g. 'thought'.
+       value: the value of the field, e.g. the id of a thought.
+  """
+  table = connection.ops.quote_name(model_class._meta.db_table)
+  column = connection.ops.quote_name(model_class._meta.get_field(field_name).column)
+  connection.cursor().execute('DELETE FROM %s WHERE %s = %%s' % (table, column), [value])
+
+def iter_value_chunks(query, field_names, chunk_size):
+  """Reads the values of the rows of a query a chunk at a time, in the order of their ids.
+     
+     QuerySet.iterator does not bound memory: the SQLite backend cannot read chunks from an open cursor, so it fetches every
+     row when the query runs, and so does the client side cursor of psycopg2. Each chunk is instead read by its own keyset
+     query, WHERE id > (the last id read) ORDER BY id LIMIT chunk_size, so at most chunk_size rows are held at a time.
+     
+     Args:
+       query: a queryset.
+       field_names: a list of the names of the fields to read.
+       chunk_size: the maximum number of rows in a chunk.
+     
+     Returns: a generator of lists of tuples of the values of the fields.
+  """
+  strip_id = 'id' not in field_names
+  if strip_id:
+    field_names = ['id'] + list(field_names)
+  id_index = list(field_names).index('id')
+  last_id = None
+  while True:
+    chunk_query = query
+    if last_id != None:
+      chunk_query = query.filter(id__gt=last_id)
+    rows = list(chunk_query.order_by('id').values_list(*field_names)[:chunk_size])
+    if not rows:
+      return
+    last_id = rows[-1][id_index]
+    if strip_id:
+      rows = [row[1:] for row in rows]
+    yield rows
+    if len(rows) < chunk_size:
+      return
+
+def run_after_commit(function):
+  """Calls a function once the transaction of this thread has ended, or now if there is no transaction.
+     
+     Django 1.4 has no hook for the end of a transaction, so the function is called when a function decorated with
+     commit_on_success_with_hooks returns or raises, i.e. once commit_on_success has committed or rolled back. A function that is already waiting is not added again.
+     
+     Args:
+       function: a function without arguments.
+  """
+  if not transaction.is_managed():
+    function()
+    return
+  pending = getattr(_after_commit, 'functions', None)
+  if pending == None:
+    pending = _after_commit.functions = []
+  if function not in pending:
+    pending.append(function)
+
+def commit_on_success_with_hooks(function):
+  """Like transaction.commit_on_success, and then calls the functions passed to run_after_commit during the transaction.
+     
+     The functions are also called after a rollback, so they must be safe to call whether or not the writes were committed,
+     e.g. invalidating a cache.
+  """
+  function = transaction.commit_on_success(function)
+  @wraps(function)
+  def call(*args, **kwargs):
+    try:
+      return function(*args, **kwargs)
+    finally:
+      pending = getattr(_after_commit, 'functions', None)
+      _after_commit.functions = None
+      for hook in pending or []:
+        hook()
+  return call
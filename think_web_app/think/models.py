@@ -1,4 +1,5 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import User
 
 
@@ -27,11 +28,24 @@ class Theme(models.Model):
   connectionInnerColor = models.TextField()
   connectionTextColor = models.TextField()
 
+
+class ThoughtManager(models.Manager):
+  """Excludes Thoughts that have been deleted but whose rows have not been reclaimed yet."""
+  
+  def get_query_set(self):
+    return super(ThoughtManager, self).get_query_set().filter(deleted=False)
+
   
 class Thought(models.Model):
   """Represents a Mind map/Thought in the Web App."""
   name = models.TextField()
   theme = models.ForeignKey('Theme', blank=True, null=True)
+  revision = models.IntegerField(default=0) # Incremented by every write to the thought, its nodes, connections, theme or permissions.
+  last_modified = models.DateTimeField(default=timezone.now) # Set whenever the revision is incremented.
+  deleted = models.BooleanField(default=False) # A tombstone; see think.thought.delete_thought_using_id.
+  
+  objects = ThoughtManager()
+  all_objects = models.Manager() # Includes deleted thoughts.
 
   
 class Node(models.Model):
@@ -50,6 +64,31 @@ class Connection(models.Model):
   thought = models.ForeignKey('Thought')
 
 
+class NodeTerm(models.Model):
+  """A posting of the search index used when the database has no full text search: a term in the text of a Node. See think.search."""
+  term = models.CharField(max_length=64)
+  node_id = models.IntegerField(db_index=True) # Plain ids rather than foreign keys, so the index can be written in any order.
+  thought_id = models.IntegerField()
+  count = models.IntegerField() # The number of times the term is in the text.
+
+
+class ThoughtChange(models.Model):
+  """Records the operations that produced a revision of a Thought; the changes of a thought are an append-only journal of its history. See think.journal."""
+  thought = models.ForeignKey('Thought')
+  revision = models.IntegerField()
+  operations = models.TextField() # A JSON list of operations; see think.thought.patchThought.
+  # The user who made the change, if known. Deleting the user must not delete changes from the journals of shared thoughts.
+  user = models.ForeignKey(User, blank=True, null=True, on_delete=models.SET_NULL)
+  created = models.DateTimeField(default=timezone.now)
+
+
+class ThoughtSnapshot(models.Model):
+  """The whole content of a Thought at a revision, so that past revisions are rebuilt from the nearest snapshot rather than from the first change."""
+  thought = models.ForeignKey('Thought')
+  revision = models.IntegerField()
+  content = models.TextField() # JSON; see think.thought.take_thought_snapshot.
+
+
 # The types of permssions.
 permit_none = "none"
 permit_view = "view"
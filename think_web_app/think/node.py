@@ -24,7 +24,21 @@ def node_to_dict(node):
      Returns:
        a dictionary.
   """
-  return {'x': node.x, 'y': node.y, 'text': node.text, 'id': get_node_id(node)}
+  return node_values_to_dict(node.id, node.x, node.y, node.text)
+
+def node_values_to_dict(id, x, y, text):
+  """Converts the values of a node's columns to a dictionary, so nodes can be serialized without creating Node models.
+     
+     Args:
+       id: the id of the node.
+       x: the x value of the node.
+       y: the y value of the node.
+       text: the text value of the node.
+     
+     Returns:
+       a dictionary identical to the one returned by node_to_dict.
+  """
+  return {'x': x, 'y': y, 'text': text, 'id': str(id)}
 
 def find_node(nodes, x, y, text):
   """Find Node in a list.
@@ -42,3 +56,29 @@ def find_node(nodes, x, y, text):
     if node.x == int(x) and node.y == int(y) and node.text == text:
       return node
   return None
+
+def get_node_key(x, y, text):
+  """Gets the key that identifies a node that has not been given an id yet.
+     
+     Args:
+       x: the x value of the node.
+       y: the y value of the node.
+       text: the text value of the node.
+     
+     Returns: a hashable key.
+  """
+  # Cast x and y to int because sometimes they may be floats which are unacceptable.
+  return (int(x), int(y), text)
+
+def create_node_index(node_values):
+  """Creates a hash index of node ids, so nodes can be found without scanning a list like find_node does.
+     
+     Args:
+       node_values: an iterable of (id, x, y, text) tuples.
+     
+     Returns: a dict of node keys to node ids. If several nodes share a key, the first one is kept.
+  """
+  index = {}
+  for id, x, y, text in node_values:
+    index.setdefault(get_node_key(x, y, text), id)
+  return index
@@ -3,9 +3,140 @@ A collection of methods relating to the Permission Model.
 """
 
 
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+from django.utils import timezone
+
 from think.models import * # Get the constants
+from think.cache import get_thought_cache
 from utilities import is_none_or_empty
 
+
+# Constants
+THOUGHT_ACL_CACHE_KEY_FORMAT = 'thought-acl:%s:%s:%s' # The thought id, revision and last modified time.
+THOUGHT_ACL_CACHE_TIMEOUT = 5 * 60 # Bounds how long a permission written by a bulk insert or raw SQL can go unnoticed.
+REQUEST_RIGHTS_ATTRIBUTE = '_thought_rights'
+
+
+class ThoughtRights:
+  """The effective rights of a user to a Thought."""
+  
+  def __init__(self, view, modify, public):
+    self.view = view
+    self.modify = modify
+    self.public = public
+  
+  def get_permission_type(self):
+    """Gets the Permission type that best describes the rights, or None."""
+    if self.modify:
+      return permit_modify
+    elif self.public:
+      return permit_all_view
+    elif self.view:
+      return permit_view
+    return None
+
+
+def load_thought_acls(thought_ids):
+  """Loads the access control lists of Thoughts with a single query.
+     
+     Args:
+       thought_ids: a list of thought ids.
+     
+     Returns: a dictionary of each thought id to a dictionary with the keys 'public', a bool, and 'users', a dict of user
+       ids to sets of Permission types.
+  """
+  acls = dict((thought_id, {'public': False, 'users': {}}) for thought_id in thought_ids)
+  for thought_id, user_id, type in Permission.objects.filter(thought__in=thought_ids).values_list('thought_id', 'user_id', 'type'):
+    if type == permit_all_view:
+      acls[thought_id]['public'] = True
+    elif user_id != None:
+      acls[thought_id]['users'].setdefault(user_id, set()).add(type)
+  return acls
+
+def load_thought_acl(thought_id):
+  """Loads the access control list of a Thought with a single query; see load_thought_acls."""
+  return load_thought_acls([thought_id])[thought_id]
+
+def get_acl_rights(acl, user_id):
+  """Resolves the effective rights of a user from the access control list of a Thought.
+     
+     Args:
+       acl: the access control list; see load_thought_acls.
+       user_id: the id of the user, or None for an anonymous user.
+     
+     Returns: a ThoughtRights.
+  """
+  types = acl['users'].get(user_id, set()) if user_id != None else set()
+  modify = permit_modify in types
+  return ThoughtRights(view=modify or permit_view in types or acl['public'], modify=modify, public=acl['public'])
+
+def get_thought_acl(thought):
+  """Gets the access control list of a revision of a Thought from the thought cache, loading it on a cache miss.
+     
+     Every write to the permissions of an existing thought increments its revision (see
+     think.thought.bump_thought_revision), and a Permission saved or deleted any other way, e.g. in the admin or a shell,
+     updates the last modified time of its thought (see touch_permission_thought). The cached list is keyed by both instead
+     of being invalidated, so a list cached by a request that read the permissions before a write committed, or by another
+     process, is never read again, since the write's transaction also commits the new key.
+     
+     Args:
+       thought: the thought model.
+     
+     Returns: a dictionary; see load_thought_acls.
+  """
+  cache = get_thought_cache()
+  key = THOUGHT_ACL_CACHE_KEY_FORMAT % (thought.id, thought.revision, thought.last_modified.isoformat())
+  acl = cache.get(key)
+  if acl == None:
+    acl = load_thought_acl(thought.id)
+    cache.set(key, acl, THOUGHT_ACL_CACHE_TIMEOUT)
+  return acl
+
+@receiver(post_save, sender=Permission)
+@receiver(post_delete, sender=Permission)
+def touch_permission_thought(sender, instance, **kwargs):
+  """Updates the last modified time of the Thought of a Permission that is saved or deleted, so that cached access control
+     lists of the thought are no longer used (see get_thought_acl).
+  """
+  if instance.thought_id != None:
+    Thought.all_objects.filter(id=instance.thought_id).update(last_modified=timezone.now())
+
+def get_thought_rights(user, thought, request=None):
+  """Resolves the effective rights of a user to a Thought.
+     
+     The access control list of a thought model is cached across requests, and the rights are memoized on the request, so a
+     request checks the permissions of a thought with at most one query. Given only the id of a thought, the list is read
+     from the database, since its revision is not known.
+     
+     Args:
+       user: the user, or None for an anonymous user.
+       thought: the thought, or its id.
+       request: the HTTP request to memoize the rights on; optional.
+     
+     Returns: a ThoughtRights.
+  """
+  thought_id = int(getattr(thought, 'id', thought))
+  user_id = user.id if user != None else None
+  memo = None
+  if request != None:
+    memo = getattr(request, REQUEST_RIGHTS_ATTRIBUTE, None)
+    if memo == None:
+      memo = {}
+      setattr(request, REQUEST_RIGHTS_ATTRIBUTE, memo)
+    if (user_id, thought_id) in memo:
+      return memo[(user_id, thought_id)]
+  
+  if isinstance(thought, Thought):
+    acl = get_thought_acl(thought)
+  else:
+    acl = load_thought_acl(thought_id)
+  rights = get_acl_rights(acl, user_id)
+  
+  if memo != None:
+    memo[(user_id, thought_id)] = rights
+  return rights
+
   
 def is_user_permitted_to_modify_thought(user, thought):
   """Checks if the user is permitted to modify the given Thought.
@@ -16,9 +147,7 @@ def is_user_permitted_to_modify_thought(user, thought):
      
      Returns: a bool; true if the user can modify the thought, false otherwise.
   """
-  query = query = Thought.objects.filter(thought=thought, user=user, type=permit_modify)
-  permission = query.get()
-  return permission != None
+  return get_thought_rights(user, thought).modify
 
 def user_can_modify_theme(user, theme):
   """Checks if the user is permitted to modify the given Theme.
@@ -42,18 +171,7 @@ def get_permission_type(thought, user):
      
      Returns: the Permission type of the thought for the user, permit_all_view (if it exists for the thought), or None.
   """
-  query = Permission.objects.filter(thought=thought, user=user)
-  permission = query.get()
-  if permission != None:
-    return permission.type
-  else:
-    # Try to get the permit_all_view type if it exists.
-    query = Permission.objects.filter(thought=thought)
-    permission = query.get()
-    if permission != None:
-      return permission.type
-    else:
-      return None
+  return get_thought_rights(user, thought).get_permission_type()
       
 def get_permissions_using_thought(thought):
   """Gets the Permission model from DataStore.
@@ -80,6 +198,16 @@ def get_permissions_using_theme(theme):
   return permissions
   
 def get_all_view_permissions(thought):
-  return Permission.objects.filter(thought=thought, type=permit_all_view).get()
+  """Gets the permit_all_view Permission of a thought.
+     
+     Args:
+       thought: The thought.
+     
+     Returns: the Permission, or None if the thought is not viewable by all.
+  """
+  permissions = Permission.objects.filter(thought=thought, type=permit_all_view)[:1]
+  if permissions:
+    return permissions[0]
+  return None
 
 
@@ -0,0 +1,396 @@
+"""
+Server-side rendering of Thoughts as SVG and PNG images.
+
+The images are drawn the way the client draws a thought (see static/js/ajs/think/draw): nodes are circles sized to fit their
+wrapped text, connections are curved polygons between the nodes, and the colours come from the thought's theme. Text cannot be
+measured on the server, so its width is estimated from the number of characters.
+
+A thought is loaded into a scene of plain tuples in the web process, and the scene is laid out and drawn in the web process or,
+if settings.EXPORT_PROCESSES is set, by a pool of that many processes. Waiting for a render process would still hold up the
+worker, so a request waits at most settings.EXPORT_TIMEOUT seconds; the render carries on, its image is cached when it is
+done, and the client is asked to retry. The output is cached in the thought cache for each revision of a thought. PNG images
+need the Python Imaging Library.
+"""
+
+
+from __future__ import with_statement
+
+import math
+import multiprocessing
+import threading
+from StringIO import StringIO
+from xml.sax.saxutils import escape, quoteattr
+
+from django.conf import settings
+
+from think.models import Node, Connection
+from think.theme import get_registered_theme, get_registered_default_theme
+from think.data import ORIGINAL_THEME
+from think.cache import get_thought_cache
+
+try:
+  from PIL import Image, ImageColor, ImageDraw
+except ImportError:
+  Image = None
+
+
+# Constants
+SVG_FORMAT = 'svg'
+PNG_FORMAT = 'png'
+CONTENT_TYPES = {
+  SVG_FORMAT: 'image/svg+xml',
+  PNG_FORMAT: 'image/png',
+}
+RENDER_CACHE_KEY_FORMAT = 'thought-render:%s:%s:%s:%s' # The thought id, revision, last modified time and format.
+RENDER_TIMEOUT = 5 # The number of seconds a request waits for a render process, unless settings.EXPORT_TIMEOUT is set.
+MAX_PNG_PIXELS = 4096 * 4096 # Larger PNG images are scaled down.
+CURVE_SEGMENTS = 12 # The number of line segments a curve is drawn with in a PNG image.
+
+# The drawing options of ajs.think.Options.
+NODE_FONT_SIZE = 14
+NODE_PADDING = 15
+MINIMUM_TEXT_WIDTH = 10
+CIRCLE_STROKE_WIDTH = 3
+CIRCLE_STROKE_COLOR = '#000000'
+CIRCLE_GRADIENT_INNER_RADIUS_QUOTIENT = 10
+CONTROL_POINT_CONSTANT = 550
+IMAGE_PADDING = 10
+WRAP_INEFFICIENCY_RATIO = 1.7 # The client's guess at the inefficiency of its word wrapping.
+CHARACTER_WIDTH = 0.55 * NODE_FONT_SIZE # The estimated average width of a character.
+
+THEME_COLOR_NAMES = ['backgroundTopColor', 'backgroundBottomColor', 'nodeOuterColor', 'nodeInnerColor', 'nodeTextColor',
+  'connectionOuterColor', 'connectionInnerColor', 'connectionTextColor']
+
+
+class RenderError(Exception):
+  """Raised when a thought cannot be rendered."""
+  pass
+
+
+def get_text_width(text):
+  """Estimates the width of a line of node text."""
+  return len(text) * CHARACTER_WIDTH
+
+def wrap_text(text):
+  """Wraps the text of a node into lines that make a roughly round block, like ajs.think.node does.
+
+     Args:
+       text: the text.
+
+     Returns: a list of lines.
+  """
+  words = text.split()
+  if not words:
+    return []
+  # A square block of text fits in the smallest circle.
+  line_width = math.sqrt(get_text_width(text) * NODE_FONT_SIZE * WRAP_INEFFICIENCY_RATIO)
+  lines = [words[0]]
+  for word in words[1:]:
+    line = lines[-1] + ' ' + word
+    if get_text_width(line) <= line_width:
+      lines[-1] = line
+    else:
+      lines.append(word)
+  return lines
+
+def get_node_radius(lines):
+  """Computes the radius of a node from its wrapped text, like ajs.think.node.radiusBasedOnWrappedText.
+
+     Args:
+       lines: the wrapped lines of text.
+
+     Returns: the radius.
+  """
+  radius = 0
+  for i, line in enumerate(lines):
+    x = get_text_width(line) / 2
+    y = NODE_FONT_SIZE * (len(lines) / 2.0 - i)
+    radius = max(radius, math.hypot(x, y))
+  return max(radius, MINIMUM_TEXT_WIDTH) + NODE_PADDING
+
+def get_connection_outline(x0, y0, r0, x1, y1, r1):
+  """Computes the outline of a connection, like ajs.think.draw.connection.drawConnection.
+
+     Returns: a tuple of the points top0, control top, top1, bottom1, control bottom and bottom0. The outline runs from top0
+     to top1 along a quadratic curve, to bottom1, and back to bottom0 along a second quadratic curve.
+  """
+  if x1 - x0 == 0:
+    angle = math.pi / 2
+  else:
+    angle = math.atan(float(y1 - y0) / (x1 - x0))
+  top_angle = angle + math.pi / 2
+  bottom_angle = top_angle + math.pi
+  control_point_value = -CONTROL_POINT_CONSTANT / min(r0, r1)
+  middle_x, middle_y = (x0 + x1) / 2.0, (y0 + y1) / 2.0
+
+  def point(x, y, r, a):
+    return (x + math.cos(a) * r, y + math.sin(a) * r)
+  return (point(x0, y0, r0, top_angle), point(middle_x, middle_y, control_point_value, top_angle), point(x1, y1, r1, top_angle),
+    point(x1, y1, r1, bottom_angle), point(middle_x, middle_y, control_point_value, bottom_angle), point(x0, y0, r0, bottom_angle))
+
+def layout_scene(scene):
+  """Wraps the text and sizes the nodes of a scene.
+
+     Args:
+       scene: a scene created by get_thought_scene.
+
+     Returns: a tuple of a list of (x, y, radius, lines) tuples and the (x0, y0, x1, y1) bounding box of the image.
+  """
+  nodes = []
+  for x, y, text in scene['nodes']:
+    lines = wrap_text(text)
+    nodes.append((x, y, get_node_radius(lines), lines))
+  if not nodes:
+    return nodes, (0, 0, 2 * IMAGE_PADDING, 2 * IMAGE_PADDING)
+  box = (min(x - r for x, y, r, lines in nodes) - IMAGE_PADDING, min(y - r for x, y, r, lines in nodes) - IMAGE_PADDING,
+    max(x + r for x, y, r, lines in nodes) + IMAGE_PADDING, max(y + r for x, y, r, lines in nodes) + IMAGE_PADDING)
+  return nodes, box
+
+def render_svg(scene):
+  """Draws a scene as an SVG image.
+
+     Args:
+       scene: a scene created by get_thought_scene.
+
+     Returns: a UTF-8 encoded SVG document.
+  """
+  nodes, (bx0, by0, bx1, by1) = layout_scene(scene)
+  theme = scene['theme']
+  color = lambda name: quoteattr(theme[name])
+  parts = [
+    '<?xml version="1.0" encoding="UTF-8"?>\n',
+    '<svg xmlns="http://www.w3.org/2000/svg" width="%d" height="%d" viewBox="%.1f %.1f %.1f %.1f">\n' % (
+      math.ceil(bx1 - bx0), math.ceil(by1 - by0), bx0, by0, bx1 - bx0, by1 - by0),
+    '<defs>\n',
+    '<linearGradient id="background" x1="0" y1="0" x2="0" y2="1"><stop offset="0" stop-color=%s/><stop offset="1" stop-color=%s/></linearGradient>\n' % (
+      color('backgroundTopColor'), color('backgroundBottomColor')),
+    '<radialGradient id="node"><stop offset="%.2f" stop-color=%s/><stop offset="1" stop-color=%s/></radialGradient>\n' % (
+      1.0 / CIRCLE_GRADIENT_INNER_RADIUS_QUOTIENT, color('nodeInnerColor'), color('nodeOuterColor')),
+    '</defs>\n',
+    '<rect x="%.1f" y="%.1f" width="%.1f" height="%.1f" fill="url(#background)"/>\n' % (bx0, by0, bx1 - bx0, by1 - by0),
+  ]
+
+  for i, (node_one, node_two) in enumerate(scene['connections']):
+    x0, y0, r0, lines = nodes[node_one]
+    x1, y1, r1, lines = nodes[node_two]
+    top0, control_top, top1, bottom1, control_bottom, bottom0 = get_connection_outline(x0, y0, r0, x1, y1, r1)
+    parts.append('<linearGradient id="c%d" gradientUnits="userSpaceOnUse" x1="%.1f" y1="%.1f" x2="%.1f" y2="%.1f">'
+      '<stop offset="0" stop-color=%s/><stop offset="0.5" stop-color=%s/><stop offset="1" stop-color=%s/></linearGradient>\n' % (
+      i, top0[0], top0[1], bottom0[0], bottom0[1], color('connectionOuterColor'), color('connectionInnerColor'), color('connectionOuterColor')))
+    parts.append('<path d="M%.1f %.1fQ%.1f %.1f %.1f %.1fL%.1f %.1fQ%.1f %.1f %.1f %.1fZ" fill="url(#c%d)" stroke="black"/>\n' % (
+      top0 + control_top + top1 + bottom1 + control_bottom + bottom0 + (i,)))
+
+  parts.append('<g stroke=%s stroke-width="%d" fill="url(#node)">\n' % (quoteattr(CIRCLE_STROKE_COLOR), CIRCLE_STROKE_WIDTH))
+  for x, y, radius, lines in nodes:
+    parts.append('<circle cx="%s" cy="%s" r="%.1f"/>\n' % (x, y, radius))
+  parts.append('</g>\n')
+
+  parts.append('<g font-family="sans-serif" font-size="%d" text-anchor="middle" fill=%s>\n' % (NODE_FONT_SIZE, color('nodeTextColor')))
+  for x, y, radius, lines in nodes:
+    for i, line in enumerate(lines):
+      # The client draws each line from its top; the baseline is about 0.8 of the font size below it.
+      line_y = y - (len(lines) / 2.0 - i) * NODE_FONT_SIZE + 0.8 * NODE_FONT_SIZE
+      parts.append('<text x="%s" y="%.1f">%s</text>\n' % (x, line_y, escape(line)))
+  parts.append('</g>\n')
+  parts.append('</svg>\n')
+  return u''.join(parts).encode('utf-8')
+
+def get_rgb(color, default=(0, 0, 0)):
+  """Converts a CSS colour of a theme into an (r, g, b) tuple, or returns the default if it is not a colour."""
+  try:
+    return ImageColor.getrgb(color)[:3]
+  except ValueError:
+    return default
+
+def get_quadratic_curve(start, control, end):
+  """Approximates a quadratic curve by CURVE_SEGMENTS line segments.
+
+     Returns: a list of points, excluding the start point.
+  """
+  points = []
+  for i in xrange(1, CURVE_SEGMENTS + 1):
+    t = float(i) / CURVE_SEGMENTS
+    points.append(((1 - t) ** 2 * start[0] + 2 * (1 - t) * t * control[0] + t ** 2 * end[0],
+      (1 - t) ** 2 * start[1] + 2 * (1 - t) * t * control[1] + t ** 2 * end[1]))
+  return points
+
+def render_png(scene):
+  """Draws a scene as a PNG image. Gradients are drawn as flat colours.
+
+     Args:
+       scene: a scene created by get_thought_scene.
+
+     Returns: the PNG data.
+
+     Raises:
+       RenderError: the Python Imaging Library is not installed.
+  """
+  if Image == None:
+    raise RenderError('PNG images cannot be rendered without the Python Imaging Library.')
+  nodes, (bx0, by0, bx1, by1) = layout_scene(scene)
+  theme = scene['theme']
+  scale = min(1.0, math.sqrt(float(MAX_PNG_PIXELS) / ((bx1 - bx0) * (by1 - by0))))
+  width, height = int(math.ceil((bx1 - bx0) * scale)), int(math.ceil((by1 - by0) * scale))
+  transform = lambda (x, y): ((x - bx0) * scale, (y - by0) * scale)
+
+  image = Image.new('RGB', (width, height))
+  draw = ImageDraw.Draw(image)
+  top, bottom = get_rgb(theme['backgroundTopColor']), get_rgb(theme['backgroundBottomColor'])
+  for row in xrange(height):
+    t = float(row) / max(height - 1, 1)
+    draw.line([(0, row), (width, row)], fill=tuple(int(a + (b - a) * t) for a, b in zip(top, bottom)))
+
+  connection_color, outline_color = get_rgb(theme['connectionInnerColor']), get_rgb(theme['connectionOuterColor'])
+  for node_one, node_two in scene['connections']:
+    x0, y0, r0, lines = nodes[node_one]
+    x1, y1, r1, lines = nodes[node_two]
+    top0, control_top, top1, bottom1, control_bottom, bottom0 = get_connection_outline(x0, y0, r0, x1, y1, r1)
+    outline = [top0] + get_quadratic_curve(top0, control_top, top1) + [bottom1] + get_quadratic_curve(bottom1, control_bottom, bottom0)
+    draw.polygon([transform(point) for point in outline], fill=connection_color, outline=outline_color)
+
+  node_color, stroke_color = get_rgb(theme['nodeInnerColor']), get_rgb(CIRCLE_STROKE_COLOR)
+  text_color = get_rgb(theme['nodeTextColor'], (255, 255, 255))
+  for x, y, radius, lines in nodes:
+    (cx, cy), r = transform((x, y)), radius * scale
+    draw.ellipse([cx - r, cy - r, cx + r, cy + r], fill=stroke_color)
+    inner = max(r - CIRCLE_STROKE_WIDTH * scale, 0)
+    draw.ellipse([cx - inner, cy - inner, cx + inner, cy + inner], fill=node_color)
+    for i, line in enumerate(lines):
+      line_width, line_height = draw.textsize(line)
+      line_x, line_y = transform((x, y - (len(lines) / 2.0 - i) * NODE_FONT_SIZE))
+      draw.text((line_x - line_width / 2.0, line_y), line, fill=text_color)
+
+  output = StringIO()
+  image.save(output, 'PNG')
+  return output.getvalue()
+
+def render_scene(format, scene):
+  """Draws a scene in an image format. This is the function run by the render processes.
+
+     Args:
+       format: SVG_FORMAT or PNG_FORMAT.
+       scene: a scene created by get_thought_scene.
+
+     Returns: the image data.
+  """
+  if format == SVG_FORMAT:
+    return render_svg(scene)
+  return render_png(scene)
+
+def get_thought_scene(thought):
+  """Loads the parts of a Thought that are drawn, as plain data that can be sent to a render process.
+
+     Args:
+       thought: the thought model.
+
+     Returns: a dictionary of 'nodes', a list of (x, y, text) tuples, 'connections', a list of (node one index, node two
+     index) tuples, and 'theme', a dictionary of the theme's colours.
+  """
+  node_values = Node.objects.filter(thought=thought).order_by('id').values_list('id', 'x', 'y', 'text')
+  ids_to_indexes = {}
+  nodes = []
+  for id, x, y, text in node_values:
+    ids_to_indexes[id] = len(nodes)
+    nodes.append((x, y, text))
+  connections = []
+  for node_one_id, node_two_id in Connection.objects.filter(thought=thought).values_list('node_one_id', 'node_two_id'):
+    connections.append((ids_to_indexes[node_one_id], ids_to_indexes[node_two_id]))
+
+  theme = get_registered_theme(thought.theme_id) or get_registered_default_theme()
+  if theme != None:
+    colors = dict((name, getattr(theme, name)) for name in THEME_COLOR_NAMES)
+  else:
+    colors = dict((name, ORIGINAL_THEME[name]) for name in THEME_COLOR_NAMES)
+  return {'nodes': nodes, 'connections': connections, 'theme': colors}
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_pending_renders = {} # The render cache keys of the images being rendered by the pool to their AsyncResults.
+
+def get_render_pool():
+  """Gets the pool of render processes of this process, creating it on first use.
+
+     The pool is forked from the web process when it is first needed, so it is off by default: a threaded worker may be
+     forked while another thread holds a lock, which the render processes would then never see released.
+
+     Returns: a multiprocessing Pool, or None if settings.EXPORT_PROCESSES is 0 and thoughts are rendered in the web process.
+  """
+  global _pool
+  processes = getattr(settings, 'EXPORT_PROCESSES', 0)
+  if not processes:
+    return None
+  with _pool_lock:
+    if _pool == None:
+      _pool = multiprocessing.Pool(processes)
+    return _pool
+
+def render_thought(thought, format):
+  """Renders a Thought as an image, using the cached image of its revision if there is one.
+
+     Args:
+       thought: the thought model.
+       format: SVG_FORMAT or PNG_FORMAT.
+
+     Returns: the image data.
+
+     Raises:
+       RenderError: the thought cannot be rendered in the format.
+       multiprocessing.TimeoutError: the render process is still running after settings.EXPORT_TIMEOUT seconds. It carries
+         on, and a later call gets its image.
+  """
+  if format not in CONTENT_TYPES:
+    raise RenderError('Unknown format: %s' % format)
+  if format == PNG_FORMAT and Image == None:
+    raise RenderError('PNG images cannot be rendered without the Python Imaging Library.')
+
+  # The last modified time distinguishes a thought from an earlier deleted thought with the same id and revision.
+  key = RENDER_CACHE_KEY_FORMAT % (thought.id, thought.revision, thought.last_modified.isoformat(), format)
+  cache = get_thought_cache()
+  data = cache.get(key)
+  if data == None:
+    pool = get_render_pool()
+    if pool == None:
+      data = render_scene(format, get_thought_scene(thought))
+      cache.set(key, data)
+    else:
+      result = start_render(pool, key, format, thought)
+      try:
+        data = result.get(getattr(settings, 'EXPORT_TIMEOUT', RENDER_TIMEOUT))
+      except multiprocessing.TimeoutError:
+        raise
+      except Exception:
+        # The render failed, so the next request starts another.
+        with _pool_lock:
+          _pending_renders.pop(key, None)
+        raise
+  return data
+
+def start_render(pool, key, format, thought):
+  """Starts rendering a Thought in the pool, unless it is already being rendered, e.g. for a request that timed out.
+
+     Args:
+       pool: the multiprocessing Pool.
+       key: the render cache key of the image.
+       format: SVG_FORMAT or PNG_FORMAT.
+       thought: the thought model.
+
+     Returns: the AsyncResult of the render. The image is cached when it is done, whether or not a request is waiting.
+  """
+  with _pool_lock:
+    result = _pending_renders.get(key)
+  if result != None:
+    return result
+
+  def finish(data):
+    # Called by the result handler thread of the pool.
+    get_thought_cache().set(key, data)
+    with _pool_lock:
+      _pending_renders.pop(key, None)
+
+  scene = get_thought_scene(thought)
+  with _pool_lock:
+    result = _pending_renders.get(key)
+    if result == None:
+      result = _pending_renders[key] = pool.apply_async(render_scene, (format, scene), callback=finish)
+  return result
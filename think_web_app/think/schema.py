@@ -0,0 +1,181 @@
+"""
+Indexes and columns that syncdb does not manage, and the upgrade of databases created before they were added.
+
+Django creates the tables and the foreign key indexes of think/models.py, but not composite indexes or columns added to tables
+that already exist. INDEXES lists the composite indexes matching the lookups the app makes; they are created after syncdb by
+think.management and, together with ADDED_COLUMNS, by the upgradeschema command for existing databases. HOT_QUERIES are the
+lookups the indexes serve; the explainqueries command prints their query plans.
+"""
+
+
+from django.db import connection, transaction
+
+from think.models import Thought, Node, Connection, NodeTerm, Permission, ThoughtChange, ThoughtSnapshot, permit_view, permit_modify, permit_all_view
+
+
+# Constants
+MYSQL_TEXT_PREFIX_LENGTH = 255 # MySQL can only index a prefix of a text column.
+
+# (name, model, field names) tuples.
+INDEXES = [
+  ('think_thought_name', Thought, ['name']),
+  ('think_thought_deleted', Thought, ['deleted']),
+  ('think_permission_thought_id_user_id_type', Permission, ['thought', 'user', 'type']),
+  ('think_permission_thought_id_type', Permission, ['thought', 'type']),
+  ('think_permission_theme_id_user_id_type', Permission, ['theme', 'user', 'type']),
+  ('think_permission_user_id_type', Permission, ['user', 'type']),
+  ('think_node_thought_id_x_y', Node, ['thought', 'x', 'y']),
+  ('think_node_thought_id_id', Node, ['thought', 'id']),
+  ('think_connection_thought_id_id', Connection, ['thought', 'id']),
+  ('think_thoughtchange_thought_id_revision', ThoughtChange, ['thought', 'revision']),
+  ('think_nodeterm_term_thought_id', NodeTerm, ['term', 'thought_id']),
+  ('think_thoughtsnapshot_thought_id_revision', ThoughtSnapshot, ['thought', 'revision']),
+]
+
+# (model, field name) tuples of the columns added to tables after they were first created.
+ADDED_COLUMNS = [
+  (Thought, 'revision'),
+  (Thought, 'last_modified'),
+  (Thought, 'deleted'),
+  (ThoughtChange, 'user'),
+  (ThoughtChange, 'created'),
+]
+
+# (description, function without arguments that returns the queryset) tuples.
+HOT_QUERIES = [
+  ('Thought by name', lambda: Thought.objects.filter(name='name')),
+  ('Permissions of a thought', lambda: Permission.objects.filter(thought=1).values_list('user_id', 'type')),
+  ('Permission of a user to a thought', lambda: Permission.objects.filter(thought=1, user=1, type=permit_modify)),
+  ('Public permission of a thought', lambda: Permission.objects.filter(thought=1, type=permit_all_view)),
+  ('Permission of a user to a theme', lambda: Permission.objects.filter(theme=1, user=1, type=permit_modify)),
+  ('Thoughts of a user', lambda: Thought.objects.filter(permission__user=1, permission__type__in=[permit_view, permit_modify]).distinct().order_by('name', 'id')),
+  ('Page of the thoughts a user can modify', lambda: Thought.objects.filter(permission__user=1, permission__type=permit_modify, id__gt=0).distinct().order_by('id')[:100]),
+  ('Chunk of the nodes of a thought', lambda: Node.objects.filter(thought=1, id__gt=0).order_by('id').values_list('id', 'x', 'y', 'text')[:500]),
+  ('Nodes of a thought in a box', lambda: Node.objects.filter(thought=1, x__gte=0, x__lte=100, y__gte=0, y__lte=100)),
+  ('Deleted thoughts', lambda: Thought.all_objects.filter(deleted=True).values_list('id', flat=True)[:1]),
+  ('Changes of a thought since a revision', lambda: ThoughtChange.objects.filter(thought=1, revision__gt=0).order_by('revision')),
+  ('Nearest snapshot of a revision', lambda: ThoughtSnapshot.objects.filter(thought=1, revision__lte=100).order_by('-revision')[:1]),
+  ('Search terms in the thoughts of a user', lambda: NodeTerm.objects.filter(term__in=['term'], thought_id__in=Permission.objects.filter(user=1, type__in=[permit_view, permit_modify]).values('thought'))),
+]
+
+
+def get_index_names(cursor, table):
+  """Gets the names of the indexes of a table.
+
+     Args:
+       cursor: a database cursor.
+       table: the name of the table.
+
+     Returns: a set of index names, or None if the indexes of this database, e.g. Oracle, cannot be listed.
+  """
+  if connection.vendor == 'sqlite':
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = %s", [table])
+    return set(row[0] for row in cursor.fetchall())
+  elif connection.vendor == 'postgresql':
+    cursor.execute('SELECT indexname FROM pg_indexes WHERE tablename = %s', [table])
+    return set(row[0] for row in cursor.fetchall())
+  elif connection.vendor == 'mysql':
+    cursor.execute('SHOW INDEX FROM %s' % connection.ops.quote_name(table))
+    return set(row[2] for row in cursor.fetchall())
+  return None
+
+def get_index_sql(name, model, field_names):
+  """Gets the statement that creates an index.
+
+     Args:
+       name: the name of the index.
+       model: the model class of the table.
+       field_names: the names of the indexed fields.
+
+     Returns: a SQL string.
+  """
+  quote_name = connection.ops.quote_name
+  columns = []
+  for field_name in field_names:
+    field = model._meta.get_field(field_name)
+    column = quote_name(field.column)
+    if connection.vendor == 'mysql' and field.db_type(connection) in ('longtext', 'text'):
+      column += '(%d)' % MYSQL_TEXT_PREFIX_LENGTH
+    columns.append(column)
+  return 'CREATE INDEX %s ON %s (%s)' % (quote_name(name), quote_name(model._meta.db_table), ', '.join(columns))
+
+def create_missing_indexes():
+  """Creates the INDEXES that do not exist yet. Nothing is created on databases whose indexes cannot be listed, since a
+     missing index could not be told apart from one that already exists.
+
+     Returns: a list of the names of the indexes created.
+  """
+  cursor = connection.cursor()
+  existing_names = {}
+  created = []
+  for name, model, field_names in INDEXES:
+    table = model._meta.db_table
+    if table not in existing_names:
+      existing_names[table] = get_index_names(cursor, table)
+    if existing_names[table] == None:
+      continue
+    if name not in existing_names[table]:
+      cursor.execute(get_index_sql(name, model, field_names))
+      existing_names[table].add(name)
+      created.append(name)
+  transaction.commit_unless_managed()
+  return created
+
+def get_add_column_sql(model, field_name):
+  """Gets the statement that adds a column to an existing table, filling it with the field's default, or with NULL if the
+     field is nullable.
+
+     Args:
+       model: the model class of the table.
+       field_name: the name of the field.
+
+     Returns: a SQL string.
+  """
+  field = model._meta.get_field(field_name)
+  quote_name = connection.ops.quote_name
+  if field.null:
+    return 'ALTER TABLE %s ADD COLUMN %s %s NULL' % (quote_name(model._meta.db_table), quote_name(field.column), field.db_type(connection))
+  default = field.get_db_prep_save(field.get_default(), connection=connection)
+  if isinstance(default, bool):
+    if connection.vendor == 'postgresql':
+      default = str(default).upper()
+    else:
+      default = int(default)
+  elif not isinstance(default, (int, long)):
+    default = "'%s'" % unicode(default).replace("'", "''")
+  return 'ALTER TABLE %s ADD COLUMN %s %s NOT NULL DEFAULT %s' % (quote_name(model._meta.db_table), quote_name(field.column),
+    field.db_type(connection), default)
+
+def add_missing_columns():
+  """Adds the ADDED_COLUMNS that do not exist yet.
+
+     Returns: a list of 'table.column' strings of the columns added.
+  """
+  cursor = connection.cursor()
+  added = []
+  for model, field_name in ADDED_COLUMNS:
+    table = model._meta.db_table
+    column = model._meta.get_field(field_name).column
+    existing_columns = [row[0] for row in connection.introspection.get_table_description(cursor, table)]
+    if column not in existing_columns:
+      cursor.execute(get_add_column_sql(model, field_name))
+      added.append('%s.%s' % (table, column))
+  transaction.commit_unless_managed()
+  return added
+
+def explain_query(queryset):
+  """Gets the query plan of a queryset.
+
+     Args:
+       queryset: the queryset.
+
+     Returns: a list of rows of the database's plan, each a tuple.
+  """
+  sql, params = queryset.query.sql_with_params()
+  if connection.vendor == 'sqlite':
+    prefix = 'EXPLAIN QUERY PLAN '
+  else:
+    prefix = 'EXPLAIN '
+  cursor = connection.cursor()
+  cursor.execute(prefix + sql, params)
+  return cursor.fetchall()
@@ -0,0 +1,247 @@
+"""
+Full text search of the text of the nodes of Thoughts.
+
+The text of every node is kept in an inverted index, which the functions of think.thought that write nodes update in the same
+transaction. On SQLite with FTS5 the index is an FTS5 table whose rowids are node ids; SQLite ranks the matches with bm25 and
+cuts their snippets. On other databases, or when settings.SEARCH_INDEX is 'terms', the index is the NodeTerm table, whose
+terms are found in Python and whose matches are ranked by how often the terms occur. Either way a search is one query that
+joins the index to the permissions of the user, so only thoughts the user may view are searched.
+"""
+
+
+import re
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q, Count, Sum
+
+from think.models import Node, NodeTerm, Permission, permit_view, permit_modify, permit_all_view
+from think.misc import BULK_INSERT_BATCH_SIZE, bulk_create_in_batches, delete_where, iter_value_chunks
+from utilities import chunk_list
+
+
+# Constants
+FTS_INDEX = 'fts'
+TERMS_INDEX = 'terms'
+FTS_TABLE = 'think_node_fts'
+MAX_TERM_LENGTH = 64
+MAX_QUERY_TERMS = 10
+DEFAULT_RESULT_LIMIT = 20
+MAX_RESULT_LIMIT = 100
+SNIPPET_WORDS = 12
+SNIPPET_ELLIPSIS = u'\u2026'
+TERM_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+_index_types = {} # Database vendors to the type of index used when settings.SEARCH_INDEX is not set.
+
+
+def tokenize(text):
+  """Splits text into the terms of the NodeTerm index.
+
+     Args:
+       text: a string.
+
+     Returns: a list of lower case terms, in the order they appear.
+  """
+  return [term[:MAX_TERM_LENGTH] for term in TERM_PATTERN.findall(text.lower())]
+
+def get_search_index_type():
+  """Gets the type of index used by this database.
+
+     Returns: FTS_INDEX or TERMS_INDEX.
+  """
+  index_type = getattr(settings, 'SEARCH_INDEX', None)
+  if index_type != None:
+    return index_type
+  if connection.vendor not in _index_types:
+    index_type = TERMS_INDEX
+    if connection.vendor == 'sqlite':
+      cursor = connection.cursor()
+      cursor.execute("SELECT sqlite_compileoption_used('ENABLE_FTS5')")
+      if cursor.fetchone()[0]:
+        index_type = FTS_INDEX
+    _index_types[connection.vendor] = index_type
+  return _index_types[connection.vendor]
+
+def create_search_index():
+  """Creates the FTS5 table if it is used and does not exist, and fills the index if it is empty but there are nodes.
+
+     Returns: True if the index was filled.
+  """
+  cursor = connection.cursor()
+  if get_search_index_type() == FTS_INDEX:
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = %s", [FTS_TABLE])
+    if cursor.fetchone() != None:
+      # The flush command empties the node table but not the FTS5 table.
+      if not Node.objects.exists():
+        cursor.execute('DELETE FROM %s' % FTS_TABLE)
+      return False
+    cursor.execute('CREATE VIRTUAL TABLE %s USING fts5(text, thought_id UNINDEXED)' % FTS_TABLE)
+    cursor.execute('INSERT INTO %s (rowid, text, thought_id) SELECT id, text, thought_id FROM %s' % (FTS_TABLE, Node._meta.db_table))
+    return True
+  if NodeTerm.objects.exists() or not Node.objects.exists():
+    return False
+  thought_ids = Node.objects.values_list('thought', flat=True).distinct()
+  for thought_id in thought_ids:
+    index_thought(thought_id)
+  return True
+
+def get_node_terms(thought_id, node_id, text):
+  """Creates the NodeTerm postings of the text of a node.
+
+     Args:
+       thought_id: the id of the thought of the node.
+       node_id: the id of the node.
+       text: the text of the node.
+
+     Returns: a list of unsaved NodeTerms.
+  """
+  counts = {}
+  for term in tokenize(text):
+    counts[term] = counts.get(term, 0) + 1
+  return [NodeTerm(term=term, node_id=node_id, thought_id=thought_id, count=count) for term, count in counts.items()]
+
+def index_nodes(thought_id, rows):
+  """Adds nodes to the index, replacing the text indexed for any of them before.
+
+     Args:
+       thought_id: the id of the thought of the nodes.
+       rows: a list of (node id, text) tuples.
+  """
+  if not rows:
+    return
+  if get_search_index_type() == FTS_INDEX:
+    cursor = connection.cursor()
+    for batch in chunk_list(rows, BULK_INSERT_BATCH_SIZE):
+      params = []
+      for node_id, text in batch:
+        params.extend([node_id, text, thought_id])
+      cursor.execute('INSERT OR REPLACE INTO %s (rowid, text, thought_id) VALUES %s' % (FTS_TABLE, ', '.join(['(%s, %s, %s)'] * len(batch))), params)
+  else:
+    remove_nodes([node_id for node_id, text in rows])
+    terms = []
+    for node_id, text in rows:
+      terms.extend(get_node_terms(thought_id, node_id, text))
+    bulk_create_in_batches(NodeTerm, terms)
+
+def index_thought(thought_id):
+  """Adds every node of a Thought to the index. The nodes must not be in the index already.
+
+     Args:
+       thought_id: the id of the thought.
+  """
+  if get_search_index_type() == FTS_INDEX:
+    connection.cursor().execute('INSERT OR REPLACE INTO %s (rowid, text, thought_id) SELECT id, text, thought_id FROM %s WHERE thought_id = %%s'
+      % (FTS_TABLE, Node._meta.db_table), [thought_id])
+  else:
+    # The nodes are read and their terms written a batch at a time, so the memory used does not depend on the size of the
+    # thought.
+    for chunk in iter_value_chunks(Node.objects.filter(thought=thought_id), ['id', 'text'], BULK_INSERT_BATCH_SIZE):
+      terms = []
+      for node_id, text in chunk:
+        terms.extend(get_node_terms(thought_id, node_id, text))
+      bulk_create_in_batches(NodeTerm, terms)
+
+def remove_nodes(node_ids):
+  """Removes nodes from the index.
+
+     Args:
+       node_ids: a list of node ids.
+  """
+  if get_search_index_type() == FTS_INDEX:
+    cursor = connection.cursor()
+    for batch in chunk_list(list(node_ids), BULK_INSERT_BATCH_SIZE):
+      cursor.execute('DELETE FROM %s WHERE rowid IN (%s)' % (FTS_TABLE, ', '.join(['%s'] * len(batch))), batch)
+  else:
+    for batch in chunk_list(list(node_ids), BULK_INSERT_BATCH_SIZE):
+      NodeTerm.objects.filter(node_id__in=batch).delete()
+
+def remove_thought(thought_id):
+  """Removes every node of a Thought from the index. This must be called before the nodes are deleted.
+
+     Args:
+       thought_id: the id of the thought.
+  """
+  if get_search_index_type() == FTS_INDEX:
+    connection.cursor().execute('DELETE FROM %s WHERE rowid IN (SELECT id FROM %s WHERE thought_id = %%s)'
+      % (FTS_TABLE, Node._meta.db_table), [thought_id])
+  else:
+    delete_where(NodeTerm, 'thought_id', thought_id)
+
+def get_viewable_thought_ids(user):
+  """Gets a queryset of the ids of the Thoughts a user may view, for use as a subquery.
+
+     Args:
+       user: the user, or None for an anonymous user.
+
+     Returns: a values queryset of Permissions.
+  """
+  condition = Q(type=permit_all_view)
+  if user != None:
+    condition |= Q(user=user, type__in=[permit_view, permit_modify])
+  return Permission.objects.filter(condition, thought__isnull=False).values('thought')
+
+def make_snippet(text, terms):
+  """Cuts the words around the first match out of a node's text.
+
+     Args:
+       text: the text of the node.
+       terms: a list of the terms searched for.
+
+     Returns: a string of at most SNIPPET_WORDS words.
+  """
+  words = text.split()
+  terms = set(terms)
+  first = 0
+  for i, word in enumerate(words):
+    if terms.intersection(tokenize(word)):
+      first = i
+      break
+  start = max(0, min(first - SNIPPET_WORDS / 2, len(words) - SNIPPET_WORDS))
+  snippet = u' '.join(words[start:start + SNIPPET_WORDS])
+  if start > 0:
+    snippet = SNIPPET_ELLIPSIS + snippet
+  if start + SNIPPET_WORDS < len(words):
+    snippet += SNIPPET_ELLIPSIS
+  return snippet
+
+def search_nodes(user, query, limit=DEFAULT_RESULT_LIMIT):
+  """Finds the nodes whose text contains every term of a query, in the Thoughts a user may view.
+
+     Args:
+       user: the user, or None for an anonymous user.
+       query: the text searched for.
+       limit: the maximum number of results; at most MAX_RESULT_LIMIT.
+
+     Returns: a list of result dictionaries, best first. The dictionaries are meant to be converted into JSON and have the
+       following properties: thoughtId, nodeId, snippet.
+
+     Raises:
+       ValueError: the limit is invalid.
+  """
+  limit = int(limit)
+  if limit < 1 or limit > MAX_RESULT_LIMIT:
+    raise ValueError('The limit must be between 1 and %d.' % MAX_RESULT_LIMIT)
+  terms = []
+  for term in tokenize(query):
+    if term not in terms:
+      terms.append(term)
+  terms = terms[:MAX_QUERY_TERMS]
+  if not terms:
+    return []
+
+  viewable_sql, viewable_params = get_viewable_thought_ids(user).query.sql_with_params()
+  if get_search_index_type() == FTS_INDEX:
+    # Quoting every term makes them match as plain words rather than FTS5 query syntax; the terms are implicitly ANDed.
+    match = ' '.join('"%s"' % term.replace('"', '""') for term in terms)
+    cursor = connection.cursor()
+    cursor.execute('SELECT thought_id, rowid, snippet(%s, 0, %%s, %%s, %%s, %%s) FROM %s WHERE %s MATCH %%s AND thought_id IN (%s) ORDER BY rank LIMIT %%s'
+      % (FTS_TABLE, FTS_TABLE, FTS_TABLE, viewable_sql), ['', '', SNIPPET_ELLIPSIS, SNIPPET_WORDS, match] + list(viewable_params) + [limit])
+    rows = cursor.fetchall()
+  else:
+    matches = list(NodeTerm.objects.filter(term__in=terms, thought_id__in=get_viewable_thought_ids(user))
+      .values('node_id', 'thought_id').annotate(matched=Count('id'), score=Sum('count')).filter(matched=len(terms))
+      .order_by('-score', 'node_id')[:limit])
+    texts = dict(Node.objects.filter(id__in=[match['node_id'] for match in matches]).values_list('id', 'text'))
+    rows = [(match['thought_id'], match['node_id'], make_snippet(texts.get(match['node_id'], u''), terms)) for match in matches]
+  return [{'thoughtId': str(thought_id), 'nodeId': str(node_id), 'snippet': snippet} for thought_id, node_id, snippet in rows]
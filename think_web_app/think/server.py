@@ -7,25 +7,30 @@ from think.models import Thought, ServerInitialised
 import think.data
 
 
+class ServerState:
+  """What this process knows about the Server's Database."""
+  
+  initialised = False # Only set once the database has been seen to be initialised, since that cannot be undone.
+
+
 def initialise_server():
-  """Initialised the Server's Database."""
+  """Initialised the Server's Database, unless it has already been initialised. The data is written in one transaction by think.data.main."""
   if not has_server_been_initialised():
     think.data.main()
     mark_server_as_initialised()
   
 def has_server_been_initialised():
-  """Checks if the Server has been initialised. 
+  """Checks if the Server has been initialised. The database is only queried until it has been seen to be initialised.
      
      Returns: true if the Server has been initialised, false otherwise.
   """
-  s = ServerInitialised.objects.all()
-  if not s:
-    return False
-  else:
-    return s[0].initialised
+  if not ServerState.initialised:
+    ServerState.initialised = ServerInitialised.objects.filter(initialised=True).exists()
+  return ServerState.initialised
 
 def mark_server_as_initialised():
   """Marks the Server as initialised."""
-  s = ServerInitialised(initialised=True)
-  s.save()
-  
+  if not ServerInitialised.objects.filter(initialised=True).exists():
+    s = ServerInitialised(initialised=True)
+    s.save()
+  ServerState.initialised = True
@@ -0,0 +1,168 @@
+"""
+Spatial lookups of the nodes of a Thought, so a client can fetch only the part of a thought inside its viewport.
+
+A box is first answered by a range query on the (thought, x, y) index of the node table. Once the same revision of a thought
+has been queried GRID_BUILD_THRESHOLD times, e.g. because a user is panning around it, a NodeGrid of the whole thought is built
+and kept in memory, and later boxes are answered without querying the database.
+"""
+
+
+from __future__ import with_statement
+
+import math
+import threading
+from collections import OrderedDict
+
+from django.db.models import Q
+
+from think.models import Node, Connection
+
+
+# Constants
+GRID_CELL_SIZE = 512 # The width and height of a grid cell, in the same units as the x and y of a node.
+GRID_BUILD_THRESHOLD = 2 # The number of box queries of a revision of a thought after which its grid is built.
+GRID_CACHE_SIZE = 50 # The maximum number of grids kept in memory by each process.
+MIN_COORDINATE = -2 ** 31 # The range of the integer x and y columns; the bounds of boxes are clamped to it.
+MAX_COORDINATE = 2 ** 31 - 1
+
+
+class NodeGrid:
+  """A uniform grid of the nodes of a Thought, with the connections of each node."""
+
+  def __init__(self, node_values, connection_values):
+    """Builds the grid.
+
+       Args:
+         node_values: an iterable of (id, x, y, text) tuples.
+         connection_values: an iterable of (node one id, node two id) tuples.
+    """
+    self.cells = {}
+    for values in node_values:
+      self.cells.setdefault(get_cell(values[1], values[2]), []).append(values)
+    self.connections = {}
+    for connection in connection_values:
+      self.connections.setdefault(connection[0], []).append(connection)
+      if connection[1] != connection[0]:
+        self.connections.setdefault(connection[1], []).append(connection)
+
+  def get_nodes_in_box(self, box):
+    """Gets the nodes inside a box.
+
+       Args:
+         box: a (x0, y0, x1, y1) tuple; the bounds are inclusive.
+
+       Returns: a list of (id, x, y, text) tuples.
+    """
+    x0, y0, x1, y1 = box
+    (cx0, cy0), (cx1, cy1) = get_cell(x0, y0), get_cell(x1, y1)
+    if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(self.cells):
+      # The box covers more cells than are occupied, so visit the occupied cells instead.
+      cells = [cell for cell in self.cells if cx0 <= cell[0] <= cx1 and cy0 <= cell[1] <= cy1]
+    else:
+      cells = [(cx, cy) for cx in xrange(cx0, cx1 + 1) for cy in xrange(cy0, cy1 + 1)]
+    nodes = []
+    for cell in cells:
+      for values in self.cells.get(cell, []):
+        if x0 <= values[1] <= x1 and y0 <= values[2] <= y1:
+          nodes.append(values)
+    return nodes
+
+  def get_connections_of_nodes(self, node_ids):
+    """Gets the connections that touch any of the given nodes.
+
+       Args:
+         node_ids: a list of node ids.
+
+       Returns: a list of (node one id, node two id) tuples.
+    """
+    connections = set()
+    for id in node_ids:
+      connections.update(self.connections.get(id, []))
+    return list(connections)
+
+
+# The keys are (thought id, revision, last modified) tuples, since the id of a deleted thought may be reused by a new thought,
+# which starts again at revision 0.
+_grids = OrderedDict() # Keys to NodeGrids, from least to most recently used.
+_box_query_counts = {} # Keys to the number of box queries answered by the database.
+_lock = threading.Lock()
+
+def get_cell(x, y):
+  """Gets the grid cell that contains a point.
+
+     Returns: a (column, row) tuple.
+  """
+  return (x // GRID_CELL_SIZE, y // GRID_CELL_SIZE)
+
+def parse_box(value):
+  """Parses a box given as 'x0,y0,x1,y1'.
+
+     Args:
+       value: the string.
+
+     Returns: a (x0, y0, x1, y1) tuple where x0 <= x1 and y0 <= y1.
+
+     Raises:
+       ValueError: the string is not a box, or a bound is not finite.
+  """
+  bounds = [float(bound) for bound in value.split(',')]
+  if len(bounds) != 4 or any(math.isinf(bound) or math.isnan(bound) for bound in bounds):
+    raise ValueError('A box must have four finite bounds.')
+  x0, y0, x1, y1 = [int(max(MIN_COORDINATE, min(MAX_COORDINATE, bound))) for bound in bounds]
+  return (min(x0, x1), min(y0, y1), max(x0, x1), max(y0, y1))
+
+def get_cached_grid(thought):
+  """Gets the grid of the current revision of a Thought if it is in memory, building it if it has been queried often enough.
+
+     Args:
+       thought: the thought model.
+
+     Returns: a NodeGrid or None.
+  """
+  key = (thought.id, thought.revision, thought.last_modified)
+  with _lock:
+    grid = _grids.pop(key, None)
+    if grid != None:
+      _grids[key] = grid
+      return grid
+    if len(_box_query_counts) > 10 * GRID_CACHE_SIZE:
+      _box_query_counts.clear() # Forget thoughts that were only queried once or twice.
+    count = _box_query_counts.get(key, 0) + 1
+    _box_query_counts[key] = count
+  if count <= GRID_BUILD_THRESHOLD:
+    return None
+
+  node_values = Node.objects.filter(thought=thought).values_list('id', 'x', 'y', 'text')
+  connection_values = Connection.objects.filter(thought=thought).values_list('node_one_id', 'node_two_id')
+  grid = NodeGrid(node_values, connection_values)
+  with _lock:
+    _box_query_counts.pop(key, None)
+    _grids[key] = grid
+    while len(_grids) > GRID_CACHE_SIZE:
+      _grids.popitem(last=False)
+    # Older revisions of the thought will not be queried again.
+    for old_key in [k for k in _box_query_counts if k[0] == thought.id and k[1] < thought.revision]:
+      del _box_query_counts[old_key]
+  return grid
+
+def get_thought_nodes_in_box(thought, box):
+  """Gets the nodes of a Thought inside a box, and the connections that touch them.
+
+     Args:
+       thought: the thought model.
+       box: a (x0, y0, x1, y1) tuple; the bounds are inclusive.
+
+     Returns: a tuple of a list of (id, x, y, text) tuples and a list of (node one id, node two id) tuples.
+  """
+  grid = get_cached_grid(thought)
+  if grid != None:
+    nodes = grid.get_nodes_in_box(box)
+    return nodes, grid.get_connections_of_nodes([values[0] for values in nodes])
+
+  x0, y0, x1, y1 = box
+  node_query = Node.objects.filter(thought=thought, x__gte=x0, x__lte=x1, y__gte=y0, y__lte=y1)
+  nodes = list(node_query.values_list('id', 'x', 'y', 'text'))
+  # Use the node query as a subquery, because a list of ids could exceed the database's limit on parameters.
+  node_ids = node_query.values('id')
+  connections = Connection.objects.filter(Q(node_one__in=node_ids) | Q(node_two__in=node_ids), thought=thought)
+  return nodes, list(connections.values_list('node_one_id', 'node_two_id'))
@@ -5,7 +5,49 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+from StringIO import StringIO
+import base64
+import asyncore
+import logging
+import tarfile
+import zipfile
+import socket
+import time
+
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
+from django.utils.unittest import skipIf, skipUnless
+from django.db import connection, DatabaseError
+from django.core.management import call_command
+from django.contrib.auth.models import User
+from django.utils import simplejson
+from django.views.decorators.csrf import csrf_exempt
+from django.http import HttpResponse
+
+from think.models import *
+from think.thought import RevisionConflictError, get_encoded_thought, iter_encoded_thought, take_thought_snapshot, createAndSaveThought, updateThought, patchThought, thought_to_dict, make_thought_public_using_id, delete_thought_using_id, reclaim_deleted_thoughts, get_thought_using_id
+from think.cache import LRUCache, get_cache_statistics, get_thought_cache
+from think.columnar import COLUMNAR_JSON_CONTENT_TYPE, COLUMNAR_BINARY_CONTENT_TYPE, decode_columnar_binary
+from think.spatial import GRID_BUILD_THRESHOLD
+from think.permission import get_thought_rights
+from think.theme import create_theme, update_theme, delete_theme, theme_to_dict, get_registered_theme, ThemeRegistry
+from think.server import ServerState, initialise_server, has_server_been_initialised
+from think.data import TUTORIAL_NODES, TUTORIAL_CONNECTIONS, get_default_theme
+from think.render import get_render_pool, render_thought, SVG_FORMAT, Image as PIL_IMAGE
+from think.graph import get_cached_graph, numpy
+from think.layout import get_repulsion
+from think.feed import ChangeFeed
+from think.archive import get_exported_thoughts, iter_thought_archive
+from think.misc import iter_value_chunks, commit_on_success_with_hooks
+from think.importer import MapImportError, import_thought
+from think.journal import HistoryError, get_thought_at_revision
+import think.archive
+import think.thought
+from think.feedserver import FeedServer
+from think.search import FTS_INDEX, TERMS_INDEX, get_search_index_type, search_nodes
+from think.schema import INDEXES, HOT_QUERIES, get_index_names, create_missing_indexes, explain_query
+from think.user import get_thought_descriptions_for_user, SORT_BY_LAST_MODIFIED
+from utilities.lazy import lazy_view
 
 
 class SimpleTest(TestCase):
@@ -14,3 +56,1152 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+def create_json_thought(no_of_nodes):
+    """Creates a JSON Thought dictionary of a chain of nodes, like the ones the client sends."""
+    json_nodes = [{'x': i, 'y': i * 2, 'text': 'Node %d' % i} for i in range(no_of_nodes)]
+    json_connections = [[json_nodes[i], json_nodes[i + 1]] for i in range(no_of_nodes - 1)]
+    return {'name': 'Big Thought', 'nodes': json_nodes, 'connections': json_connections}
+
+
+class CreateAndSaveThoughtTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('author', 'author@example.com', 'password')
+
+    def test_nodes_and_connections_are_saved(self):
+        thought_id = createAndSaveThought(create_json_thought(300), self.user)
+        thought = Thought.objects.get(id=thought_id)
+        self.assertEqual(Node.objects.filter(thought=thought).count(), 300)
+        self.assertEqual(Connection.objects.filter(thought=thought).count(), 299)
+        for connection in Connection.objects.filter(thought=thought):
+            self.assertEqual(connection.node_two.x, connection.node_one.x + 1)
+        self.assertTrue(Permission.objects.filter(thought=thought, user=self.user, type=permit_modify).exists())
+
+    def test_inserts_are_batched(self):
+        # The thought, the permission and its update of the thought, two node batches, the node index, two connection batches, the search index and the snapshot.
+        with self.assertNumQueries(10):
+            createAndSaveThought(create_json_thought(150), self.user)
+
+
+class UpdateThoughtTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('author', 'author@example.com', 'password')
+        self.thought = Thought.objects.get(id=createAndSaveThought(create_json_thought(200), self.user))
+
+    def get_json_thought(self):
+        """Gets the thought in the form the client sends it back after loading it."""
+        nodes = dict((node.id, {'id': str(node.id), 'x': node.x, 'y': node.y, 'text': node.text}) for node in Node.objects.filter(thought=self.thought))
+        connections = [[nodes[c.node_one_id], nodes[c.node_two_id]] for c in Connection.objects.filter(thought=self.thought)]
+        return {'id': str(self.thought.id), 'name': self.thought.name, 'nodes': nodes.values(), 'connections': connections}
+
+    def test_moving_one_node_writes_one_node(self):
+        json_thought = self.get_json_thought()
+        moved = json_thought['nodes'][0]
+        moved['x'] = 1000
+        # The revision update, the node load, the connection load, the node update and the change record.
+        with self.assertNumQueries(5):
+            updateThought(self.thought, json_thought, self.user)
+        self.assertEqual(Node.objects.get(id=moved['id']).x, 1000)
+        self.assertEqual(Node.objects.filter(thought=self.thought).count(), 200)
+        self.assertEqual(Connection.objects.filter(thought=self.thought).count(), 199)
+
+    def test_nodes_and_connections_are_created_and_deleted(self):
+        json_thought = self.get_json_thought()
+        deleted = json_thought['nodes'].pop()
+        json_thought['connections'] = [c for c in json_thought['connections'] if deleted not in c]
+        new_node = {'x': -5, 'y': -5, 'text': 'New'}
+        json_thought['nodes'].append(new_node)
+        json_thought['connections'].append([json_thought['nodes'][0], new_node])
+        updateThought(self.thought, json_thought, self.user)
+        self.assertFalse(Node.objects.filter(id=deleted['id']).exists())
+        new_node = Node.objects.get(thought=self.thought, text='New')
+        self.assertEqual(Node.objects.filter(thought=self.thought).count(), 200)
+        self.assertTrue(Connection.objects.filter(node_one=json_thought['nodes'][0]['id'], node_two=new_node).exists())
+        self.assertEqual(Connection.objects.filter(thought=self.thought).count(), len(json_thought['connections']))
+
+
+class PatchThoughtTest(TransactionTestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('author', 'author@example.com', 'password')
+        self.thought = Thought.objects.get(id=createAndSaveThought(create_json_thought(3), self.user))
+        self.nodes = list(Node.objects.filter(thought=self.thought).order_by('id'))
+        self.client.login(username='author', password='password')
+
+    def patch(self, operations):
+        body = simplejson.dumps({'id': str(self.thought.id), 'operations': operations})
+        return self.client.post('/thought', body, content_type='application/json', REQUEST_METHOD='PATCH')
+
+    def test_operations_are_applied(self):
+        response = self.patch([
+            {'op': 'addNode', 'key': 'a', 'x': 7, 'y': 8, 'text': 'Added'},
+            {'op': 'addConnection', 'node_one': {'id': str(self.nodes[0].id)}, 'node_two': {'key': 'a'}},
+            {'op': 'moveNode', 'id': str(self.nodes[1].id), 'x': 50, 'y': 60},
+            {'op': 'setNodeText', 'id': str(self.nodes[1].id), 'text': 'Moved'},
+            {'op': 'removeNode', 'id': str(self.nodes[2].id)},
+            {'op': 'rename', 'name': 'Renamed'},
+        ])
+        body = simplejson.loads(response.content)
+        self.assertTrue(body['success'])
+        added = Node.objects.get(id=body['nodeIds']['a'])
+        self.assertEqual((added.x, added.y, added.text), (7, 8, 'Added'))
+        self.assertTrue(Connection.objects.filter(node_one=self.nodes[0], node_two=added).exists())
+        moved = Node.objects.get(id=self.nodes[1].id)
+        self.assertEqual((moved.x, moved.y, moved.text), (50, 60, 'Moved'))
+        self.assertFalse(Node.objects.filter(id=self.nodes[2].id).exists())
+        self.assertEqual(Thought.objects.get(id=self.thought.id).name, 'Renamed')
+
+    def test_invalid_operations_are_not_applied(self):
+        response = self.patch([
+            {'op': 'rename', 'name': 'Renamed'},
+            {'op': 'moveNode', 'id': '-1', 'x': 0, 'y': 0},
+        ])
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(Thought.objects.get(id=self.thought.id).name, 'Big Thought')
+
+
+class ThoughtToDictTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('author', 'author@example.com', 'password')
+
+    def test_query_count_does_not_depend_on_thought_size(self):
+        for no_of_nodes in [2, 20, 200]:
+            thought = Thought.objects.get(id=createAndSaveThought(create_json_thought(no_of_nodes), self.user))
+            # The nodes and the connections; the thought has no theme.
+            with self.assertNumQueries(2):
+                data = thought_to_dict(thought)
+            self.assertEqual(len(data['nodes']), no_of_nodes)
+            self.assertEqual(len(data['connections']), no_of_nodes - 1)
+
+    def test_connections_refer_to_node_ids(self):
+        thought = Thought.objects.get(id=createAndSaveThought(create_json_thought(5), self.user))
+        data = thought_to_dict(thought)
+        node_ids = set(node['id'] for node in data['nodes'])
+        for connection in data['connections']:
+            self.assertTrue(connection['nodeOne'] in node_ids and connection['nodeTwo'] in node_ids)
+
+
+class ThoughtCacheTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('author', 'author@example.com', 'password')
+        self.thought_id = createAndSaveThought(create_json_thought(3), self.user)
+        make_thought_public_using_id(self.thought_id)
+        get_thought_cache().clear()
+
+    def get_thought(self):
+        return simplejson.loads(self.client.get('/thought', {'id': self.thought_id}).content)
+
+    def test_thought_is_cached_until_it_is_modified(self):
+        statistics = get_cache_statistics()
+        body = self.get_thought()
+        self.assertTrue(body['success'])
+        self.assertTrue(body['thought']['is_public'])
+        self.assertFalse(body['thought']['modifiable'])
+        self.assertEqual(self.get_thought(), body)
+        self.assertEqual(get_cache_statistics()['misses'], statistics['misses'] + 1)
+        self.assertEqual(get_cache_statistics()['hits'], statistics['hits'] + 1)
+
+        thought = Thought.objects.get(id=self.thought_id)
+        json_thought = {'name': 'Renamed', 'nodes': body['thought']['nodes'], 'connections': []}
+        updateThought(thought, json_thought, self.user)
+        body = self.get_thought()
+        self.assertEqual(body['thought']['name'], 'Renamed')
+        self.assertEqual(body['thought']['connections'], [])
+        self.assertEqual(get_cache_statistics()['misses'], statistics['misses'] + 2)
+
+    def test_reused_id_is_not_served_from_cache(self):
+        body = self.get_thought()
+        # The deleted thought is cached at its old revision, which a new thought with the same id could reach.
+        Thought.objects.filter(id=self.thought_id).update(revision=0)
+        thought = Thought.objects.get(id=self.thought_id)
+        get_encoded_thought(thought)
+        # Delete the rows without delete_thought_using_id, so the entry is left in the cache.
+        Thought.all_objects.filter(id=self.thought_id).delete()
+        new_id = createAndSaveThought(create_json_thought(1), self.user)
+        self.assertEqual(new_id, self.thought_id)
+        self.assertEqual(len(simplejson.loads(get_encoded_thought(Thought.objects.get(id=new_id)))['nodes']), 1)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = LRUCache('test', {'OPTIONS': {'MAX_ENTRIES': 2}})
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual(cache.get('c'), 3)
+        self.assertEqual(cache.evictions, 1)
+
+
+class ConditionalGetTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('author', 'author@example.com', 'password')
+        self.thought_id = createAndSaveThought(create_json_thought(3), self.user)
+        make_thought_public_using_id(self.thought_id)
+
+    def test_unchanged_thought_is_not_modified(self):
+        response = self.client.get('/thought', {'id': self.thought_id})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Cache-Control'].startswith('public'))
+        etag = response['ETag']
+        # Only the thought is loaded; its permissions are cached and the nodes and connections are not loaded.
+        with self.assertNumQueries(1):
+            response = self.client.get('/thought', {'id': self.thought_id}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response['ETag'], etag)
+
+    def test_modified_thought_has_a_new_etag(self):
+        etag = self.client.get('/thought', {'id': self.thought_id})['ETag']
+        thought = Thought.objects.get(id=self.thought_id)
+        updateThought(thought, {'name': 'Renamed', 'nodes': [], 'connections': []}, self.user)
+        response = self.client.get('/thought', {'id': self.thought_id}, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class RevisionConflictTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('author', 'author@example.com', 'password')
+        self.thought_id = createAndSaveThought(create_json_thought(3), self.user)
+        self.node_id = str(Node.objects.filter(thought=self.thought_id)[0].id)
+        self.client.login(username='author', password='password')
+
+    def patch(self, operations, **extra):
+        body = simplejson.dumps({'id': self.thought_id, 'operations': operations})
+        return self.client.post('/thought', body, content_type='application/json', REQUEST_METHOD='PATCH', **extra)
+
+    def test_save_to_an_old_revision_returns_the_delta(self):
+        response = self.patch([{'op': 'moveNode', 'id': self.node_id, 'x': 1, 'y': 2}], HTTP_IF_MATCH='"%s-0-modify"' % self.thought_id)
+        self.assertEqual(simplejson.loads(response.content)['revision'], 1)
+        response = self.patch([{'op': 'rename', 'name': 'Other tab'}], HTTP_IF_MATCH='"%s-0-modify"' % self.thought_id)
+        self.assertEqual(response.status_code, 409)
+        body = simplejson.loads(response.content)
+        self.assertEqual(body['revision'], 1)
+        self.assertEqual(body['operations'], [{'op': 'moveNode', 'id': self.node_id, 'x': 1, 'y': 2}])
+        self.assertEqual(Thought.objects.get(id=self.thought_id).name, 'Big Thought')
+
+    def test_malformed_if_match_is_rejected(self):
+        operations = [{'op': 'rename', 'name': 'Renamed'}]
+        other_id = createAndSaveThought(create_json_thought(1), self.user)
+        for if_match in ['"abc"', 'garbage', '"%s-x-modify"' % self.thought_id, '"%s-0-modify"' % other_id, '"%s-0-modify", "%s-0-view"' % (self.thought_id, self.thought_id)]:
+            self.assertEqual(self.patch(operations, HTTP_IF_MATCH=if_match).status_code, 400)
+        self.assertEqual(Thought.objects.get(id=self.thought_id).name, 'Big Thought')
+        response = self.patch(operations, HTTP_IF_MATCH='"%s-0-modify-columnar"' % self.thought_id)
+        self.assertEqual(simplejson.loads(response.content)['revision'], 1)
+
+    def test_put_with_expected_revision(self):
+        json_thought = {'id': self.thought_id, 'name': 'Renamed', 'nodes': [], 'connections': []}
+        body = simplejson.dumps({'thought': json_thought, 'expected_revision': 0})
+        response = self.client.put('/thought', body, content_type='application/json')
+        self.assertEqual(simplejson.loads(response.content)['revision'], 1)
+        response = self.client.put('/thought', body, content_type='application/json')
+        self.assertEqual(response.status_code, 409)
+        operations = simplejson.loads(response.content)['operations']
+        self.assertEqual(operations[0], {'op': 'rename', 'name': 'Renamed'})
+        self.assertEqual(len([o for o in operations if o['op'] == 'removeNode']), 3)
+
+
+class StreamedThoughtTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('author', 'author@example.com', 'password')
+        self.thought_id = createAndSaveThought(create_json_thought(1200), self.user)
+        make_thought_public_using_id(self.thought_id)
+        # The ids of thoughts are reused between tests, so cached thoughts of earlier tests must be cleared.
+        get_thought_cache().clear()
+
+    def test_streamed_thought_matches_encoded_thought(self):
+        streamed = simplejson.loads(self.client.get('/thought', {'id': self.thought_id, 'stream': '1'}).content)
+        encoded = simplejson.loads(self.client.get('/thought', {'id': self.thought_id}).content)
+        self.assertEqual(len(streamed['thought']['nodes']), 1200)
+        self.assertEqual(streamed, encoded)
+
+    def test_torn_thought_is_not_completed(self):
+        thought = Thought.objects.get(id=self.thought_id)
+        pieces = iter_encoded_thought(thought)
+        pieces.next()
+        pieces.next()
+        patchThought(Thought.objects.get(id=self.thought_id), [{'op': 'rename', 'name': 'Saved meanwhile'}], self.user)
+        self.assertRaises(RevisionConflictError, list, pieces)
+
+    def test_rows_are_read_in_chunks(self):
+        with self.assertNumQueries(3):
+            chunks = list(iter_value_chunks(Node.objects.filter(thought=self.thought_id), ['text'], 500))
+        self.assertEqual([len(chunk) for chunk in chunks], [500, 500, 200])
+        self.assertEqual(chunks[0][0], ('Node 0',))
+        self.assertEqual(chunks[2][-1], ('Node 1199',))
+
+
+class ColumnarThoughtTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('author', 'author@example.com', 'password')
+        self.thought_id = createAndSaveThought(create_json_thought(50), self.user)
+        make_thought_public_using_id(self.thought_id)
+
+    def get_thought(self, accept):
+        return self.client.get('/thought', {'id': self.thought_id}, HTTP_ACCEPT=accept)
+
+    def test_columnar_encodings_match(self):
+        response = self.get_thought(COLUMNAR_JSON_CONTENT_TYPE)
+        self.assertEqual(response['Content-Type'], COLUMNAR_JSON_CONTENT_TYPE)
+        columnar = simplejson.loads(response.content)['thought']
+        binary = decode_columnar_binary(self.get_thought(COLUMNAR_BINARY_CONTENT_TYPE).content)
+        self.assertEqual(columnar, binary)
+        self.assertEqual(len(columnar['nodes']['ids']), 50)
+        self.assertEqual(columnar['nodes']['text'][3], 'Node 3')
+        self.assertEqual(len(columnar['connections']), 2 * 49)
+        x = columnar['nodes']['x']
+        for i in range(0, len(columnar['connections']), 2):
+            self.assertEqual(x[columnar['connections'][i + 1]], x[columnar['connections'][i]] + 1)
+
+    def test_each_encoding_has_its_own_etag(self):
+        etags = set(self.get_thought(accept)['ETag'] for accept in ['application/json', COLUMNAR_JSON_CONTENT_TYPE, COLUMNAR_BINARY_CONTENT_TYPE])
+        self.assertEqual(len(etags), 3)
+
+
+class ThoughtBoxTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('author', 'author@example.com', 'password')
+        self.thought_id = createAndSaveThought(create_json_thought(100), self.user)
+        make_thought_public_using_id(self.thought_id)
+
+    def get_thought(self, bbox):
+        return simplejson.loads(self.client.get('/thought', {'id': self.thought_id, 'bbox': bbox}).content)['thought']
+
+    def test_only_nodes_in_the_box_are_returned(self):
+        # Once from the database, then from the grid once it has been built.
+        for i in range(GRID_BUILD_THRESHOLD + 2):
+            thought = self.get_thought('10,0,19,1000')
+            self.assertEqual(sorted(node['x'] for node in thought['nodes']), range(10, 20))
+            # The chain of nodes inside the box, plus the connections leaving each end of it.
+            self.assertEqual(len(thought['connections']), 11)
+
+    def test_invalid_box(self):
+        for bbox in ['1,2,3', 'inf,0,1,1', '0,nan,1,1']:
+            response = self.client.get('/thought', {'id': self.thought_id, 'bbox': bbox})
+            self.assertEqual(response.status_code, 400)
+        # Bounds beyond the range of the columns are clamped.
+        self.assertEqual(len(self.get_thought('-1e300,-1e300,1e300,1e300')['nodes']), 100)
+
+    def test_grid_of_deleted_thought_is_not_reused(self):
+        for i in range(GRID_BUILD_THRESHOLD + 1):
+            self.get_thought('0,0,1000,1000')
+        delete_thought_using_id(self.thought_id)
+        new_id = createAndSaveThought(create_json_thought(1), self.user)
+        make_thought_public_using_id(new_id)
+        self.assertEqual(new_id, self.thought_id)
+        self.assertEqual(len(self.get_thought('0,0,1000,1000')['nodes']), 1)
+
+
+class ThoughtRightsTest(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user('author', 'author@example.com', 'password')
+        self.viewer = User.objects.create_user('viewer', 'viewer@example.com', 'password')
+        self.thought = Thought.objects.get(id=createAndSaveThought(create_json_thought(3), self.author))
+        Permission(thought=self.thought, user=self.viewer, type=permit_view).save()
+
+    def test_rights_are_resolved_with_one_query(self):
+        with self.assertNumQueries(1):
+            author = get_thought_rights(self.author, self.thought)
+            viewer = get_thought_rights(self.viewer, self.thought)
+            anonymous = get_thought_rights(None, self.thought)
+        self.assertEqual((author.view, author.modify, author.public), (True, True, False))
+        self.assertEqual((viewer.view, viewer.modify, viewer.public), (True, False, False))
+        self.assertEqual((anonymous.view, anonymous.modify, anonymous.public), (False, False, False))
+
+    def test_cached_rights_follow_the_revision(self):
+        get_thought_rights(None, self.thought)
+        make_thought_public_using_id(self.thought.id)
+        thought = Thought.objects.get(id=self.thought.id)
+        self.assertTrue(get_thought_rights(None, thought).public)
+        self.assertEqual(get_thought_rights(self.viewer, thought).get_permission_type(), permit_all_view)
+        # As another process would, make the thought private without touching this process's cache.
+        Permission.objects.filter(thought=thought, type=permit_all_view).update(type=permit_none)
+        Thought.objects.filter(id=thought.id).update(revision=thought.revision + 1)
+        self.assertFalse(get_thought_rights(None, Thought.objects.get(id=thought.id)).public)
+
+    def test_permission_writes_outside_saves_are_noticed(self):
+        thought = Thought.objects.get(id=self.thought.id)
+        self.assertTrue(get_thought_rights(self.viewer, thought).view)
+        # As in the admin, the permissions change without the revision.
+        Permission.objects.get(thought=thought, user=self.viewer).delete()
+        thought = Thought.objects.get(id=self.thought.id)
+        self.assertEqual(thought.revision, 0)
+        self.assertFalse(get_thought_rights(self.viewer, thought).view)
+        Permission(thought=thought, type=permit_all_view).save()
+        self.assertTrue(get_thought_rights(None, Thought.objects.get(id=self.thought.id)).public)
+
+    def test_rights_of_an_id_are_not_cached(self):
+        self.assertTrue(get_thought_rights(self.viewer, self.thought.id).view)
+        Permission.objects.filter(thought=self.thought, user=self.viewer).delete()
+        self.assertFalse(get_thought_rights(self.viewer, self.thought.id).view)
+
+
+class ThoughtDescriptionsTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('author', 'author@example.com', 'password')
+        for name in ['C', 'A', 'B', 'A']:
+            json_thought = create_json_thought(1)
+            json_thought['name'] = name
+            createAndSaveThought(json_thought, self.user)
+
+    def get_all_pages(self, sort, limit):
+        names, cursor = [], None
+        while True:
+            descriptions, cursor = get_thought_descriptions_for_user(self.user, sort=sort, cursor=cursor, limit=limit)
+            names.extend(description['name'] for description in descriptions)
+            if cursor == None:
+                return names
+
+    def test_pages_are_read_with_one_query(self):
+        with self.assertNumQueries(1):
+            descriptions, cursor = get_thought_descriptions_for_user(self.user, limit=2)
+        self.assertEqual([description['name'] for description in descriptions], ['A', 'A'])
+        with self.assertNumQueries(1):
+            descriptions, cursor = get_thought_descriptions_for_user(self.user, cursor=cursor, limit=2)
+        self.assertEqual([description['name'] for description in descriptions], ['B', 'C'])
+        self.assertEqual(cursor, None)
+
+    def test_pages_cover_every_thought_once(self):
+        self.assertEqual(self.get_all_pages('name', 1), ['A', 'A', 'B', 'C'])
+        self.assertEqual(self.get_all_pages(SORT_BY_LAST_MODIFIED, 3), ['A', 'B', 'A', 'C'])
+
+    def test_view_pages_the_collection(self):
+        self.client.login(username='author', password='password')
+        body = simplejson.loads(self.client.get('/thought', {'collection': 'all', 'limit': 3}).content)
+        self.assertEqual(len(body['thoughtDescriptions']), 3)
+        body = simplejson.loads(self.client.get('/thought', {'collection': 'all', 'cursor': body['nextCursor']}).content)
+        self.assertEqual([description['name'] for description in body['thoughtDescriptions']], ['C'])
+        self.assertEqual(body['nextCursor'], None)
+        for cursor in ['nonsense', base64.urlsafe_b64encode('5'), base64.urlsafe_b64encode('{"a": 1}')]:
+            self.assertEqual(self.client.get('/thought', {'collection': 'all', 'cursor': cursor}).status_code, 400)
+
+
+class SchemaTest(TestCase):
+    def test_indexes_are_created_by_syncdb(self):
+        cursor = connection.cursor()
+        for name, model, field_names in INDEXES:
+            self.assertTrue(name in get_index_names(cursor, model._meta.db_table))
+        self.assertEqual(create_missing_indexes(), [])
+
+    def test_unknown_databases_are_skipped(self):
+        vendor = connection.vendor
+        connection.vendor = 'oracle'
+        try:
+            self.assertEqual(get_index_names(connection.cursor(), Node._meta.db_table), None)
+            self.assertEqual(create_missing_indexes(), [])
+        finally:
+            connection.vendor = vendor
+
+    def test_hot_queries_use_indexes(self):
+        if connection.vendor != 'sqlite':
+            return
+        for description, get_queryset in HOT_QUERIES:
+            plan = ' '.join(unicode(row[-1]) for row in explain_query(get_queryset()))
+            self.assertTrue('USING' in plan and 'SCAN' not in plan, '%s: %s' % (description, plan))
+
+
+class DeleteThoughtTest(TestCase):
+    def setUp(self):
+        get_thought_cache().clear()
+        self.user = User.objects.create_user('author', 'author@example.com', 'password')
+        self.thought_id = createAndSaveThought(create_json_thought(300), self.user)
+
+    def assert_rows_deleted(self):
+        self.assertFalse(Thought.all_objects.filter(id=self.thought_id).exists())
+        self.assertFalse(Node.objects.filter(thought=self.thought_id).exists())
+        self.assertFalse(Connection.objects.filter(thought=self.thought_id).exists())
+        self.assertFalse(Permission.objects.filter(thought=self.thought_id).exists())
+        self.assertFalse(ThoughtSnapshot.objects.filter(thought=self.thought_id).exists())
+
+    def test_delete_is_set_based(self):
+        # The thought load, the permissions, the search index, the snapshots, the changes, the connections, the nodes and the thought.
+        with self.assertNumQueries(8):
+            delete_thought_using_id(self.thought_id)
+        self.assert_rows_deleted()
+
+    def test_asynchronous_delete_tombstones_the_thought(self):
+        delete_thought_using_id(self.thought_id, asynchronous=True)
+        self.assertEqual(get_thought_using_id(self.thought_id), None)
+        self.assertFalse(get_thought_rights(self.user, self.thought_id).view)
+        self.assertEqual(Node.objects.filter(thought=self.thought_id).count(), 300)
+        chunks = 0
+        while reclaim_deleted_thoughts(chunk_size=100):
+            chunks += 1
+        # The snapshot, three chunks of connections, three of nodes and the thought.
+        self.assertEqual(chunks, 8)
+        self.assert_rows_deleted()
+
+    def test_view_deletes_the_thought(self):
+        self.client.login(username='author', password='password')
+        response = self.client.delete('/thought?id=%s&async=1' % self.thought_id)
+        self.assertTrue(simplejson.loads(response.content)['success'])
+        self.assertTrue(Thought.all_objects.get(id=self.thought_id).deleted)
+
+
+class ThemeRegistryTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('author', 'author@example.com', 'password')
+        self.theme_dict = {'name': 'Dark', 'background_top_color': '#000', 'background_bottom_color': '#000',
+            'node_outer_color': '#111', 'node_inner_color': '#222', 'node_text_color': '#fff',
+            'connection_outer_color': '#333', 'connection_inner_color': '#444', 'connection_text_color': '#fff'}
+        create_theme(self.theme_dict, self.user)
+        json_thought = create_json_thought(2)
+        json_thought['theme'] = self.theme_dict
+        self.thought = Thought.objects.get(id=createAndSaveThought(json_thought, self.user))
+
+    def test_themes_are_read_without_queries(self):
+        get_registered_theme(self.theme_dict['id'])
+        with self.assertNumQueries(2):
+            data = thought_to_dict(self.thought)
+        self.assertEqual(data['theme']['name'], 'Dark')
+
+    def test_registry_is_invalidated_by_updates(self):
+        self.assertEqual(get_registered_theme(self.theme_dict['id']).name, 'Dark')
+        self.theme_dict['name'] = 'Light'
+        update_theme(self.theme_dict)
+        self.assertEqual(get_registered_theme(self.theme_dict['id']).name, 'Light')
+
+    def test_registry_is_cleared_after_the_transaction(self):
+        @commit_on_success_with_hooks
+        def rename():
+            self.theme_dict['name'] = 'Light'
+            update_theme(self.theme_dict)
+            # Another thread reloads the registry before the commit, and reads the old theme.
+            ThemeRegistry.themes = {int(self.theme_dict['id']): Theme(name='Dark')}
+        rename()
+        self.assertEqual(get_registered_theme(self.theme_dict['id']).name, 'Light')
+
+    def test_saving_a_themed_thought_bumps_its_revision_once(self):
+        json_thought = create_json_thought(2)
+        json_thought['theme'] = dict(self.theme_dict)
+        for name in ('Dark', 'Light'):
+            json_thought['theme']['name'] = name
+            updateThought(self.thought, json_thought, self.user, self.thought.revision)
+            self.assertEqual(Thought.objects.get(id=self.thought.id).revision, self.thought.revision)
+        changes = [simplejson.loads(operations) for operations in ThoughtChange.objects.filter(thought=self.thought).order_by('revision').values_list('operations', flat=True)]
+        self.assertEqual(len(changes), 2)
+        self.assertFalse([op for op in changes[0] if op['op'] == 'setTheme'])
+        self.assertEqual([op['theme']['name'] for op in changes[1] if op['op'] == 'setTheme'], ['Light'])
+
+    def test_theme_updates_are_journalled(self):
+        self.theme_dict['name'] = 'Light'
+        self.assertTrue(update_theme(self.theme_dict))
+        self.assertFalse(update_theme(self.theme_dict))
+        thought = Thought.objects.get(id=self.thought.id)
+        self.assertEqual(thought.revision, 1)
+        self.assertEqual(get_thought_at_revision(thought, 1).theme['name'], 'Light')
+        delete_theme(Theme.objects.get(id=self.theme_dict['id']))
+        thought = Thought.objects.get(id=self.thought.id)
+        self.assertEqual((thought.revision, thought.theme_id), (2, None))
+        self.assertEqual(get_thought_at_revision(thought, 2).theme, None)
+
+    def test_themes_of_other_processes_are_found(self):
+        get_registered_theme(self.theme_dict['id'])
+        theme = Theme.objects.create(name='Created elsewhere')
+        self.assertEqual(get_registered_theme(theme.id).name, 'Created elsewhere')
+
+
+class InitialiseServerTest(TestCase):
+    def setUp(self):
+        ServerState.initialised = False
+        User.objects.create_user('admin', 'admin@example.com', 'password')
+
+    def tearDown(self):
+        ServerState.initialised = False
+
+    def test_seeding_is_bulk_and_idempotent(self):
+        # The four existence checks, the thought, the admin user, its permissions, nodes, node ids, connections, search index and snapshot, the theme, its permission, the metadata and the flag.
+        with self.assertNumQueries(16):
+            initialise_server()
+        thought = Thought.objects.get(name='Tutorial')
+        self.assertEqual(Node.objects.filter(thought=thought).count(), len(TUTORIAL_NODES))
+        self.assertEqual(Connection.objects.filter(thought=thought).count(), len(TUTORIAL_CONNECTIONS))
+        state = get_thought_at_revision(thought, 0)
+        self.assertEqual((len(state.nodes), len(state.connections), state.public), (len(TUTORIAL_NODES), len(TUTORIAL_CONNECTIONS), True))
+        # The Tutorial is public, so anyone can find its nodes.
+        results = search_nodes(None, 'familar register')
+        self.assertEqual([result['thoughtId'] for result in results], [str(thought.id)])
+        self.assertEqual(get_default_theme().name, 'Think - Original')
+        with self.assertNumQueries(0):
+            initialise_server()
+            self.assertTrue(has_server_been_initialised())
+        ServerState.initialised = False
+        initialise_server()
+        self.assertEqual(Thought.objects.filter(name='Tutorial').count(), 1)
+        self.assertEqual(Theme.objects.count(), 1)
+
+    def test_check_only(self):
+        output = StringIO()
+        self.assertRaises(SystemExit, call_command, 'initialiseserver', check_only=True, stdout=output, stderr=output)
+        call_command('initialiseserver', stdout=output)
+        call_command('initialiseserver', check_only=True, stdout=output)
+        self.assertTrue(output.getvalue().endswith('The database has been initialised.\n'))
+
+
+@override_settings(EXPORT_PROCESSES=0)
+class ExportThoughtTest(TestCase):
+    def setUp(self):
+        get_thought_cache().clear()
+        self.user = User.objects.create_user('author', 'author@example.com', 'password')
+        self.thought_id = createAndSaveThought(create_json_thought(20), self.user)
+        self.client.login(username='author', password='password')
+
+    def export(self, format):
+        return self.client.get('/thought/export', {'id': self.thought_id, 'format': format})
+
+    def test_svg_is_rendered_and_cached(self):
+        response = self.export('svg')
+        self.assertEqual(response['Content-Type'], 'image/svg+xml')
+        self.assertEqual(response.content.count('<circle '), 20)
+        self.assertEqual(response.content.count('<path '), 19)
+        # The session, the user and the thought; the cached image is sent without loading the nodes and connections.
+        with self.assertNumQueries(3):
+            self.assertEqual(self.export('svg').content, response.content)
+
+    def test_png_needs_the_imaging_library(self):
+        response = self.export('png')
+        if PIL_IMAGE == None:
+            self.assertEqual(response.status_code, 501)
+        else:
+            self.assertTrue(response.content.startswith('\x89PNG'))
+
+    def test_invalid_format(self):
+        self.assertEqual(self.export('gif').status_code, 400)
+
+    @override_settings(EXPORT_PROCESSES=1)
+    def test_render_process_pool(self):
+        data = render_thought(Thought.objects.get(id=self.thought_id), SVG_FORMAT)
+        self.assertEqual(data.count('<circle '), 20)
+
+    @override_settings(EXPORT_PROCESSES=1, EXPORT_TIMEOUT=0)
+    def test_slow_render_is_retried(self):
+        # Keep the only render process busy, so the export cannot finish in time.
+        get_render_pool().apply_async(time.sleep, (0.5,))
+        response = self.export('svg')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '0')
+        # The render carries on in the pool; waiting for it again does not start another, and its image is cached.
+        with self.settings(EXPORT_TIMEOUT=30):
+            data = render_thought(Thought.objects.get(id=self.thought_id), SVG_FORMAT)
+        self.assertEqual(self.export('svg').content, data)
+
+
+class ThoughtGraphTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('author', 'author@example.com', 'password')
+        # A chain of 6 nodes, a separate pair of nodes, and a hub connected to the first 3 nodes of the chain.
+        json_thought = create_json_thought(6)
+        pair = [{'x': 100, 'y': 0, 'text': 'A'}, {'x': 101, 'y': 0, 'text': 'B'}]
+        hub = {'x': 200, 'y': 0, 'text': 'Hub'}
+        json_thought['nodes'].extend(pair + [hub])
+        json_thought['connections'].append(pair)
+        json_thought['connections'].extend([[hub, node] for node in json_thought['nodes'][:3]])
+        self.thought = Thought.objects.get(id=createAndSaveThought(json_thought, self.user))
+        self.ids = dict((node.text, str(node.id)) for node in Node.objects.filter(thought=self.thought))
+        self.client.login(username='author', password='password')
+
+    def get_metric(self, metric, **params):
+        params.update({'id': self.thought.id, 'metric': metric})
+        return simplejson.loads(self.client.get('/thought/graph', params).content)
+
+    @skipUnless(numpy, 'NumPy is not installed.')
+    def test_graph_is_cached_per_revision(self):
+        graph = get_cached_graph(self.thought)
+        with self.assertNumQueries(0):
+            self.assertTrue(get_cached_graph(self.thought) is graph)
+        self.assertEqual(len(graph), 9)
+        self.assertEqual(graph.get_degrees().sum(), 2 * 9)
+
+    @skipIf(numpy, 'NumPy is installed.')
+    def test_metrics_need_numpy(self):
+        self.assertEqual(self.client.get('/thought/graph', {'id': self.thought.id, 'metric': 'hubs'}).status_code, 501)
+
+    @skipUnless(numpy, 'NumPy is not installed.')
+    def test_metrics(self):
+        components = self.get_metric('components')['components']
+        self.assertEqual([len(component) for component in components], [7, 2])
+        self.assertEqual(sorted(components[1]), sorted([self.ids['A'], self.ids['B']]))
+        path = self.get_metric('path', **{'from': self.ids['Hub'], 'to': self.ids['Node 5']})['path']
+        self.assertEqual(path, [self.ids[text] for text in ['Hub', 'Node 2', 'Node 3', 'Node 4', 'Node 5']])
+        self.assertEqual(self.get_metric('path', **{'from': self.ids['A'], 'to': self.ids['Hub']})['path'], None)
+        hubs = self.get_metric('hubs', limit=4)['hubs']
+        self.assertEqual(set(hub['id'] for hub in hubs[:3]), set([self.ids['Hub'], self.ids['Node 1'], self.ids['Node 2']]))
+        self.assertEqual([hub['degree'] for hub in hubs], [3, 3, 3, 2])
+        body = self.get_metric('degree')
+        self.assertEqual(dict(zip(body['nodeIds'], body['degrees']))[self.ids['Node 5']], 1)
+
+
+class ThoughtLayoutTest(TestCase):
+    def setUp(self):
+        get_thought_cache().clear()
+        self.user = User.objects.create_user('author', 'author@example.com', 'password')
+        # A chain of 10 nodes piled up on one point.
+        json_thought = create_json_thought(10)
+        for node in json_thought['nodes']:
+            node['x'], node['y'] = 300, 200
+        self.thought = Thought.objects.get(id=createAndSaveThought(json_thought, self.user))
+        self.client.login(username='author', password='password')
+
+    @skipUnless(numpy, 'NumPy is not installed.')
+    def test_repulsion(self):
+        # Nodes in one cell repel each other individually.
+        positions = numpy.random.RandomState(1).uniform(0, 100, (50, 2))
+        delta = positions[:, None, :] - positions[None, :, :]
+        distance_squared = numpy.maximum((delta ** 2).sum(axis=2), 0.01)
+        expected = (delta * (150 ** 2 / distance_squared)[:, :, None]).sum(axis=1)
+        self.assertTrue(numpy.allclose(get_repulsion(positions, 150), expected))
+        # Nodes more than two cells apart do not repel each other.
+        self.assertTrue((get_repulsion(numpy.array([[0.0, 0.0], [1000.0, 0.0]]), 150) == 0).all())
+
+    @skipIf(numpy, 'NumPy is installed.')
+    def test_layout_needs_numpy(self):
+        self.assertEqual(self.client.post('/thought/layout?id=%s' % self.thought.id).status_code, 501)
+
+    @skipUnless(numpy, 'NumPy is not installed.')
+    def test_layout_spreads_nodes(self):
+        body = simplejson.loads(self.client.post('/thought/layout?id=%s' % self.thought.id).content)
+        self.assertTrue(body['success'])
+        self.assertEqual(body['revision'], self.thought.revision + 1)
+        self.assertEqual(len(body['operations']), 10)
+        nodes = list(Node.objects.filter(thought=self.thought).order_by('id'))
+        self.assertEqual(len(set((node.x, node.y) for node in nodes)), 10)
+        # The layout stays centred on where the nodes were.
+        self.assertAlmostEqual(sum(node.x for node in nodes) / 10.0, 300, delta=1)
+        self.assertEqual(ThoughtChange.objects.get(thought=self.thought, revision=body['revision']).operations, simplejson.dumps(body['operations']))
+
+    def test_layout_requires_permission(self):
+        self.client.logout()
+        body = simplejson.loads(self.client.post('/thought/layout?id=%s' % self.thought.id).content)
+        self.assertFalse(body['success'])
+        self.assertEqual(self.client.post('/thought/layout?id=%s&iterations=0' % self.thought.id).status_code, 400)
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        self.author = User.objects.create_user('author', 'author@example.com', 'password')
+        self.other = User.objects.create_user('other', 'other@example.com', 'password')
+
+    def create_thought(self, user, texts):
+        json_thought = {'name': 'Thought', 'nodes': [{'x': i, 'y': 0, 'text': text} for i, text in enumerate(texts)], 'connections': []}
+        thought = Thought.objects.get(id=createAndSaveThought(json_thought, user))
+        return thought, dict((node.text, node.id) for node in Node.objects.filter(thought=thought))
+
+    def check_search(self):
+        thought, ids = self.create_thought(self.author, ['Apple pie recipe', 'Banana bread', 'apple apple crumble'])
+        self.create_thought(self.other, ['apple secret'])
+        public_thought, public_ids = self.create_thought(self.other, ['apple public'])
+        make_thought_public_using_id(public_thought.id)
+
+        results = search_nodes(self.author, 'Apple')
+        self.assertEqual(results[0]['nodeId'], str(ids['apple apple crumble']))
+        self.assertEqual(set(result['nodeId'] for result in results),
+            set([str(ids['Apple pie recipe']), str(ids['apple apple crumble']), str(public_ids['apple public'])]))
+        self.assertEqual([result['nodeId'] for result in search_nodes(None, 'apple')], [str(public_ids['apple public'])])
+        results = search_nodes(self.author, 'pie apple')
+        self.assertEqual(results, [{'thoughtId': str(thought.id), 'nodeId': str(ids['Apple pie recipe']), 'snippet': 'Apple pie recipe'}])
+
+        # The index follows edits and deletes.
+        patchThought(thought, [{'op': 'setNodeText', 'id': str(ids['Banana bread']), 'text': 'Cherry tart'},
+            {'op': 'removeNode', 'id': str(ids['Apple pie recipe'])}], self.author)
+        self.assertEqual([result['nodeId'] for result in search_nodes(self.author, 'cherry')], [str(ids['Banana bread'])])
+        self.assertEqual(search_nodes(self.author, 'banana'), [])
+        self.assertEqual(search_nodes(self.author, 'pie'), [])
+        delete_thought_using_id(thought.id)
+        self.assertEqual(search_nodes(self.author, 'cherry'), [])
+
+    def test_fts_index(self):
+        if get_search_index_type() != FTS_INDEX:
+            return
+        self.check_search()
+
+    @override_settings(SEARCH_INDEX=TERMS_INDEX)
+    def test_terms_index(self):
+        self.check_search()
+
+    def test_search_view(self):
+        self.create_thought(self.author, ['Find me'])
+        self.client.login(username='author', password='password')
+        body = simplejson.loads(self.client.get('/search', {'q': 'find'}).content)
+        self.assertEqual([result['snippet'] for result in body['results']], ['Find me'])
+        self.assertEqual(self.client.get('/search').status_code, 400)
+        self.assertEqual(self.client.get('/search', {'q': 'find', 'limit': '0'}).status_code, 400)
+
+
+class RecordingSubscriber:
+    def __init__(self):
+        self.records = []
+        self.reloaded = False
+
+    def send_changes(self, records):
+        self.records.extend(simplejson.loads(encoded) for revision, encoded in records)
+        return True
+
+    def send_reload(self):
+        self.reloaded = True
+
+
+class ChangeFeedTest(TestCase):
+    def setUp(self):
+        get_thought_cache().clear()
+        self.user = User.objects.create_user('author', 'author@example.com', 'password')
+        self.thought = Thought.objects.get(id=createAndSaveThought(create_json_thought(2), self.user))
+        self.node_id = str(Node.objects.filter(thought=self.thought)[0].id)
+
+    def rename(self, name):
+        patchThought(self.thought, [{'op': 'rename', 'name': name}], self.user)
+
+    def test_publish(self):
+        feed = ChangeFeed()
+        subscriber = RecordingSubscriber()
+        feed.subscribe(subscriber, self.thought.id, self.thought.revision, self.user.id)
+        self.rename('One')
+        self.rename('Two')
+        with self.assertNumQueries(3):
+            feed.publish()
+        self.assertEqual([record['operations'][0]['name'] for record in subscriber.records], ['One', 'Two'])
+        self.assertEqual(subscriber.records[-1]['revision'], self.thought.revision)
+        with self.assertNumQueries(2):
+            feed.publish()
+        self.assertEqual(len(subscriber.records), 2)
+        # A deleted thought has to be reloaded.
+        delete_thought_using_id(self.thought.id, asynchronous=True)
+        feed.publish()
+        self.assertTrue(subscriber.reloaded)
+        self.assertEqual(len(feed), 0)
+
+    def test_themed_saves_are_sent_as_changes(self):
+        json_thought = create_json_thought(2)
+        json_thought['theme'] = {'name': 'Dark', 'background_top_color': '#000', 'background_bottom_color': '#000',
+            'node_outer_color': '#111', 'node_inner_color': '#222', 'node_text_color': '#fff',
+            'connection_outer_color': '#333', 'connection_inner_color': '#444', 'connection_text_color': '#fff'}
+        thought = Thought.objects.get(id=createAndSaveThought(json_thought, self.user))
+        feed = ChangeFeed()
+        subscriber = RecordingSubscriber()
+        feed.subscribe(subscriber, thought.id, thought.revision, self.user.id)
+        json_thought['theme']['name'] = 'Light'
+        updateThought(thought, json_thought, self.user, thought.revision)
+        json_thought['theme']['name'] = 'Dim'
+        update_theme(json_thought['theme'], self.user)
+        feed.publish()
+        self.assertFalse(subscriber.reloaded)
+        self.assertEqual([record['revision'] for record in subscriber.records], [1, 2])
+        self.assertEqual([op['theme']['name'] for op in subscriber.records[1]['operations']], ['Dim'])
+
+    def test_revoked_subscribers_are_dropped(self):
+        feed = ChangeFeed()
+        subscriber = RecordingSubscriber()
+        feed.subscribe(subscriber, self.thought.id, self.thought.revision, self.user.id)
+        anonymous = RecordingSubscriber()
+        feed.subscribe(anonymous, self.thought.id, self.thought.revision)
+        feed.publish()
+        self.assertTrue(anonymous.reloaded)
+        self.assertFalse(subscriber.reloaded)
+        # The revision does not change, as when another process writes the permissions.
+        Permission.objects.filter(thought=self.thought, user=self.user).delete()
+        feed.publish()
+        self.assertTrue(subscriber.reloaded)
+        self.assertEqual(len(feed), 0)
+
+    def test_failed_publish_does_not_stop_the_server(self):
+        server = FeedServer('127.0.0.1', 0)
+        try:
+            def fail():
+                raise DatabaseError('database is locked')
+            server.feed.publish = fail
+            logger = logging.getLogger()
+            logger.disabled = True
+            try:
+                server.tick(0)
+            finally:
+                logger.disabled = False
+            self.assertTrue(Thought.objects.exists()) # The connection is opened again.
+        finally:
+            server.close()
+
+    def test_changes_view(self):
+        self.client.login(username='author', password='password')
+        since = self.thought.revision
+        self.rename('One')
+        body = simplejson.loads(self.client.get('/thought/changes', {'id': self.thought.id, 'since': since}).content)
+        self.assertEqual(body['changes'], [{'revision': since + 1, 'operations': [{'op': 'rename', 'name': 'One'}]}])
+        body = simplejson.loads(self.client.get('/thought/changes', {'id': self.thought.id, 'since': since + 5}).content)
+        self.assertEqual(body, {'reload': True})
+
+    def test_long_poll(self):
+        self.client.login(username='author', password='password')
+        server = FeedServer('127.0.0.1', 0)
+        client = socket.create_connection(server.socket.getsockname())
+        client.settimeout(5)
+        try:
+            client.sendall('GET /thought/feed?id=%s&since=%s HTTP/1.1\r\nCookie: sessionid=%s\r\n\r\n'
+                % (self.thought.id, self.thought.revision, self.client.cookies['sessionid'].value))
+            for i in range(10):
+                asyncore.loop(timeout=0.05, count=1)
+            self.assertEqual(len(server.feed), 1)
+            self.rename('One')
+            server.feed.publish()
+            for i in range(10):
+                asyncore.loop(timeout=0.05, count=1)
+            response = client.recv(65536)
+            self.assertTrue(response.startswith('HTTP/1.1 200 OK'))
+            body = simplejson.loads(response.split('\r\n\r\n', 1)[1])
+            self.assertEqual(body['changes'][0]['operations'], [{'op': 'rename', 'name': 'One'}])
+        finally:
+            client.close()
+            server.close()
+
+
+class JournalTest(TestCase):
+    def setUp(self):
+        get_thought_cache().clear()
+        self.user = User.objects.create_user('author', 'author@example.com', 'password')
+        self.thought = Thought.objects.get(id=createAndSaveThought(create_json_thought(3), self.user))
+        self.snapshot_interval = think.thought.SNAPSHOT_INTERVAL
+        think.thought.SNAPSHOT_INTERVAL = 3
+
+    def tearDown(self):
+        think.thought.SNAPSHOT_INTERVAL = self.snapshot_interval
+
+    def get_content(self, thought_dict):
+        nodes = sorted((node['id'], node['x'], node['y'], node['text']) for node in thought_dict['nodes'])
+        connections = sorted((connection['nodeOne'], connection['nodeTwo']) for connection in thought_dict['connections'])
+        return thought_dict['name'], nodes, connections
+
+    def test_past_revisions_are_rebuilt(self):
+        node_ids = [str(id) for id in Node.objects.filter(thought=self.thought).order_by('id').values_list('id', flat=True)]
+        edits = [
+            [{'op': 'moveNode', 'id': node_ids[0], 'x': 50, 'y': 60}],
+            [{'op': 'addNode', 'key': 'new', 'x': 1, 'y': 2, 'text': 'New'}, {'op': 'addConnection', 'node_one': {'key': 'new'}, 'node_two': {'id': node_ids[2]}}],
+            [{'op': 'rename', 'name': 'Renamed'}],
+            [{'op': 'removeNode', 'id': node_ids[1]}],
+            [{'op': 'setNodeText', 'id': node_ids[2], 'text': 'Changed'}],
+        ]
+        contents = {self.thought.revision: self.get_content(thought_to_dict(self.thought))}
+        for operations in edits:
+            patchThought(self.thought, operations, self.user)
+            contents[self.thought.revision] = self.get_content(thought_to_dict(self.thought))
+        make_thought_public_using_id(self.thought.id)
+        self.thought = get_thought_using_id(self.thought.id)
+        # Snapshots were taken when the thought was created and every 3 revisions.
+        self.assertEqual(list(ThoughtSnapshot.objects.filter(thought=self.thought).order_by('revision').values_list('revision', flat=True)), [0, 3, 6])
+        for revision, content in contents.items():
+            with self.assertNumQueries(2):
+                state = get_thought_at_revision(self.thought, revision)
+            self.assertEqual(self.get_content(state.to_dict(self.thought.id)), content)
+        self.assertFalse(get_thought_at_revision(self.thought, 5).public)
+        self.assertTrue(get_thought_at_revision(self.thought, 6).public)
+        self.assertRaises(HistoryError, get_thought_at_revision, self.thought, 7)
+
+    def test_history_view(self):
+        patchThought(self.thought, [{'op': 'rename', 'name': 'Renamed'}], self.user)
+        self.client.login(username='author', password='password')
+        body = simplejson.loads(self.client.get('/thought/history', {'id': self.thought.id}).content)
+        self.assertEqual([(change['revision'], change['user'], change['operations']) for change in body['changes']],
+            [(1, 'author', [{'op': 'rename', 'name': 'Renamed'}])])
+        body = simplejson.loads(self.client.get('/thought/history', {'id': self.thought.id, 'revision': 0}).content)
+        self.assertEqual(body['thought']['name'], 'Big Thought')
+        self.assertEqual(len(body['thought']['nodes']), 3)
+
+    def test_themed_saves_leave_no_gaps(self):
+        json_thought = create_json_thought(3)
+        json_thought['theme'] = {'name': 'Dark', 'background_top_color': '#000', 'background_bottom_color': '#000',
+            'node_outer_color': '#111', 'node_inner_color': '#222', 'node_text_color': '#fff',
+            'connection_outer_color': '#333', 'connection_inner_color': '#444', 'connection_text_color': '#fff'}
+        for name in ('Dark', 'Light'):
+            json_thought['theme']['name'] = name
+            updateThought(self.thought, json_thought, self.user, self.thought.revision)
+        self.assertEqual(self.thought.revision, 2)
+        for revision in range(3):
+            get_thought_at_revision(self.thought, revision)
+        self.assertEqual(get_thought_at_revision(self.thought, 2).theme['name'], 'Light')
+
+    def test_deleting_a_user_keeps_their_changes(self):
+        editor = User.objects.create_user('editor', 'editor@example.com', 'password')
+        Permission(thought=self.thought, user=editor, type=permit_modify).save()
+        patchThought(self.thought, [{'op': 'rename', 'name': 'Renamed'}], editor)
+        editor.delete()
+        self.assertEqual(list(ThoughtChange.objects.filter(thought=self.thought).values_list('revision', 'user')), [(1, None)])
+        self.assertEqual(get_thought_at_revision(self.thought, 1).name, 'Renamed')
+
+    def test_snapshot_reads_the_theme_from_the_database(self):
+        theme = Theme.objects.create(name='Original')
+        Thought.objects.filter(id=self.thought.id).update(theme=theme)
+        get_registered_theme(theme.id)
+        # Another process renames the theme, which this process's registry does not see.
+        Theme.objects.filter(id=theme.id).update(name='Renamed')
+        take_thought_snapshot(Thought.objects.get(id=self.thought.id))
+        content = simplejson.loads(ThoughtSnapshot.objects.filter(thought=self.thought).order_by('-id')[0].content)
+        self.assertEqual(content['theme']['name'], 'Renamed')
+
+
+FREEMIND_MAP = """<map version="1.0.1">
+<node TEXT="Root">
+<node TEXT="Child one"><node TEXT="Grandchild"/></node>
+<node TEXT="Child two"/>
+</node>
+</map>"""
+
+OPML_MAP = """<?xml version="1.0"?>
+<opml version="2.0"><head><title>Outline</title></head>
+<body><outline text="First"><outline text="Second"/></outline><outline text="Third"/></body></opml>"""
+
+
+class ImportThoughtTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user('author', 'author@example.com', 'password')
+
+    def get_edges(self, thought):
+        texts = dict(Node.objects.filter(thought=thought).values_list('id', 'text'))
+        return sorted((texts[c.node_one_id], texts[c.node_two_id]) for c in Connection.objects.filter(thought=thought))
+
+    def test_freemind(self):
+        thought, nodes, connections = import_thought(StringIO(FREEMIND_MAP), 'mm', self.user, 'file')
+        self.assertEqual((thought.name, nodes, connections), ('Root', 4, 3))
+        self.assertEqual(self.get_edges(thought), [('Child one', 'Grandchild'), ('Root', 'Child one'), ('Root', 'Child two')])
+        self.assertEqual(Node.objects.get(thought=thought, text='Grandchild').x, 400)
+        self.assertTrue(get_thought_rights(self.user, thought).modify)
+        # The history of the thought starts with the import.
+        state = get_thought_at_revision(thought, 0)
+        self.assertEqual((state.name, len(state.nodes), len(state.connections)), ('Root', 4, 3))
+
+    def test_opml(self):
+        thought, nodes, connections = import_thought(StringIO(OPML_MAP), 'opml', self.user, 'file')
+        self.assertEqual((thought.name, nodes, connections), ('Outline', 3, 1))
+        self.assertEqual(self.get_edges(thought), [('First', 'Second')])
+
+    def test_json_is_streamed(self):
+        # More nodes than a batch, with the connections before the nodes as in ThoughtView.get responses.
+        json_thought = create_json_thought(250)
+        for i, node in enumerate(json_thought['nodes']):
+            node['id'] = str(1000 + i)
+        connections = [{'nodeOne': pair[0]['id'], 'nodeTwo': pair[1]['id']} for pair in json_thought['connections']]
+        stream = StringIO('{"connections": %s, "nodes": %s, "name": "Imported \\u00e9"}' % (simplejson.dumps(connections), simplejson.dumps(json_thought['nodes'])))
+        stream.read = lambda size=-1, read=stream.read: read(min(size, 7)) # Reads end in the middle of values.
+        thought, nodes, connections = import_thought(stream, 'json', self.user, 'file')
+        self.assertEqual((thought.name, nodes, connections), (u'Imported \u00e9', 250, 249))
+        self.assertEqual(self.get_edges(thought)[0], ('Node 0', 'Node 1'))
+
+    def test_json_node_values_are_checked(self):
+        thought, nodes, connections = import_thought(StringIO('{"nodes": [{"x": 1, "y": 2, "text": 5}]}'), 'json', self.user, 'file')
+        self.assertEqual(Node.objects.get(thought=thought).text, u'5')
+        for x in ['1e400', '99999999999999999999', '"left"']:
+            stream = StringIO('{"nodes": [{"x": %s, "y": 2, "text": "Node"}]}' % x)
+            self.assertRaises(MapImportError, import_thought, stream, 'json', self.user, 'file')
+
+    def test_json_must_be_utf8(self):
+        self.assertRaises(MapImportError, import_thought, StringIO('{"name": "Caf\xe9", "nodes": []}'), 'json', self.user, 'file')
+
+    def test_doctype_is_rejected(self):
+        entities = '<!DOCTYPE map [<!ENTITY a "aaaaaaaaaa"><!ENTITY b "&a;&a;&a;&a;&a;&a;&a;&a;&a;&a;">]>'
+        stream = StringIO('<?xml version="1.0"?>%s<map><node TEXT="&b;"/></map>' % entities)
+        stream.read = lambda size=-1, read=stream.read: read(min(size, 5)) # The declaration is split between reads.
+        self.assertRaises(MapImportError, import_thought, stream, 'mm', self.user, 'file')
+        self.assertRaises(MapImportError, import_thought, StringIO(FREEMIND_MAP.encode('utf-16')), 'mm', self.user, 'file')
+
+    def test_import_view(self):
+        self.client.login(username='author', password='password')
+        upload = StringIO(FREEMIND_MAP)
+        upload.name = 'map.mm'
+        body = simplejson.loads(self.client.post('/thought/import', {'file': upload}).content)
+        self.assertTrue(body['success'])
+        self.assertEqual(body['nodes'], 4)
+        self.assertEqual(Thought.objects.get(id=body['id']).name, 'Root')
+
+
+class ImportRollbackTest(TransactionTestCase):
+    def test_malformed_files_import_nothing(self):
+        # Nodes are written in batches as the file is read, so an error at the end of a file must roll them back.
+        user = User.objects.create_user('author', 'author@example.com', 'password')
+        nodes = ''.join('<node TEXT="Node %d"/>' % i for i in range(150))
+        self.assertRaises(MapImportError, import_thought, StringIO('<map><node TEXT="Root">%s' % nodes), 'mm', user, 'file')
+        self.assertRaises(MapImportError, import_thought, StringIO('{"nodes": [{"x": 1'), 'json', user, 'file')
+        self.assertFalse(Thought.all_objects.exists())
+        self.assertFalse(Node.objects.exists())
+
+
+class ThoughtArchiveTest(TestCase):
+    def setUp(self):
+        get_thought_cache().clear()
+        self.user = User.objects.create_user('author', 'author@example.com', 'password')
+        self.thought_ids = [createAndSaveThought(create_json_thought(size), self.user) for size in (3, 600, 1)]
+        Thought.objects.filter(id=self.thought_ids[1]).update(name=u'Caf\u00e9 plans')
+        # A thought the user can only view is not exported.
+        other = User.objects.create_user('other', 'other@example.com', 'password')
+        viewed_id = createAndSaveThought(create_json_thought(2), other)
+        Permission.objects.create(thought_id=viewed_id, user=self.user, type=permit_view)
+
+    def test_thoughts_are_read_in_pages(self):
+        self.assertEqual([thought.id for thought in get_exported_thoughts(self.user, page_size=2)], [int(id) for id in self.thought_ids])
+
+    def test_zip_archive_of_json(self):
+        archive = zipfile.ZipFile(StringIO(''.join(iter_thought_archive(self.user, 'json', 'zip'))))
+        self.assertEqual(archive.testzip(), None)
+        names = archive.namelist()
+        self.assertEqual(names, ['%s-big-thought.json' % self.thought_ids[0], '%s-cafe-plans.json' % self.thought_ids[1], '%s-big-thought.json' % self.thought_ids[2]])
+        data = simplejson.loads(archive.read(names[1]))
+        self.assertEqual((data['name'], len(data['nodes']), len(data['connections'])), (u'Caf\u00e9 plans', 600, 599))
+        # The files can be imported again.
+        thought, nodes, connections = import_thought(StringIO(archive.read(names[1])), 'json', self.user, 'copy')
+        self.assertEqual((nodes, connections), (600, 599))
+
+    def test_tar_archives_of_opml(self):
+        for archive_type in ('tar', 'tgz'):
+            archive = tarfile.open(fileobj=StringIO(''.join(iter_thought_archive(self.user, 'opml', archive_type))))
+            members = archive.getmembers()
+            self.assertEqual([member.name for member in members][1], '%s-cafe-plans.opml' % self.thought_ids[1])
+            opml = archive.extractfile(members[0]).read()
+            self.assertTrue('<outline text="Node 0">\n <outline text="Node 1">\n  <outline text="Node 2"/>' in opml)
+            # The chain of nodes is written as nested outlines, which import back as the same chain.
+            thought, nodes, connections = import_thought(archive.extractfile(members[1]), 'opml', self.user, 'copy')
+            self.assertEqual((thought.name, nodes, connections), (u'Caf\u00e9 plans', 600, 599))
+
+    def test_thoughts_saved_while_encoded_are_encoded_again(self):
+        encode = think.archive.ENCODERS['json']
+        def save_and_encode(thought):
+            if thought.name == 'Big Thought' and thought.revision == 0:
+                patchThought(Thought.objects.get(id=thought.id), [{'op': 'rename', 'name': 'Saved meanwhile'}], self.user)
+            return encode(thought)
+        think.archive.ENCODERS['json'] = save_and_encode
+        try:
+            archive = zipfile.ZipFile(StringIO(''.join(iter_thought_archive(self.user, 'json', 'zip'))))
+        finally:
+            think.archive.ENCODERS['json'] = encode
+        self.assertEqual(archive.namelist()[0], '%s-saved-meanwhile.json' % self.thought_ids[0])
+        self.assertEqual(simplejson.loads(archive.read(archive.namelist()[0]))['revision'], 1)
+
+    def test_full_zip_archive_is_ended_early(self):
+        # The archive is ended with a note once the next thought would not fit, and is still a valid zip archive.
+        for name, value in (('MAX_ZIP_ENTRIES', 3), ('MAX_ZIP_SIZE', think.archive.INCOMPLETE_RESERVE + 2000)):
+            original = getattr(think.archive, name)
+            setattr(think.archive, name, value)
+            try:
+                archive = zipfile.ZipFile(StringIO(''.join(iter_thought_archive(self.user, 'json', 'zip'))))
+            finally:
+                setattr(think.archive, name, original)
+            self.assertEqual(archive.testzip(), None)
+            names = archive.namelist()
+            self.assertEqual(names[-1], 'INCOMPLETE.txt')
+            self.assertTrue(archive.read(names[-1]).startswith('Only the first %d thoughts were exported.' % (len(names) - 1)))
+            self.assertEqual(len(names), 3 if name == 'MAX_ZIP_ENTRIES' else 2)
+
+    def test_archive_view(self):
+        self.assertFalse(simplejson.loads(self.client.get('/thought/archive').content)['success'])
+        self.client.login(username='author', password='password')
+        self.assertEqual(self.client.get('/thought/archive', {'archive': 'rar'}).status_code, 400)
+        response = self.client.get('/thought/archive', {'format': 'opml'})
+        self.assertEqual(response['Content-Type'], 'application/zip')
+        self.assertEqual(len(zipfile.ZipFile(StringIO(response.content)).namelist()), 3)
+
+
+@csrf_exempt
+def exempt_view(request):
+    return HttpResponse('exempt')
+
+
+class LazyViewTest(TestCase):
+    def test_attributes_of_the_view_are_read_from_it(self):
+        view = lazy_view('think.tests.exempt_view')
+        # The CSRF middleware reads the attribute before the view is first called.
+        self.assertTrue(getattr(view, 'csrf_exempt', False))
+        self.assertEqual(view(None).content, 'exempt')
+        self.assertFalse(getattr(lazy_view('think.views.thought.ThoughtView'), 'csrf_exempt', False))
@@ -1,16 +1,127 @@
 """
 A collection of methods relating to the Theme Model.
+
+Themes are few, small and rarely modified, so every theme is loaded into a process-local registry the first time one is read,
+and reads are answered from it without querying the database. create_theme, update_theme and delete_theme clear the
+registry, both at once and after their transaction commits. They also increment a version number in the thought cache; if
+settings.THEME_REGISTRY_CHECK_INTERVAL is a number of seconds, other processes compare their registry to that version at most
+once per interval, which keeps them consistent when the thought cache is shared, e.g. memcached. Whatever the interval, a
+process reloads its registry when it is asked for a theme it does not have, so themes created by other processes are found.
 """
 
 
+from __future__ import with_statement
+
+import threading
+import time
+
+from django.conf import settings
 
 from utilities import is_none_or_empty
-from think.models import Theme, Permission, permit_modify
+from think.models import Theme, Thought, Permission, MetaData, permit_modify
 from think.permission import get_permissions_using_theme
-from think.misc import get_id
+from think.misc import get_id, delete_where, run_after_commit
+from think.cache import get_thought_cache
+
+
+# Constants
+THEME_REGISTRY_VERSION_KEY = 'theme-registry-version'
+
+
+class ThemeRegistry:
+  """The themes loaded by this process."""
+  
+  themes = None # Theme ids to Theme models, or None if the themes have not been loaded.
+  default_theme_id = None
+  version = None # The version number in the thought cache when the themes were loaded.
+  checked = 0 # The time the version number was last compared.
+  generation = 0 # Incremented by every invalidation in this process, so that themes loaded before one are not kept.
 
 
+_registry_lock = threading.Lock()
+
 get_theme_id = get_id
+
+def get_theme_registry_version():
+  """Gets the version number of the themes from the thought cache, or 0 if it is not there."""
+  return get_thought_cache().get(THEME_REGISTRY_VERSION_KEY, 0)
+
+def clear_theme_registry():
+  """Clears the theme registry of this process and, through the thought cache, of other processes."""
+  cache = get_thought_cache()
+  if not cache.add(THEME_REGISTRY_VERSION_KEY, 1):
+    try:
+      cache.incr(THEME_REGISTRY_VERSION_KEY)
+    except ValueError, e: # The version was evicted in between.
+      cache.add(THEME_REGISTRY_VERSION_KEY, 1)
+  with _registry_lock:
+    ThemeRegistry.themes = None
+    ThemeRegistry.generation += 1
+
+def invalidate_theme_registry():
+  """Clears the theme registry now and again once the current transaction ends. This must be called after Themes are written.
+     
+     Until the writes are committed, other threads and processes that reload the registry still read the old themes, so it is
+     cleared again after the commit (see think.misc.run_after_commit); clearing it now lets this thread read its own writes.
+  """
+  clear_theme_registry()
+  run_after_commit(clear_theme_registry)
+
+def get_registered_themes():
+  """Gets the theme registry, loading every theme with one query if it has not been loaded or has been invalidated.
+     
+     Returns: a dictionary of theme ids to Theme models. The models are shared by every thread and must not be modified.
+  """
+  check_interval = getattr(settings, 'THEME_REGISTRY_CHECK_INTERVAL', None)
+  with _registry_lock:
+    themes = ThemeRegistry.themes
+    generation = ThemeRegistry.generation
+    if themes != None and check_interval != None and time.time() - ThemeRegistry.checked >= check_interval:
+      ThemeRegistry.checked = time.time()
+      if get_theme_registry_version() != ThemeRegistry.version:
+        themes = ThemeRegistry.themes = None
+        ThemeRegistry.generation += 1
+        generation = ThemeRegistry.generation
+  if themes != None:
+    return themes
+  
+  version = get_theme_registry_version()
+  themes = dict((theme.id, theme) for theme in Theme.objects.all())
+  default_theme_ids = MetaData.objects.values_list('original_theme_id', flat=True)[:1]
+  with _registry_lock:
+    if ThemeRegistry.generation == generation:
+      ThemeRegistry.themes = themes
+      ThemeRegistry.default_theme_id = default_theme_ids[0] if default_theme_ids else None
+      ThemeRegistry.version = version
+      ThemeRegistry.checked = time.time()
+  return themes
+
+def get_registered_theme(id):
+  """Gets a Theme from the theme registry.
+     
+     Args:
+       id: the id of the theme, or None.
+     
+     Returns: a Theme model, which must not be modified, or None if there is no such theme.
+  """
+  if id == None:
+    return None
+  theme = get_registered_themes().get(int(id))
+  if theme == None:
+    # The theme may have been created by another process since the registry was loaded.
+    with _registry_lock:
+      ThemeRegistry.themes = None
+      ThemeRegistry.generation += 1
+    theme = get_registered_themes().get(int(id))
+  return theme
+
+def get_registered_default_theme():
+  """Gets the default Theme from the theme registry.
+     
+     Returns: a Theme model, which must not be modified, or None if the server has not been initialised.
+  """
+  themes = get_registered_themes()
+  return themes.get(ThemeRegistry.default_theme_id)
   
 def theme_to_dict(theme):
   """Convert a Theme Model into a dictionary ready to be turned into a JSON string.
@@ -32,7 +143,7 @@ def theme_to_dict(theme):
     'node_inner_color': theme.nodeInnerColor,
     'node_text_color': theme.nodeTextColor,
     'connection_outer_color': theme.connectionOuterColor,
-    'connection_inner_color': theme.connection_inner_color,
+    'connection_inner_color': theme.connectionInnerColor,
     'connectionTextColor': theme.connectionTextColor,
   }
   return data
@@ -56,18 +167,28 @@ def create_theme(theme_dict, user):
   theme.connectionOuterColor = theme_dict['connection_outer_color']
   theme.connectionInnerColor = theme_dict['connection_inner_color']
   theme.connectionTextColor = theme_dict['connection_text_color']
-  theme.put()
+  theme.save()
   theme_dict['id'] = get_theme_id(theme)
   permission = Permission(theme=theme, type=permit_modify, user=user)
-  permission.put()
+  permission.save()
+  invalidate_theme_registry()
 
-def update_theme(theme_dict):
-  """Updates a Theme model from a dictionary.
+def update_theme(theme_dict, user=None, thought=None):
+  """Updates a Theme model from a dictionary, if any of its fields have changed.
+     
+     The theme is part of the thoughts that use it, so each of them gets a new revision with a setTheme change in its
+     journal (see think.thought.record_theme_change).
      
      Args:
        theme_dict: a dictionary that is identical to a Theme model instance.
+       user: the user updating the theme, or None.
+       thought: the thought being saved with the theme, if any, which records its own setTheme change.
+     
+     Returns: whether the theme was changed.
   """
+  from think.thought import record_theme_change # think.thought imports this module.
   theme = get_theme_using_id(theme_dict['id'])
+  original = theme_to_dict(theme)
   theme.name = theme_dict['name']
   theme.backgroundTopColor = theme_dict['background_top_color']
   theme.backgroundBottomColor = theme_dict['background_bottom_color']
@@ -77,20 +198,26 @@ def update_theme(theme_dict):
   theme.connectionOuterColor = theme_dict['connection_outer_color']
   theme.connectionInnerColor = theme_dict['connection_inner_color']
   theme.connectionTextColor = theme_dict['connection_text_color']
-  theme.put()
+  if theme_to_dict(theme) == original:
+    return False
+  theme.save()
+  invalidate_theme_registry()
+  record_theme_change(theme, user, thought)
+  return True
 
-def create_or_update_theme(theme_dict, user=None):
+def create_or_update_theme(theme_dict, user=None, thought=None):
   """Creates or Updates a Theme model from a dictionary.
      
      Args:
        theme_dict: a dictionary that is identical to a Theme model instance.
        user: the user is needed if the Theme model is going to be created.
+       thought: the thought being saved with the theme, if any; see update_theme.
   """
   if 'id' not in theme_dict:
     create_theme(theme_dict, user)
   else:
     #TODO: check that the user has permissions to update the theme. remove the user default assignment.
-    update_theme(theme_dict)
+    update_theme(theme_dict, user, thought)
   return theme_dict['id']
 
 def get_theme_using_id(id):
@@ -102,7 +229,7 @@ def get_theme_using_id(id):
      Returns: a Theme model.
   """
   try:
-    theme = Theme.get(id)
+    theme = Theme.objects.get(id=id)
     return theme
   except Exception, e:
     return None
@@ -121,21 +248,19 @@ def get_thoughts_using_theme(theme):
     list.append(element)
   return list
   
-def delete_theme(theme):
+def delete_theme(theme, user=None):
   """Deletes the theme model and 'fixes' associated models.
      
      Args:
        theme: the theme to be deleted.
+       user: the user deleting the theme, or None.
   """
-  # Find All Thoughts using the theme.
-  for thought in get_thoughts_using_theme(theme):
-    thought.theme = None
-    thought.put()
-  
-  for permission in get_permissions_using_theme(theme):
-    permission.delete()
-    
+  from think.thought import record_theme_change # think.thought imports this module.
+  # The thoughts using the theme are left without one, with a setTheme change in their journals.
+  record_theme_change(theme, user, deleted=True)
+  delete_where(Permission, 'theme', theme.id)
   theme.delete()
+  invalidate_theme_registry()
 
 def get_thoughts_using_theme(theme):
   """Get all thoughts that are associated to a given Theme.
@@ -160,7 +285,7 @@ def get_theme_using_id(id):
      Returns: a Theme model.
   """
   try:
-    theme = Theme.get(id)
+    theme = Theme.objects.get(id=id)
     return theme
   except Exception, e:
     return None
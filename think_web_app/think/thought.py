@@ -3,16 +3,30 @@ A collection of methods relating to the Thought Model.
 """
 
 
+from django.db import transaction
+from django.db.models import Q, F
+from django.utils import simplejson, timezone
+
 from think.models import * # Get the constants
-from think.node import node_to_dict, get_node_id, find_node
-from think.connection import connection_to_dict
-from think.permission import get_permissions_using_thought, get_all_view_permissions
-from think.theme import theme_to_dict, get_theme_id, create_or_update_theme, delete_theme, get_theme_using_id
-from think.misc import get_id
+from think.node import node_to_dict, node_values_to_dict, get_node_id, find_node, get_node_key, create_node_index
+from think.connection import connection_to_dict, connection_ids_to_dict
+from think.permission import get_permissions_using_thought, get_all_view_permissions, get_thought_rights
+from think.theme import theme_to_dict, get_theme_id, create_or_update_theme, delete_theme, get_theme_using_id, get_registered_theme
+from think.misc import get_id, bulk_create_in_batches, bulk_update_in_batches, bulk_delete_in_batches, delete_where, iter_value_chunks, commit_on_success_with_hooks
 from think.data import get_default_theme
+from think.cache import get_cached_thought, delete_cached_thought
+from think.search import index_nodes, index_thought, remove_nodes, remove_thought
 from utilities import model_list_to_dict
 
 
+# The number of nodes or connections encoded at a time when a thought is streamed.
+STREAM_CHUNK_SIZE = 500
+# The number of rows of a deleted thought deleted at a time by reclaim_deleted_thoughts.
+RECLAIM_CHUNK_SIZE = 1000
+# A snapshot of a thought is taken every SNAPSHOT_INTERVAL revisions; see take_thought_snapshot.
+SNAPSHOT_INTERVAL = 100
+
+
 class Names:
   """An emumeration of parameter names."""
   
@@ -33,6 +47,52 @@ class Names:
   modifiable = 'modifiable'
   type = 'type'
   is_public = 'is_public' # This is called 'is_public' because 'public' is a javascript keyword.
+  operations = 'operations'
+  op = 'op'
+  node_ids = 'nodeIds'
+  revision = 'revision'
+  expected_revision = 'expected_revision'
+  stream = 'stream'
+  bbox = 'bbox'
+  sort = 'sort'
+  cursor = 'cursor'
+  limit = 'limit'
+  next_cursor = 'nextCursor'
+  asynchronous = 'async'
+  format = 'format'
+  metric = 'metric'
+  source = 'from'
+  target = 'to'
+  iterations = 'iterations'
+  spacing = 'spacing'
+  query = 'q'
+  since = 'since'
+  before = 'before'
+  archive = 'archive'
+
+
+class Operations:
+  """An emumeration of the operations that can be applied to a Thought by a patch."""
+  
+  add_node = 'addNode'
+  move_node = 'moveNode'
+  set_node_text = 'setNodeText'
+  remove_node = 'removeNode'
+  add_connection = 'addConnection'
+  remove_connection = 'removeConnection'
+  rename = 'rename'
+  set_theme = 'setTheme'
+  set_public = 'setPublic'
+
+
+
+class RevisionConflictError(Exception):
+  """Raised when a Thought is saved by a client that has not loaded its latest revision."""
+  
+  def __init__(self, expected_revision):
+    Exception.__init__(self, 'The thought is no longer at revision %s.' % expected_revision)
+    self.expected_revision = expected_revision
+
 
 get_thought_id = get_id
 
@@ -58,11 +118,12 @@ def get_thought_using_name(name):
      Args:
        name: The name of the thought.
      
-     Returns: a Thought model.
+     Returns: a Thought model, or None if there is no such thought.
   """
-  query = Thought.objects.filter(name=name)
-  thought = query.get()
-  return thought
+  thoughts = Thought.objects.filter(name=name)[:1]
+  if thoughts:
+    return thoughts[0]
+  return None
 
 def get_thought_using_id(id):
   """Gets the Thought from DataStore.
@@ -78,29 +139,63 @@ def get_thought_using_id(id):
   except Exception, e:
     return None
 
-def delete_thought_using_id(id):
+@commit_on_success_with_hooks
+def delete_thought_using_id(id, asynchronous=False):
   """Deletes the Thought and all related models from DataStore.
      
+     The related models are deleted by a few set-based statements in one transaction. Deleting the nodes and connections of a
+     very large thought this way can take a long time, so it can instead be tombstoned: its permissions are deleted and it is
+     marked as deleted immediately, and its rows are left for reclaim_deleted_thoughts to delete in chunks.
+     
      Args:
        id: The id of the thought.
+       asynchronous: whether to tombstone the thought instead of deleting its nodes and connections.
   """
   thought = get_thought_using_id(id)
+  if thought == None:
+    return
   
-  for node in get_thought_nodes(thought):
-    node.delete()
-    
-  for connection in get_thought_connections(thought):
-    connection.delete()
-  
-  for permission in get_permissions_using_thought(thought):
-    permission.delete()
+  delete_where(Permission, 'thought', thought.id)
+  if asynchronous:
+    Thought.objects.filter(id=thought.id).update(deleted=True, theme=None, revision=F('revision') + 1, last_modified=timezone.now())
+  else:
+    remove_thought(thought.id)
+    delete_where(ThoughtSnapshot, 'thought', thought.id)
+    delete_where(ThoughtChange, 'thought', thought.id)
+    delete_where(Connection, 'thought', thought.id)
+    delete_where(Node, 'thought', thought.id)
+    bulk_delete_in_batches(Thought, [thought.id])
   
   # Current policy dictates that there are a one-to-one relationship between thoughts and themes. This will change in the future.
-  if thought.theme != None:
-    delete_theme(thought.theme)
-    
-  thought.delete()
+  if thought.theme_id != None:
+    delete_theme(get_theme_using_id(thought.theme_id))
+  delete_cached_thought(thought.id, thought.revision, thought.last_modified)
 
+@transaction.commit_on_success
+def reclaim_deleted_thoughts(chunk_size=RECLAIM_CHUNK_SIZE):
+  """Deletes a chunk of the rows of Thoughts tombstoned by delete_thought_using_id, in its own transaction.
+     
+     Args:
+       chunk_size: the maximum number of rows to delete.
+     
+     Returns: the number of rows deleted; 0 if there is nothing left to reclaim.
+  """
+  thought_ids = list(Thought.all_objects.filter(deleted=True).values_list('id', flat=True)[:1])
+  if not thought_ids:
+    return 0
+  thought_id = thought_ids[0]
+  # Connections refer to nodes, so they are deleted first.
+  for model_class in [ThoughtSnapshot, ThoughtChange, Connection, Node]:
+    ids = list(model_class.objects.filter(thought=thought_id).values_list('id', flat=True)[:chunk_size])
+    if ids:
+      if model_class == Node:
+        remove_nodes(ids)
+      bulk_delete_in_batches(model_class, ids)
+      return len(ids)
+  bulk_delete_in_batches(Thought, [thought_id])
+  return 1
+
+@transaction.commit_on_success
 def make_thought_public_using_id(thoughtId):
   """Make a thought public (viewable by all).
      
@@ -112,8 +207,11 @@ def make_thought_public_using_id(thoughtId):
     return
   else:
     permission = Permission(thought=thought,type=permit_all_view)
-    permission.put()
+    permission.save()
+    bump_thought_revision(thought)
+    record_thought_change(thought, [{Names.op: Operations.set_public, Names.is_public: True}])
 
+@transaction.commit_on_success
 def make_thought_private_using_id(thoughtId):
   """Make a thought private (not viewable by all).
      
@@ -121,19 +219,46 @@ def make_thought_private_using_id(thoughtId):
        thoughtId: the id of the thought to be made private.
   """
   thought = get_thought_using_id(thoughtId)
-  query = Permssion.objects.filter(thought=thought, type=permit_all_view)
+  query = Permission.objects.filter(thought=thought, type=permit_all_view)
   for permission in query: # In case there are multiple permissions.
     permission.delete()
+  bump_thought_revision(thought)
+  record_thought_change(thought, [{Names.op: Operations.set_public, Names.is_public: False}])
+
+def thought_viewable_by_all(thought):
+  """Checks if the Thought is viewable by all."""
+  return get_thought_rights(None, thought).public
 
 def thought_viewable_by_all_using_name(name):
   """Checks if the Thought is viewable by all using the thought name."""
-  thought = Thought.objects.filter(name=name).get()
-  return get_all_view_permissions(thought) != None
+  thought = get_thought_using_name(name)
+  return thought != None and thought_viewable_by_all(thought)
   
 def thought_viewable_by_all_using_id(id):
   """Checks if the Thought is viewable by all using the thought id."""
-  thought = get_thought_using_id(id)
-  return get_all_view_permissions(thought) != None
+  return get_thought_rights(None, id).public
+
+def bump_thought_revision(thought, expected_revision=None):
+  """Increments the revision of a Thought. This must be called by everything that writes to a thought, so that cached copies of the thought are no longer used.
+     
+     Args:
+       thought: a thought Model. Its revision attribute is incremented too.
+       expected_revision: if given, the revision is only incremented if it is still the expected revision.
+     
+     Raises:
+       RevisionConflictError: the thought is no longer at the expected revision.
+  """
+  last_modified = timezone.now()
+  query = Thought.objects.filter(id=thought.id)
+  if expected_revision != None:
+    query = query.filter(revision=expected_revision)
+  if query.update(revision=F('revision') + 1, last_modified=last_modified) == 0:
+    raise RevisionConflictError(expected_revision)
+  if expected_revision != None:
+    thought.revision = expected_revision + 1
+  else:
+    thought.revision += 1
+  thought.last_modified = last_modified
 
 def get_thought_connections(thought):
   """Get all connections for a given Thought.
@@ -166,6 +291,9 @@ def get_thought_nodes(thought):
 def thought_to_dict(thought):
   """Convert a Thought Model into a dictionary ready to be turned into a JSON string.
      
+     Only the needed columns of the nodes and connections are selected, so the number of queries does not depend on the size of the thought.
+     The nodes and connections are in the order of their ids, as iter_encoded_thought streams them.
+     
      Args:
        thought: the thought model.
      
@@ -174,45 +302,157 @@ def thought_to_dict(thought):
   if thought == None: 
     return None
   
-  nodes = get_thought_nodes(thought)
   dictNodes = []
-  for node in nodes:
-    dictNodes.append(node_to_dict(node))
+  for id, x, y, text in Node.objects.filter(thought=thought).order_by('id').values_list('id', 'x', 'y', 'text'):
+    dictNodes.append(node_values_to_dict(id, x, y, text))
     
-  connections = get_thought_connections(thought)
   dictConnections = []
-  for connection in connections:
-    dictConnections.append(connection_to_dict(connection))    
+  for node_one_id, node_two_id in Connection.objects.filter(thought=thought).order_by('id').values_list('node_one_id', 'node_two_id'):
+    dictConnections.append(connection_ids_to_dict(node_one_id, node_two_id))
     
   data = {
     'name': thought.name,
     'connections': dictConnections,
     'nodes': dictNodes,
     'id': str(thought.id),
-    'theme': theme_to_dict(thought.theme)
+    'revision': thought.revision,
+    'theme': theme_to_dict(get_registered_theme(thought.theme_id))
   }  
   return data
 
-def create_or_update_themeFromThoughtDict(thoughtDict, user):
+def get_encoded_thought(thought):
+  """Gets a Thought encoded as a JSON string from the thought cache, encoding it on a cache miss.
+     
+     The JSON object is the dictionary returned by thought_to_dict, plus an is_public property.
+     
+     Args:
+       thought: the thought model.
+     
+     Returns: a JSON string.
+  """
+  def encode_thought():
+    data = thought_to_dict(thought)
+    data[Names.is_public] = thought_viewable_by_all(thought)
+    return simplejson.JSONEncoder().encode(data)
+  return get_cached_thought(thought.id, thought.revision, thought.last_modified, encode_thought)
+
+def get_thought_properties(thought):
+  """Gets the properties of a Thought other than its nodes and connections, ready to be turned into a JSON string.
+     
+     Args:
+       thought: the thought model.
+     
+     Returns: a dictionary.
+  """
+  return {
+    'name': thought.name,
+    'id': str(thought.id),
+    'revision': thought.revision,
+    'theme': theme_to_dict(get_registered_theme(thought.theme_id)),
+    Names.is_public: thought_viewable_by_all(thought),
+  }
+
+def iter_encoded_thought(thought, properties={}):
+  """Encodes a Thought as a JSON string piece by piece, so that a large thought never has to be held in memory at once.
+     
+     The nodes and connections are read and encoded a chunk at a time, with a keyset query for each chunk (see
+     think.misc.iter_value_chunks), so memory does not grow with the size of the thought. The JSON object is the same as the one returned by get_encoded_thought, plus the given properties.
+     
+     The chunks are read by separate queries, so a save between them would tear the thought. The revision is checked before
+     the object is closed, and a torn thought ends the stream with an error rather than as a complete object that would be
+     served under the ETag of the revision it started at.
+     
+     Args:
+       thought: the thought model.
+       properties: a dictionary of extra properties to add to the JSON object.
+     
+     Returns: a generator of strings which, joined together, are the encoded thought.
+     
+     Raises:
+       RevisionConflictError: the thought was modified while it was read.
+  """
+  encoder = simplejson.JSONEncoder()
+  data = get_thought_properties(thought)
+  data.update(properties)
+  # Open the object and leave it ready for the nodes and connections arrays.
+  yield encoder.encode(data)[:-1] + ', "nodes": ['
+  
+  node_chunks = iter_value_chunks(Node.objects.filter(thought=thought), ['id', 'x', 'y', 'text'], STREAM_CHUNK_SIZE)
+  for i, chunk in enumerate(node_chunks):
+    yield (', ' if i > 0 else '') + ', '.join(encoder.encode(node_values_to_dict(*values)) for values in chunk)
+  yield '], "connections": ['
+  
+  connection_chunks = iter_value_chunks(Connection.objects.filter(thought=thought), ['node_one_id', 'node_two_id'], STREAM_CHUNK_SIZE)
+  for i, chunk in enumerate(connection_chunks):
+    yield (', ' if i > 0 else '') + ', '.join(encoder.encode(connection_ids_to_dict(*values)) for values in chunk)
+  check_thought_revision(thought)
+  yield ']}'
+
+def check_thought_revision(thought):
+  """Checks that a Thought is still at the revision of its model, e.g. after reading its rows with several queries.
+     
+     Args:
+       thought: the thought model.
+     
+     Raises:
+       RevisionConflictError: the thought has been modified or deleted since the model was loaded.
+  """
+  if not Thought.objects.filter(id=thought.id, revision=thought.revision).exists():
+    raise RevisionConflictError(thought.revision)
+
+def create_or_update_themeFromThoughtDict(thoughtDict, user, thought=None):
   """
      Creates or Updates a Theme based on a Thought Dictionary.
      
      Args:
        thoughtDict: a dictionary contain keys matching the properties of a Thought Model.
+       user: the user saving the thought.
+       thought: the Thought model being saved, if it exists; it records its own setTheme change (see think.theme.update_theme).
        
      Returns: Theme.
   """
   if Names.theme in thoughtDict:
     themeDict = thoughtDict[Names.theme]
     if themeDict != None:
-      create_or_update_theme(themeDict, user)
+      create_or_update_theme(themeDict, user, thought)
       return get_theme_using_id(themeDict[Names.id])
     else:
       return None
 
+def get_json_node_text(json_node):
+  """Gets the text of a JSON Node Dictionary.
+     
+     Args:
+       json_node: a JSON Node in the form of a dictionary.
+     
+     Returns: the text, or an empty string if the text is missing or null.
+  """
+  # Somtimes text is null/empty.
+  text = json_node.get(Names.text)
+  if text == None:
+    return ""
+  return text
+
+def get_json_node_key(json_node):
+  """Gets the node key of a JSON Node Dictionary. See think.node.get_node_key."""
+  return get_node_key(json_node[Names.x], json_node[Names.y], get_json_node_text(json_node))
+
+def get_thought_node_index(thought):
+  """Gets a hash index of the nodes of a given Thought using a single query.
+     
+     Args:
+       thought: a thought Model.
+    
+     Returns: a dict of node keys to node ids. See think.node.create_node_index.
+  """
+  return create_node_index(Node.objects.filter(thought=thought).order_by('id').values_list('id', 'x', 'y', 'text'))
+
+@commit_on_success_with_hooks
 def createAndSaveThought(jsonThought, user):
   """Creates a Thought from a JSON Thought Dictionary and saves it.
      
+     The nodes and connections are written with batched inserts inside one transaction.
+     
      Args:
        jsonThought: a JSON Thought in the form of a dictionary.
        user: the author of the Thought.
@@ -221,136 +461,336 @@ def createAndSaveThought(jsonThought, user):
   """
   # Create the Thought
   if Names.name not in jsonThought:
-    raise 'The thought has no name.'
+    raise ValueError('The thought has no name.')
         
   theme = create_or_update_themeFromThoughtDict(jsonThought, user)
 
   thought = Thought(name = jsonThought[Names.name], theme=theme)
-  thought.put()
+  thought.save()
     
   permission = Permission(thought=thought, user=user, type=permit_modify)
-  permission.put()
+  permission.save()
      
   # Create nodes
-  json_nodes = jsonThought[Names.nodes]
   nodes = []
-  for json_node in json_nodes:
-    # Somtimes text is null/empty.
-    text = ""
-    if Names.text in json_node:
-      text = json_node[Names.text]
-        
-    node = Node(x=int(json_node[Names.x]), y=int(json_node[Names.y]), text=text, thought=thought)
-    node.put()
-    nodes.append(node)
-    
-  # Create connections
-  json_connections = jsonThought[Names.connections]
-  for jsonConnection in json_connections:
-    node_one = find_node(nodes, jsonConnection[0][Names.x], jsonConnection[0][Names.y], jsonConnection[0][Names.text])  
-    node_two = find_node(nodes, jsonConnection[1][Names.x], jsonConnection[1][Names.y], jsonConnection[1][Names.text])  
-    connection = Connection(node_one=node_one, node_two=node_two, thought=thought)
-    connection.put()
+  for json_node in jsonThought[Names.nodes]:
+    nodes.append(Node(x=int(json_node[Names.x]), y=int(json_node[Names.y]), text=get_json_node_text(json_node), thought=thought))
+  bulk_create_in_batches(Node, nodes)
+  
+  # Create connections. The bulk inserts do not set the ids of the nodes, so the connections are matched to the saved nodes through an index.
+  node_values = list(Node.objects.filter(thought=thought).order_by('id').values_list('id', 'x', 'y', 'text'))
+  node_index = create_node_index(node_values)
+  connections = []
+  for jsonConnection in jsonThought[Names.connections]:
+    node_one_id = node_index[get_json_node_key(jsonConnection[0])]
+    node_two_id = node_index[get_json_node_key(jsonConnection[1])]
+    connections.append(Connection(node_one_id=node_one_id, node_two_id=node_two_id, thought=thought))
+  bulk_create_in_batches(Connection, connections)
+  index_thought(thought.id)
+  take_thought_snapshot(thought, node_values, [(connection.node_one_id, connection.node_two_id) for connection in connections], False)
   
   return get_thought_id(thought)
   
-def updateThought(thought, jsonThought, user):
+def get_thought_graph(thought):
+  """Loads the nodes and connections of a given Thought as id-keyed indexes, using one query for each.
+     
+     Args:
+       thought: a thought Model.
+     
+     Returns: a tuple of a dict of node ids to (x, y, text) tuples and a dict of (node one id, node two id) tuples to connection ids.
+  """
+  nodes = {}
+  for id, x, y, text in Node.objects.filter(thought=thought).values_list('id', 'x', 'y', 'text'):
+    nodes[id] = (x, y, text)
+  connections = {}
+  for id, node_one_id, node_two_id in Connection.objects.filter(thought=thought).values_list('id', 'node_one_id', 'node_two_id'):
+    connections[(node_one_id, node_two_id)] = id
+  return nodes, connections
+
+@commit_on_success_with_hooks
+def updateThought(thought, jsonThought, user, expected_revision=None):
   """Updates a Thought model using a JSON Thought Dictionary.
      
+     The current nodes and connections are loaded once and compared with the JSON Thought. The resulting inserts, updates and 
+     deletes are then applied in bulk. Nodes whose x, y and text have not changed are not written.
+     
      Args:
        thought: the Thought model.
        jsonThought: a JSON Thought in the form of a dictionary.
        user: the author of the Thought.
+       expected_revision: the revision of the thought the client last loaded. If it is given and the thought has been modified since, nothing is written.
+     
+     Raises:
+       RevisionConflictError: the thought is no longer at the expected revision.
   """        
-  theme = create_or_update_themeFromThoughtDict(jsonThought, user)
+  # Increment the revision first, so that a conflicting save fails before anything is written.
+  bump_thought_revision(thought, expected_revision)
+  operations = []
+  
+  # The theme may be updated in place, so its fields are compared as well as its id.
+  original_theme = theme_to_dict(thought.theme) if thought.theme_id != None else None
+  theme = create_or_update_themeFromThoughtDict(jsonThought, user, thought)
   
   # Update thought
   if thought.name != jsonThought[Names.name]:
     thought.name = jsonThought[Names.name]
-  if thought.theme != theme:
+    operations.append({Names.op: Operations.rename, Names.name: thought.name})
+  if theme_to_dict(theme) != original_theme:
     thought.theme = theme
-  thought.put()
+    operations.append({Names.op: Operations.set_theme, Names.theme: theme_to_dict(theme)})
+  if operations:
+    # Use an UPDATE rather than save, which would write the revision too.
+    Thought.objects.filter(id=thought.id).update(name=thought.name, theme=theme)
   
-  # Create Nodes before creating connections because the creation of connections are dependant on nodes already existing.
-  json_nodes = jsonThought[Names.nodes]
-  for json_node in json_nodes:
-    if Names.id not in json_node:
-      # Create the node.
-      # Somtimes text is null/empty.
-      text = ""
-      if Names.text in json_node:
-        text = json_node[Names.text]
-      node = Node(x=int(json_node[Names.x]), y=int(json_node[Names.y]), text=text, thought=thought)
-      node.put()
-      
-  # Update the connections before updating nodes because a bug occurs in certain cases if a node is deleted before a connection.
-  # Connections are going to be removed from the dict to track which connetions have been deleted since the thought was last saved.
-  connections = get_thought_connections(thought) 
-  json_connections = jsonThought[Names.connections]
-  nodes = get_thought_nodes(thought)
-  keys_to_nodes = model_list_to_dict(nodes) 
-  for jsonConnection in json_connections:
-    # Find if the connection already exists.
-    if Names.id in jsonConnection[0] and Names.id in jsonConnection[1]:
-      # Search for the existing node.
-      matchingConnection = None
-      for connection in connections:
-        if get_node_id(connection.node_one) == jsonConnection[0][Names.id] and get_node_id(connection.node_two) == jsonConnection[1][Names.id]:
-          matchingConnection = connection
-          # The connection exists.
-          break
-      
-      if matchingConnection != None:
-        # Remove the connection from the list of connection because it exists.
-        connections.remove(matchingConnection)
-        continue
-    
-    # The connection has not been saved to the database
-    node_one = None
-    node_two = None
-         
-    # Because the json_connections may be linked to a new node that does not have an id, we may have to search for it.
-    i = 0
-    if Names.id in jsonConnection[i]:
-      node_one = keys_to_nodes[jsonConnection[i][Names.id]]
+  existing_nodes, existing_connections = get_thought_graph(thought)
+  
+  # Sort the JSON nodes into nodes to create and nodes to update. Nodes that are not in the JSON Thought have been deleted.
+  new_nodes = []
+  updated_node_rows = []
+  kept_node_ids = set()
+  for json_node in jsonThought[Names.nodes]:
+    node_id = int(json_node[Names.id]) if Names.id in json_node else None
+    values = get_json_node_key(json_node)
+    if node_id in existing_nodes:
+      kept_node_ids.add(node_id)
+      if existing_nodes[node_id] != values:
+        updated_node_rows.append((node_id,) + values)
     else:
-      node_one = find_node(nodes, jsonConnection[i][Names.x], jsonConnection[i][Names.y], jsonConnection[i][Names.text])
-            
-    i = 1
-    if Names.id in jsonConnection[i]:
-      node_two = keys_to_nodes[jsonConnection[i][Names.id]]
+      # The node is new, or it was deleted since the client loaded the thought; either way it has to be created.
+      new_nodes.append(Node(x=values[0], y=values[1], text=values[2], thought=thought))
+  deleted_node_ids = set(existing_nodes) - kept_node_ids
+  
+  # Create nodes before connections because new connections may be linked to new nodes, which are matched using an index.
+  new_node_values = []
+  if new_nodes:
+    bulk_create_in_batches(Node, new_nodes)
+    newest_existing_node_id = max(existing_nodes) if existing_nodes else 0
+    new_node_values = list(Node.objects.filter(thought=thought, id__gt=newest_existing_node_id).order_by('id').values_list('id', 'x', 'y', 'text'))
+  new_node_index = create_node_index(new_node_values)
+  
+  def get_json_node_id(json_node):
+    if Names.id in json_node and int(json_node[Names.id]) in kept_node_ids:
+      return int(json_node[Names.id])
+    return new_node_index.get(get_json_node_key(json_node))
+  
+  # Connections that are not in the JSON Thought have been deleted.
+  kept_connection_ids = set()
+  new_connection_keys = set()
+  for jsonConnection in jsonThought[Names.connections]:
+    key = (get_json_node_id(jsonConnection[0]), get_json_node_id(jsonConnection[1]))
+    if None in key:
+      continue # The connection is linked to a deleted node.
+    if key in existing_connections:
+      kept_connection_ids.add(existing_connections[key])
     else:
-      node_two = find_node(nodes, jsonConnection[i][Names.x], jsonConnection[i][Names.y], jsonConnection[i][Names.text])
-    
-    connection = Connection(node_one=node_one, node_two=node_two, thought=thought)
-    connection.put()
+      new_connection_keys.add(key)
+  deleted_connection_keys = [key for key, id in existing_connections.items() if id not in kept_connection_ids]
+  
+  # Delete connections before nodes because the connections reference the nodes.
+  bulk_delete_in_batches(Connection, [existing_connections[key] for key in deleted_connection_keys])
+  bulk_delete_in_batches(Node, list(deleted_node_ids))
+  bulk_update_in_batches(Node, ['x', 'y', 'text'], updated_node_rows)
+  bulk_create_in_batches(Connection, [Connection(node_one_id=node_one_id, node_two_id=node_two_id, thought=thought) for node_one_id, node_two_id in new_connection_keys])
+  remove_nodes(deleted_node_ids)
+  index_nodes(thought.id, [(id, text) for id, x, y, text in new_node_values] +
+    [(id, text) for id, x, y, text in updated_node_rows if existing_nodes[id][2] != text])
+  
+  # Record the changes as the operations a patch would have applied.
+  for key in deleted_connection_keys:
+    operations.append(get_connection_operation(Operations.remove_connection, key[0], key[1]))
+  for node_id in deleted_node_ids:
+    operations.append({Names.op: Operations.remove_node, Names.id: str(node_id)})
+  for id, x, y, text in new_node_values:
+    operations.append({Names.op: Operations.add_node, Names.id: str(id), Names.x: x, Names.y: y, Names.text: text})
+  for id, x, y, text in updated_node_rows:
+    if existing_nodes[id][:2] != (x, y):
+      operations.append({Names.op: Operations.move_node, Names.id: str(id), Names.x: x, Names.y: y})
+    if existing_nodes[id][2] != text:
+      operations.append({Names.op: Operations.set_node_text, Names.id: str(id), Names.text: text})
+  for key in new_connection_keys:
+    operations.append(get_connection_operation(Operations.add_connection, key[0], key[1]))
+  record_thought_change(thought, operations, user)
 
-  # Delete the connections left in the list.
-  for connection in connections:
-    connection.delete()
-    
-      
-  # Update nodes
-  # Nodes will be deleted out of this dictionary to figure out which nodes have been deleted since 
-  # the thought is attempted being saved.
-  keys_to_nodes = model_list_to_dict(get_thought_nodes(thought)) 
-  json_nodes = jsonThought[Names.nodes]
-  nodes = get_thought_nodes(thought)
-  for json_node in json_nodes:
-    if Names.id not in json_node:
-      # This nodes has already been created in the top of this function. So don't delete it by removing it from the dict.
-      node = find_node(nodes, json_node[Names.x], json_node[Names.y], json_node[Names.text])
-      del keys_to_nodes[get_node_id(node)]
-      pass
+@commit_on_success_with_hooks
+def patchThought(thought, operations, user, expected_revision=None):
+  """Applies a list of operations to a Thought model, so the cost of a save depends on the size of the edit rather than the size of the Thought.
+     
+     Each operation is a dictionary with an 'op' key whose value is one of the Operations:
+       addNode: x, y and text, plus a client chosen key that later operations can use to refer to the new node.
+       moveNode: id, x and y.
+       setNodeText: id and text.
+       removeNode: id. The connections of the node are removed too.
+       addConnection/removeConnection: node_one and node_two, which are dictionaries containing either an id or the key of an added node.
+       rename: name.
+       setTheme: theme, which is a JSON Theme dictionary or null.
+     
+     Args:
+       thought: the Thought model.
+       operations: a list of operation dictionaries.
+       user: the user applying the operations.
+       expected_revision: the revision of the thought the client last loaded. If it is given and the thought has been modified since, nothing is written.
+     
+     Returns: a dict of the keys of added nodes to their new ids.
+     
+     Raises:
+       KeyError or ValueError: an operation is malformed, unknown or refers to a node that is not in the Thought. No operations are applied.
+       RevisionConflictError: the thought is no longer at the expected revision.
+  """
+  if operations:
+    bump_thought_revision(thought, expected_revision)
+  keys_to_ids = {}
+  applied_operations = [] # The operations with the keys of added nodes replaced by ids.
+  
+  def get_operation_node_id(node_reference):
+    if Names.key in node_reference:
+      return keys_to_ids[node_reference[Names.key]]
+    return int(node_reference[Names.id])
+  
+  def get_thought_node_query(node_id):
+    query = Node.objects.filter(id=node_id, thought=thought)
+    if not query.exists():
+      raise ValueError('The node %s is not in the thought.' % node_id)
+    return query
+  
+  for operation in operations:
+    op = operation[Names.op]
+    if op == Operations.add_node:
+      node = Node(x=int(operation[Names.x]), y=int(operation[Names.y]), text=get_json_node_text(operation), thought=thought)
+      node.save()
+      if Names.key in operation:
+        keys_to_ids[operation[Names.key]] = node.id
+      index_nodes(thought.id, [(node.id, node.text)])
+      applied_operations.append({Names.op: op, Names.id: str(node.id), Names.x: node.x, Names.y: node.y, Names.text: node.text})
+    elif op == Operations.move_node:
+      node_id = int(operation[Names.id])
+      get_thought_node_query(node_id).update(x=int(operation[Names.x]), y=int(operation[Names.y]))
+      applied_operations.append({Names.op: op, Names.id: str(node_id), Names.x: int(operation[Names.x]), Names.y: int(operation[Names.y])})
+    elif op == Operations.set_node_text:
+      node_id = int(operation[Names.id])
+      get_thought_node_query(node_id).update(text=get_json_node_text(operation))
+      index_nodes(thought.id, [(node_id, get_json_node_text(operation))])
+      applied_operations.append({Names.op: op, Names.id: str(node_id), Names.text: get_json_node_text(operation)})
+    elif op == Operations.remove_node:
+      node_id = int(operation[Names.id])
+      query = get_thought_node_query(node_id)
+      Connection.objects.filter(Q(node_one=node_id) | Q(node_two=node_id), thought=thought).delete()
+      remove_nodes([node_id])
+      query.delete()
+      applied_operations.append({Names.op: op, Names.id: str(node_id)})
+    elif op in (Operations.add_connection, Operations.remove_connection):
+      node_one_id = get_operation_node_id(operation[Names.node_one])
+      node_two_id = get_operation_node_id(operation[Names.node_two])
+      if Node.objects.filter(id__in=[node_one_id, node_two_id], thought=thought).count() != len(set([node_one_id, node_two_id])):
+        raise ValueError('The connection is not between nodes in the thought.')
+      query = Connection.objects.filter(node_one=node_one_id, node_two=node_two_id, thought=thought)
+      if op == Operations.remove_connection:
+        query.delete()
+      elif not query.exists():
+        Connection(node_one_id=node_one_id, node_two_id=node_two_id, thought=thought).save()
+      applied_operations.append(get_connection_operation(op, node_one_id, node_two_id))
+    elif op == Operations.rename:
+      thought.name = operation[Names.name]
+      Thought.objects.filter(id=thought.id).update(name=thought.name)
+      applied_operations.append({Names.op: op, Names.name: thought.name})
+    elif op == Operations.set_theme:
+      thought.theme = create_or_update_themeFromThoughtDict(operation, user, thought)
+      Thought.objects.filter(id=thought.id).update(theme=thought.theme)
+      applied_operations.append({Names.op: op, Names.theme: theme_to_dict(thought.theme)})
     else:
-      node = keys_to_nodes[json_node[Names.id]]
-      del keys_to_nodes[json_node[Names.id]] # Delete the node, to mark that it still exists.
-      # Update the node.
-      node.x = json_node[Names.x] 
-      node.y = json_node[Names.y]
-      node.text = json_node[Names.text]
-      node.put()
-      
-  # Delete the left-over existing nodes.
-  for node in keys_to_nodes.values():
-    node.delete()
+      raise ValueError('Unknown operation: %s' % op)
+  
+  if operations:
+    record_thought_change(thought, applied_operations, user)
+  return dict((key, str(id)) for key, id in keys_to_ids.items())
+
+def get_connection_operation(op, node_one_id, node_two_id):
+  """Creates an addConnection or removeConnection operation dictionary.
+     
+     Args:
+       op: the operation.
+       node_one_id: the id of the first node.
+       node_two_id: the id of the second node.
+     
+     Returns: a dictionary.
+  """
+  return {Names.op: op, Names.node_one: {Names.id: str(node_one_id)}, Names.node_two: {Names.id: str(node_two_id)}}
+
+def record_thought_change(thought, operations, user=None):
+  """Records the operations that produced the current revision of a Thought in its journal, and takes a snapshot of the
+     thought every SNAPSHOT_INTERVAL revisions.
+     
+     Args:
+       thought: a thought Model.
+       operations: a list of operation dictionaries whose nodes are all referred to by id.
+       user: the user who made the change, or None.
+  """
+  ThoughtChange(thought=thought, revision=thought.revision, operations=simplejson.dumps(operations), user=user).save()
+  if thought.revision % SNAPSHOT_INTERVAL == 0:
+    take_thought_snapshot(thought)
+
+def record_theme_change(theme, user=None, excluded_thought=None, deleted=False):
+  """Gives every Thought that uses a Theme a new revision with a setTheme change, after the theme has been updated or before
+     it is deleted, so that their journals have no gaps.
+     
+     Args:
+       theme: the theme model.
+       user: the user who changed the theme, or None.
+       excluded_thought: a thought model that is being saved with the theme and records its own change, or None.
+       deleted: whether the theme is being deleted, in which case the thoughts are left without a theme.
+  """
+  query = Thought.objects.filter(theme=theme)
+  if excluded_thought != None:
+    query = query.exclude(id=excluded_thought.id)
+  theme_dict = None if deleted else theme_to_dict(theme)
+  for thought in query:
+    bump_thought_revision(thought)
+    if deleted:
+      Thought.objects.filter(id=thought.id).update(theme=None)
+      thought.theme = None
+    record_thought_change(thought, [{Names.op: Operations.set_theme, Names.theme: theme_dict}], user)
+
+def take_thought_snapshot(thought, node_values=None, connection_ids=None, public=None):
+  """Saves the whole content of the current revision of a Thought, which think.journal replays the later changes onto.
+     
+     The content is a JSON dictionary of the name, the theme dictionary, whether the thought is public, the nodes as
+     [id, x, y, text] lists and the connections as [node one id, node two id] lists.
+     
+     Args:
+       thought: a thought Model.
+       node_values: a list of the (id, x, y, text) tuples of the nodes, if they have already been loaded.
+       connection_ids: a list of the (node one id, node two id) tuples of the connections, if they have already been loaded.
+       public: whether the thought is public, if it is known.
+  """
+  if node_values == None:
+    node_values = Node.objects.filter(thought=thought).order_by('id').values_list('id', 'x', 'y', 'text')
+  if connection_ids == None:
+    connection_ids = Connection.objects.filter(thought=thought).values_list('node_one_id', 'node_two_id')
+  if public == None:
+    public = thought_viewable_by_all(thought)
+  content = {
+    Names.name: thought.name,
+    # The theme is read from the database, since the theme registry of this process may not have a theme written by this
+    # transaction or by another process yet.
+    Names.theme: theme_to_dict(thought.theme) if thought.theme_id != None else None,
+    Names.is_public: public,
+    Names.nodes: [list(values) for values in node_values],
+    Names.connections: [list(ids) for ids in connection_ids],
+  }
+  ThoughtSnapshot(thought=thought, revision=thought.revision, content=simplejson.dumps(content, separators=(',', ':'))).save()
+
+def get_thought_operations_since(thought, revision):
+  """Gets the operations that have been applied to a Thought since a given revision.
+     
+     Args:
+       thought: a thought Model.
+       revision: the revision the operations are applied to.
+     
+     Returns: a list of operation dictionaries, or None if a change since the revision was not recorded as operations.
+  """
+  changes = list(ThoughtChange.objects.filter(thought=thought, revision__gt=revision).order_by('revision').values_list('operations', flat=True))
+  if len(changes) != thought.revision - revision:
+    return None
+  operations = []
+  for change in changes:
+    operations.extend(simplejson.loads(change))
+  return operations
@@ -3,14 +3,24 @@ A collection of user related methods.
 """
 
 from datetime import datetime
+import base64
 import uuid
 
-# Must set this env var before importing any part of Django
-import os
-os.environ['DJANGO_SETTINGS_MODULE'] = 'settings'
-
 from utilities.session import create_cookie
 from django.contrib.auth.models import User
+from think.models import * # Get the constants
+from think.permission import get_thought_rights
+from think.thought import get_thought_using_name
+from django.db.models import Q
+from django.utils import simplejson
+from django.utils.dateparse import parse_datetime
+
+
+# Constants
+SORT_BY_NAME = 'name'
+SORT_BY_LAST_MODIFIED = 'modified'
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
 
 
 def get_user(claimed_id, server_url):
@@ -34,26 +44,97 @@ def create_user(claimed_id, server_url):
   user.put()
   return user
 
-def get_thought_descriptions_for_user(user):
-  """Gets a list of descriptions for Thoughts the User is allowed to view or modify. 
+def encode_cursor(values):
+  """Encodes the sort key of the last thought of a page as an opaque cursor.
+     
+     Args:
+       values: a list of the sort key's values.
+     
+     Returns: a URL safe string.
+  """
+  return base64.urlsafe_b64encode(simplejson.dumps(values))
+
+def decode_cursor(cursor):
+  """Decodes a cursor created by encode_cursor.
+     
+     Args:
+       cursor: the cursor.
+     
+     Returns: the list of values.
+     
+     Raises:
+       ValueError: the cursor is malformed.
+  """
+  try:
+    values = simplejson.loads(base64.urlsafe_b64decode(str(cursor)))
+  except (TypeError, UnicodeEncodeError), e:
+    raise ValueError('The cursor is malformed.')
+  if not isinstance(values, list):
+    raise ValueError('The cursor is malformed.')
+  return values
+
+def get_thought_descriptions_for_user(user, sort=SORT_BY_NAME, cursor=None, limit=DEFAULT_PAGE_SIZE):
+  """Gets a page of descriptions for Thoughts the User is allowed to view or modify. 
+     
+     The page is read with a single query that joins the thoughts to the user's permissions, and each thought appears once
+     even if the user has several permissions to it. Pages are found with keyset cursors, so reading a later page costs the
+     same as reading the first.
      
      Args:
        user: the user.
+       sort: SORT_BY_NAME, or SORT_BY_LAST_MODIFIED for the most recently modified thoughts first.
+       cursor: the cursor returned with the previous page, or None for the first page.
+       limit: the maximum number of descriptions in the page; at most MAX_PAGE_SIZE.
     
-     Returns: a list of description dictionaries that are meant to be converted into JSON. The description dictionaries have the following properties: id, name.
+     Returns: a tuple of a list of description dictionaries and the cursor of the next page, or None if this is the last page. 
+     The description dictionaries are meant to be converted into JSON and have the following properties: id, name.
+     
+     Raises:
+       ValueError: the sort, cursor or limit is invalid.
   """
+  if sort not in (SORT_BY_NAME, SORT_BY_LAST_MODIFIED):
+    raise ValueError('Unknown sort: %s' % sort)
+  limit = int(limit)
+  if limit < 1 or limit > MAX_PAGE_SIZE:
+    raise ValueError('The limit must be between 1 and %d.' % MAX_PAGE_SIZE)
+  
+  query = Thought.objects.filter(permission__user=user, permission__type__in=[permit_view, permit_modify]).distinct()
+  if sort == SORT_BY_NAME:
+    query = query.order_by('name', 'id')
+  else:
+    query = query.order_by('-last_modified', '-id')
+  
+  if cursor != None:
+    values = decode_cursor(cursor)
+    if len(values) != 2:
+      raise ValueError('The cursor is malformed.')
+    if sort == SORT_BY_NAME:
+      name, id = values
+      query = query.filter(Q(name__gt=name) | Q(name=name, id__gt=id))
+    else:
+      last_modified, id = parse_datetime(values[0]), values[1]
+      if last_modified == None:
+        raise ValueError('The cursor is malformed.')
+      query = query.filter(Q(last_modified__lt=last_modified) | Q(last_modified=last_modified, id__lt=id))
+  
+  # Read one more row than needed to find out if there is another page.
+  rows = list(query.values_list('id', 'name', 'last_modified')[:limit + 1])
   descriptions = []
-  viewable = get_view_permissions(user, None).get()
-  modifiable = get_modify_permissions(user, None).get()
-  queries = [viewable, modifiable]
-  for query in queries:
-    for permission in query:
-      description = {
-        'id': str(permission.thought.id),
-        'name': permission.thought.name,
-      }
-      descriptions.append(description)
-  return descriptions
+  for id, name, last_modified in rows[:limit]:
+    description = {
+      'id': str(id),
+      'name': name,
+    }
+    descriptions.append(description)
+  
+  next_cursor = None
+  if len(rows) > limit:
+    id, name, last_modified = rows[limit - 1]
+    if sort == SORT_BY_NAME:
+      next_cursor = encode_cursor([name, id])
+    else:
+      next_cursor = encode_cursor([last_modified.isoformat(), id])
+  return descriptions, next_cursor
   
 def user_can_view_thought_using_name(user, thought_name):
   """Checks if the user has permission to view the given thought. 
@@ -64,13 +145,8 @@ def user_can_view_thought_using_name(user, thought_name):
      
      Returns: true if the user can view the thought, false otherwise.
   """
-  thought = Thought.objects.filter(name = thought_name).get()
-  
-  viewable = get_view_permissions(user, thought)
-  if viewable.get() != None:
-    return True
-  modifiable = get_modify_permissions(user, thought)
-  return modifiable.get() != None
+  thought = get_thought_using_name(thought_name)
+  return thought != None and get_thought_rights(user, thought).view
 
 def user_can_view_thought_using_id(user, thought_id):
   """Checks if the user has permission to view the given thought. 
@@ -81,11 +157,7 @@ def user_can_view_thought_using_id(user, thought_id):
      
      Returns: true if the user can view the thought, false otherwise.
   """
-  thought = getThoughtUsingId(thought_id)
-  viewable = get_view_permissions(user, though)
-  if viewable.get() != None:
-    return True
-  return userCanModifyThoughtUsingId(user, thought_id)
+  return get_thought_rights(user, thought_id).view
 
 def userCanModifyThoughtUsingId(user, thought_id):
   """Checks if the user has permission to modify the given thought. 
@@ -96,9 +168,7 @@ def userCanModifyThoughtUsingId(user, thought_id):
      
      Returns: true if the user can modify the thought, false otherwise.
   """
-  thought = getThoughtUsingId(thought_id)
-  modifiable = get_modify_permissions(user, thought)
-  return modifiable.get() != None
+  return get_thought_rights(user, thought_id).modify
 
 def get_view_permissions(user, thought):
   return get_permission(user, thought, permit_view)
@@ -0,0 +1,46 @@
+"""
+A HTTP handler that streams an archive of all of a user's Thoughts.
+"""
+
+from django.views.generic import View
+from django.http import HttpResponse, HttpResponseBadRequest
+
+from think.thought import Names
+from think.archive import FORMATS, JSON_FORMAT, ZIP_ARCHIVE, ARCHIVE_CONTENT_TYPES, ARCHIVE_EXTENSIONS, ArchiveError, check_thought_archive, iter_thought_archive
+from think.views.thought import json_response, get_authenticated_user
+
+
+class ThoughtArchiveView(View):
+  """An interface to export every Thought a user can modify as a zip or tar archive."""
+  
+  def get(self, request, *args, **kwargs):
+    """Returns an archive of the user's thoughts, one file per thought.
+       
+       The format of the files is given by the 'format' parameter, json (the default) or opml, and the type of the archive by
+       the 'archive' parameter, zip (the default), tar or tgz. The archive is written as it is sent, so the response starts
+       at once however many thoughts there are. A zip archive holds at most 65535 thoughts of at most 4 GiB in all and is
+       ended early with an INCOMPLETE.txt file past that, so large accounts should be exported as tar archives.
+    """
+    format = self.request.GET.get(Names.format, JSON_FORMAT)
+    archive = self.request.GET.get(Names.archive, ZIP_ARCHIVE)
+    if format not in FORMATS or archive not in ARCHIVE_CONTENT_TYPES:
+      return HttpResponseBadRequest()
+    
+    body = {}
+    user = get_authenticated_user(self.request)
+    if user == None:
+      body['success'] = False
+      body['errorMsg'] = 'You are not logged in.'
+      return json_response(body)
+    # The error could not be reported once the archive has been started.
+    try:
+      check_thought_archive(user, archive)
+    except ArchiveError, e:
+      body['success'] = False
+      body['errorMsg'] = str(e)
+      return json_response(body, status=400)
+    
+    response = HttpResponse(iter_thought_archive(user, format, archive), content_type=ARCHIVE_CONTENT_TYPES[archive])
+    response['Content-Disposition'] = 'attachment; filename="thoughts-%s.%s"' % (user.id, ARCHIVE_EXTENSIONS[archive])
+    response['Cache-Control'] = 'private, no-cache'
+    return response
@@ -0,0 +1,66 @@
+"""
+A HTTP handler that exports Thoughts as images rendered on the server.
+"""
+
+import multiprocessing
+
+from django.conf import settings
+from django.views.generic import View
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotModified
+from django.utils.http import quote_etag
+
+from utilities import is_none_or_empty
+from think.thought import Names, get_thought_using_id
+from think.permission import get_thought_rights
+from think.render import CONTENT_TYPES, RENDER_TIMEOUT, RenderError, render_thought
+from think.views.thought import json_response, get_authenticated_user, thought_not_modified, set_thought_cache_headers
+
+
+class ExportThoughtView(View):
+  """An interface to export Thoughts as SVG or PNG images."""
+  
+  def get(self, request, *args, **kwargs):
+    """Returns an image of a specific Thought.
+       
+       If the image is rendered by a render process and is not ready within settings.EXPORT_TIMEOUT seconds, the response
+       is 503 with a Retry-After header; the image is cached once it is ready.
+    """
+    thought_id = self.request.GET.get(Names.id)
+    format = self.request.GET.get(Names.format)
+    if is_none_or_empty(thought_id) or not thought_id.isdigit() or format not in CONTENT_TYPES:
+      return HttpResponseBadRequest()
+    
+    body = {}
+    thought = get_thought_using_id(thought_id)
+    user = get_authenticated_user(self.request)
+    rights = None
+    if thought != None:
+      rights = get_thought_rights(user, thought, self.request)
+    if rights == None or not rights.view:
+      body['success'] = False
+      if user == None:
+        body['errorMsg'] = 'You are not logged in.'
+      else:
+        body['errorMsg'] = 'No such thought exists.'
+      return json_response(body)
+    
+    etag = quote_etag('%s-%s-%s' % (thought.id, thought.revision, format))
+    if thought_not_modified(self.request, thought, etag):
+      response = HttpResponseNotModified()
+    else:
+      try:
+        data = render_thought(thought, format)
+      except RenderError, e:
+        body['success'] = False
+        body['errorMsg'] = str(e)
+        return json_response(body, status=501)
+      except multiprocessing.TimeoutError, e:
+        body['success'] = False
+        body['errorMsg'] = 'The thought is still being rendered; try again shortly.'
+        response = json_response(body, status=503)
+        response['Retry-After'] = str(getattr(settings, 'EXPORT_TIMEOUT', RENDER_TIMEOUT))
+        return response
+      response = HttpResponse(data, content_type=CONTENT_TYPES[format])
+      response['Content-Disposition'] = 'inline; filename="thought-%s.%s"' % (thought.id, format)
+    set_thought_cache_headers(response, thought, etag, rights.public)
+    return response
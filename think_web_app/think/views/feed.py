@@ -0,0 +1,44 @@
+"""
+A HTTP handler that returns the changes made to a Thought since a revision without waiting for them.
+
+Clients that cannot reach the feed server of think.feedserver can poll this instead of reloading the whole thought.
+"""
+
+from django.views.generic import View
+from django.http import HttpResponse, HttpResponseBadRequest
+
+from utilities import is_none_or_empty
+from think.thought import Names, get_thought_using_id
+from think.permission import get_thought_rights
+from think.feed import RELOAD_RECORD, get_encoded_changes
+from think.views.thought import json_response, json_content_type, content_type_name, get_authenticated_user
+
+
+class ThoughtChangesView(View):
+  """An interface to get the changes made to a Thought."""
+  
+  def get(self, request, *args, **kwargs):
+    """Returns {"changes": [...]} with a {"revision", "operations"} record for each revision after 'since', or
+       {"reload": true} if the client must reload the thought.
+    """
+    thought_id = self.request.GET.get(Names.id)
+    since = self.request.GET.get(Names.since)
+    if is_none_or_empty(thought_id) or not thought_id.isdigit() or is_none_or_empty(since) or not since.isdigit():
+      return HttpResponseBadRequest()
+    
+    thought = get_thought_using_id(thought_id)
+    if thought == None or not get_thought_rights(get_authenticated_user(self.request), thought, self.request).view:
+      body = {}
+      body['success'] = False
+      body['errorMsg'] = 'No such thought exists.'
+      return json_response(body)
+    
+    changes = get_encoded_changes(thought.id, int(since), thought.revision)
+    if changes == None:
+      content = RELOAD_RECORD
+    else:
+      content = '{"changes": [%s]}' % ', '.join(encoded for revision, encoded in changes)
+    response = HttpResponse(content)
+    response[content_type_name] = json_content_type
+    response['Cache-Control'] = 'no-cache'
+    return response
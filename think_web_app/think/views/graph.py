@@ -0,0 +1,98 @@
+"""
+A HTTP handler for graph analytics of Thoughts.
+"""
+
+from django.views.generic import View
+from django.http import HttpResponseBadRequest
+
+from utilities import is_none_or_empty
+from think.thought import Names, get_thought_using_id
+from think.permission import get_thought_rights
+from think.graph import DEFAULT_HUB_LIMIT, GraphError, get_cached_graph
+from think.views.thought import json_response, get_authenticated_user
+
+
+# Constants
+MAX_HUB_LIMIT = 1000
+
+
+class Metrics:
+  """An emumeration of the metrics of a Thought's graph."""
+  
+  degree = 'degree'
+  components = 'components'
+  path = 'path'
+  hubs = 'hubs'
+
+
+class ThoughtGraphView(View):
+  """An interface to analyse the graph of nodes and connections of a Thought."""
+  
+  def get(self, request, *args, **kwargs):
+    """Returns a metric of a specific Thought.
+       
+       degree: the number of connections of every node, as parallel 'nodeIds' and 'degrees' lists.
+       components: 'components', a list of lists of the node ids of each connected component, largest first.
+       path: 'path', a list of the node ids of a shortest path between the nodes 'from' and 'to', or null.
+       hubs: 'hubs', a list of the ids and degrees of the 'limit' most connected nodes.
+       
+       Node ids are strings, as in every other thought response.
+    """
+    thought_id = self.request.GET.get(Names.id)
+    metric = self.request.GET.get(Names.metric)
+    if is_none_or_empty(thought_id) or not thought_id.isdigit():
+      return HttpResponseBadRequest()
+    
+    body = {}
+    thought = get_thought_using_id(thought_id)
+    user = get_authenticated_user(self.request)
+    rights = None
+    if thought != None:
+      rights = get_thought_rights(user, thought, self.request)
+    if rights == None or not rights.view:
+      body['success'] = False
+      if user == None:
+        body['errorMsg'] = 'You are not logged in.'
+      else:
+        body['errorMsg'] = 'No such thought exists.'
+      return json_response(body)
+    
+    try:
+      graph = get_cached_graph(thought)
+    except GraphError, e:
+      body['success'] = False
+      body['errorMsg'] = str(e)
+      return json_response(body, status=501)
+    node_ids = [str(node_id) for node_id in graph.node_ids.tolist()]
+    
+    if metric == Metrics.degree:
+      body[Names.node_ids] = node_ids
+      body['degrees'] = graph.get_degrees().tolist()
+    elif metric == Metrics.components:
+      components = {}
+      for node_id, label in zip(node_ids, graph.get_connected_components().tolist()):
+        components.setdefault(label, []).append(node_id)
+      body['components'] = sorted(components.values(), key=len, reverse=True)
+    elif metric == Metrics.path:
+      try:
+        source = graph.get_index(int(self.request.GET[Names.source]))
+        target = graph.get_index(int(self.request.GET[Names.target]))
+      except (KeyError, ValueError, GraphError), e:
+        return HttpResponseBadRequest()
+      path = graph.get_shortest_path(source, target)
+      body['path'] = [node_ids[index] for index in path] if path != None else None
+    elif metric == Metrics.hubs:
+      try:
+        limit = int(self.request.GET.get(Names.limit, DEFAULT_HUB_LIMIT))
+      except ValueError, e:
+        return HttpResponseBadRequest()
+      if limit < 1 or limit > MAX_HUB_LIMIT:
+        return HttpResponseBadRequest()
+      degrees = graph.get_degrees()
+      body['hubs'] = [{'id': node_ids[index], 'degree': int(degrees[index])} for index in graph.get_hubs(limit)]
+    else:
+      return HttpResponseBadRequest()
+    
+    body['success'] = True
+    body[Names.revision] = thought.revision
+    return json_response(body)
@@ -0,0 +1,65 @@
+"""
+A HTTP handler for the history of Thoughts.
+"""
+
+from django.views.generic import View
+from django.http import HttpResponseBadRequest
+
+from utilities import is_none_or_empty
+from think.thought import Names, get_thought_using_id
+from think.permission import get_thought_rights
+from think.journal import DEFAULT_HISTORY_LIMIT, HistoryError, get_thought_at_revision, get_thought_history
+from think.views.thought import json_response, get_authenticated_user
+
+
+class ThoughtHistoryView(View):
+  """An interface to read the past revisions of a Thought."""
+  
+  def get(self, request, *args, **kwargs):
+    """Returns the history of a specific Thought.
+       
+       With a 'revision' parameter, 'thought' is the thought as it was at that revision, in the form ThoughtView.get returns
+       it; saving it with ThoughtView.put undoes the changes made since. Otherwise 'changes' is a page of the changes made to
+       the thought, the most recent first, before the revision 'before' if it is given.
+    """
+    thought_id = self.request.GET.get(Names.id)
+    if is_none_or_empty(thought_id) or not thought_id.isdigit():
+      return HttpResponseBadRequest()
+    try:
+      revision = self.request.GET.get(Names.revision)
+      revision = int(revision) if revision != None else None
+      before = self.request.GET.get(Names.before)
+      before = int(before) if before != None else None
+    except ValueError, e:
+      return HttpResponseBadRequest()
+    
+    body = {}
+    thought = get_thought_using_id(thought_id)
+    user = get_authenticated_user(self.request)
+    rights = None
+    if thought != None:
+      rights = get_thought_rights(user, thought, self.request)
+    if rights == None or not rights.view:
+      body['success'] = False
+      if user == None:
+        body['errorMsg'] = 'You are not logged in.'
+      else:
+        body['errorMsg'] = 'No such thought exists.'
+      return json_response(body)
+    
+    if revision != None:
+      try:
+        body[Names.thought] = get_thought_at_revision(thought, revision).to_dict(thought.id)
+      except HistoryError, e:
+        body['success'] = False
+        body['errorMsg'] = str(e)
+        return json_response(body, status=404)
+    else:
+      try:
+        body['changes'] = get_thought_history(thought, before, self.request.GET.get(Names.limit, DEFAULT_HISTORY_LIMIT))
+      except ValueError, e:
+        return HttpResponseBadRequest()
+    
+    body['success'] = True
+    body[Names.revision] = thought.revision
+    return json_response(body)
@@ -0,0 +1,51 @@
+"""
+A HTTP handler that imports mind map files as Thoughts.
+"""
+
+from django.views.generic import View
+from django.http import HttpResponseBadRequest
+
+from think.thought import Names, get_thought_id
+from think.importer import MapImportError, get_file_format, import_thought
+from think.views.thought import json_response, get_authenticated_user
+
+
+# Constants
+FILE_PARAMETER = 'file'
+
+
+class ImportThoughtView(View):
+  """An interface to import FreeMind, OPML and Think JSON files."""
+  
+  def post(self, request, *args, **kwargs):
+    """Imports the file uploaded as 'file' as a new thought of the user.
+       
+       The format is given by the 'format' parameter, or else by the extension of the file's name. The file is read as it is
+       parsed, so large uploads, which Django spools to a temporary file, are not loaded into memory.
+    """
+    upload = self.request.FILES.get(FILE_PARAMETER)
+    if upload == None:
+      return HttpResponseBadRequest()
+    format = self.request.GET.get(Names.format) or get_file_format(upload.name)
+    if format == None:
+      return HttpResponseBadRequest()
+    
+    body = {}
+    user = get_authenticated_user(self.request)
+    if user == None:
+      body['success'] = False
+      body['errorMsg'] = 'You are not logged in.'
+      return json_response(body)
+    
+    try:
+      thought, nodes, connections = import_thought(upload, format, user, upload.name.rsplit('.', 1)[0])
+    except MapImportError, e:
+      body['success'] = False
+      body['errorMsg'] = str(e)
+      return json_response(body, status=400)
+    
+    body['success'] = True
+    body['id'] = get_thought_id(thought)
+    body[Names.nodes] = nodes
+    body[Names.connections] = connections
+    return json_response(body)
@@ -0,0 +1,66 @@
+"""
+A HTTP handler that lays out the nodes of Thoughts on the server.
+"""
+
+from django.views.generic import View
+from django.http import HttpResponseBadRequest
+
+from utilities import is_none_or_empty
+from think.thought import Names, get_thought_using_id, get_thought_id, RevisionConflictError
+from think.permission import is_user_permitted_to_modify_thought
+from think.graph import GraphError
+from think.layout import DEFAULT_ITERATIONS, MAX_ITERATIONS, DEFAULT_SPACING, layout_thought
+from think.views.thought import json_response, get_authenticated_user, revision_conflict_response
+
+
+class ThoughtLayoutView(View):
+  """An interface to automatically lay out the nodes of a Thought."""
+  
+  def post(self, request, *args, **kwargs):
+    """Lays out a specific Thought and saves the new positions of its nodes.
+       
+       The optional 'iterations' and 'spacing' parameters set the number of layout iterations and the ideal length of a
+       connection in pixels. The response contains the new revision and the moveNode operations that were applied, so the
+       client can apply them rather than reloading the thought.
+    """
+    thought_id = self.request.GET.get(Names.id)
+    if is_none_or_empty(thought_id) or not thought_id.isdigit():
+      return HttpResponseBadRequest()
+    try:
+      iterations = int(self.request.GET.get(Names.iterations, DEFAULT_ITERATIONS))
+      spacing = int(self.request.GET.get(Names.spacing, DEFAULT_SPACING))
+    except ValueError, e:
+      return HttpResponseBadRequest()
+    if iterations < 1 or iterations > MAX_ITERATIONS or spacing < 1:
+      return HttpResponseBadRequest()
+    
+    body = {}
+    user = get_authenticated_user(self.request)
+    if user == None:
+      body['success'] = False
+      body['errorMsg'] = 'You are not logged in.'
+      return json_response(body)
+    
+    thought = get_thought_using_id(thought_id)
+    if thought == None:
+      return HttpResponseBadRequest()
+    
+    if not is_user_permitted_to_modify_thought(user, thought):
+      body['success'] = False
+      body['errorMsg'] = 'You are not permmited to modify the thought.'
+      return json_response(body)
+    
+    try:
+      operations = layout_thought(thought, iterations, spacing, user)
+    except RevisionConflictError, e:
+      return revision_conflict_response(thought, e.expected_revision)
+    except GraphError, e:
+      body['success'] = False
+      body['errorMsg'] = str(e)
+      return json_response(body, status=501)
+    
+    body['success'] = True
+    body['id'] = get_thought_id(thought)
+    body[Names.revision] = thought.revision
+    body[Names.operations] = operations
+    return json_response(body)
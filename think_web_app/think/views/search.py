@@ -0,0 +1,35 @@
+"""
+A HTTP handler that searches the text of the nodes of Thoughts.
+"""
+
+from django.views.generic import View
+from django.http import HttpResponseBadRequest
+
+from utilities import is_none_or_empty
+from think.thought import Names
+from think.search import DEFAULT_RESULT_LIMIT, search_nodes
+from think.views.thought import json_response, get_authenticated_user
+
+
+class SearchView(View):
+  """An interface to search the nodes of the Thoughts a user may view."""
+  
+  def get(self, request, *args, **kwargs):
+    """Returns the nodes whose text contains every word of the 'q' parameter, best first.
+       
+       The response contains 'results', a list of dictionaries of the thoughtId, nodeId and a snippet of the text of each node.
+       Anonymous users only search public thoughts.
+    """
+    query = self.request.GET.get(Names.query)
+    if is_none_or_empty(query):
+      return HttpResponseBadRequest()
+    
+    try:
+      results = search_nodes(get_authenticated_user(self.request), query, self.request.GET.get(Names.limit, DEFAULT_RESULT_LIMIT))
+    except ValueError, e:
+      return HttpResponseBadRequest()
+    
+    body = {}
+    body['success'] = True
+    body['results'] = results
+    return json_response(body)
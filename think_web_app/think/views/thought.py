@@ -6,24 +6,208 @@ A collection of HTTP handlers that provide the Thought part of a RESTful API.
 
 
 import os
+import re
 import logging
+import calendar
 
 from django.views.generic import View
 from django.utils import simplejson
-from django.http import HttpResponse
+from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotModified
+from django.utils.http import http_date, parse_http_date_safe, parse_etags, quote_etag
 
 from utilities import get_url_file_path, is_none_or_empty
 from think.models import * # Get the constants
 import think.json
-from think.thought import Names, thought_viewable_by_all_using_name, get_thought_using_name, get_thought_using_id, thought_to_dict
-from think.permission import get_permission_type, is_user_permitted_to_modify_thought
-from think.user import user_can_view_thought_using_name, user_can_view_thought_using_id
+from think.thought import Names, thought_viewable_by_all_using_name, thought_viewable_by_all_using_id, get_thought_using_name, get_thought_using_id, thought_to_dict, createAndSaveThought, updateThought, patchThought, get_thought_id, get_encoded_thought, iter_encoded_thought, get_thought_properties, RevisionConflictError, get_thought_operations_since, delete_thought_using_id
+from think.permission import get_permission_type, get_thought_rights, is_user_permitted_to_modify_thought
+from think.user import user_can_view_thought_using_name, user_can_view_thought_using_id, get_thought_descriptions_for_user, SORT_BY_NAME, DEFAULT_PAGE_SIZE
+from think.spatial import parse_box, get_thought_nodes_in_box
+from think.node import node_values_to_dict
+from think.connection import connection_ids_to_dict
+from think.columnar import COLUMNAR_JSON_CONTENT_TYPE, COLUMNAR_BINARY_CONTENT_TYPE, encode_columnar_json, encode_columnar_binary
 
 
 # Constants
 content_type_name = 'Content-Type'
 json_content_type = 'application/json; charset=utf-8'
 main_html_file = 'static/think.html'
+# An unquoted ETag made by get_thought_etag: the thought id, the revision, the permission and the encoding.
+thought_etag_pattern = re.compile(r'^(\d+)-(\d+)-(%s|%s)(-columnar|-columnar-json)?$' % (permit_modify, permit_view))
+
+def json_response(body, status=200):
+  """Creates a HTTP response containing the body encoded as JSON.
+     
+     Args:
+       body: a dictionary.
+       status: the HTTP status code.
+     
+     Returns: a HttpResponse.
+  """
+  response = HttpResponse(simplejson.JSONEncoder().encode(body), status=status)
+  response[content_type_name] = json_content_type
+  return response
+
+def get_expected_revision(request, args, thought_id):
+  """Gets the revision of the thought that a save is conditional on.
+     
+     The revision is taken from the If-Match header, which holds an ETag sent by ThoughtView.get, or else from the
+     expected_revision argument.
+     
+     Args:
+       request: the HTTP request.
+       args: the decoded JSON body of the request.
+       thought_id: the id of the thought being saved, or None if it is new.
+     
+     Returns: the expected revision, or None if the save is unconditional.
+     
+     Raises:
+       ValueError: the precondition is malformed, holds more than one ETag, or is an ETag of another thought.
+  """
+  if_match = request.META.get('HTTP_IF_MATCH')
+  if if_match != None:
+    etags = parse_etags(if_match)
+    if '*' in etags:
+      return None
+    match = thought_etag_pattern.match(etags[0]) if len(etags) == 1 else None
+    if match == None or thought_id == None or match.group(1) != str(thought_id):
+      raise ValueError('The If-Match header is not an ETag of the thought: %s' % if_match)
+    return int(match.group(2))
+  if args.get(Names.expected_revision) != None:
+    return int(args[Names.expected_revision])
+  return None
+
+def revision_conflict_response(thought, expected_revision):
+  """Creates a 409 Conflict response for a save that was made to an old revision of a thought.
+     
+     The response contains the operations applied since the expected revision so the client can rebase its edits on them. If
+     some of those changes were not recorded as operations, the whole thought is sent instead.
+     
+     Args:
+       thought: the thought.
+       expected_revision: the revision the client expected the thought to be at.
+     
+     Returns: a HttpResponse.
+  """
+  thought = get_thought_using_id(thought.id)
+  body = {
+    'success': False,
+    'errorMsg': 'The thought has been modified since it was loaded.',
+    Names.revision: thought.revision,
+  }
+  operations = None
+  if expected_revision != None and expected_revision <= thought.revision:
+    operations = get_thought_operations_since(thought, expected_revision)
+  if operations != None:
+    body[Names.operations] = operations
+  else:
+    body[Names.thought] = thought_to_dict(thought)
+  return json_response(body, status=409)
+
+def encoded_thought_response(encoded_thought, modifiable):
+  """Creates a HTTP response for a successful request of a thought.
+     
+     Args:
+       encoded_thought: the thought encoded as a JSON object by think.thought.get_encoded_thought.
+       modifiable: whether the user can modify the thought.
+     
+     Returns: a HttpResponse.
+  """
+  # The encoded thought is shared by all users, so the modifiable property is appended to it rather than decoding it.
+  encoded_thought = encoded_thought[:-1] + ', "%s": %s}' % (Names.modifiable, simplejson.dumps(modifiable))
+  response = HttpResponse('{"success": true, "%s": %s}' % (Names.thought, encoded_thought))
+  response[content_type_name] = json_content_type
+  return response
+
+def streamed_thought_response_content(thought, modifiable):
+  """Encodes the body of a response for a successful request of a thought piece by piece.
+     
+     Args:
+       thought: the thought.
+       modifiable: whether the user can modify the thought.
+     
+     Returns: a generator of strings. The body is identical to the one created by encoded_thought_response.
+  """
+  yield '{"success": true, "%s": ' % Names.thought
+  for piece in iter_encoded_thought(thought, {Names.modifiable: modifiable}):
+    yield piece
+  yield '}'
+
+def get_thought_format(request):
+  """Chooses the encoding of a thought response from the Accept header of the request.
+     
+     Args:
+       request: the HTTP request.
+     
+     Returns: the content type of the encoding; json_content_type or one of the columnar content types in think.columnar.
+  """
+  accept = request.META.get('HTTP_ACCEPT', '')
+  for content_type in [COLUMNAR_BINARY_CONTENT_TYPE, COLUMNAR_JSON_CONTENT_TYPE]:
+    if content_type in [media_range.split(';')[0].strip() for media_range in accept.split(',')]:
+      return content_type
+  return json_content_type
+
+def get_thought_etag(thought, modifiable, format=json_content_type):
+  """Gets the strong ETag of a thought response.
+     
+     Args:
+       thought: the thought.
+       modifiable: whether the user can modify the thought, which is part of the response.
+       format: the content type of the response.
+     
+     Returns: a quoted ETag.
+  """
+  etag = '%s-%s-%s' % (thought.id, thought.revision, permit_modify if modifiable else permit_view)
+  if format == COLUMNAR_JSON_CONTENT_TYPE:
+    etag += '-columnar-json'
+  elif format == COLUMNAR_BINARY_CONTENT_TYPE:
+    etag += '-columnar'
+  return quote_etag(etag)
+
+def thought_not_modified(request, thought, etag):
+  """Checks the If-None-Match and If-Modified-Since headers of a request for a thought.
+     
+     Args:
+       request: the HTTP request.
+       thought: the thought.
+       etag: the current ETag of the thought response.
+     
+     Returns: true if the client's copy of the thought is current, false otherwise.
+  """
+  if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+  if if_none_match != None:
+    etags = parse_etags(if_none_match)
+    return '*' in etags or etag in [quote_etag(e) for e in etags]
+  if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+  if if_modified_since != None:
+    return int(calendar.timegm(thought.last_modified.utctimetuple())) <= if_modified_since
+  return False
+
+def set_thought_cache_headers(response, thought, etag, shared):
+  """Sets the headers that let clients and caches revalidate a thought instead of downloading it again.
+     
+     Args:
+       response: the HTTP response.
+       thought: the thought.
+       etag: the ETag of the thought response.
+       shared: whether the response is the same for everyone, so shared caches may store it.
+  """
+  response['ETag'] = etag
+  response['Last-Modified'] = http_date(calendar.timegm(thought.last_modified.utctimetuple()))
+  response['Cache-Control'] = '%s, max-age=0, must-revalidate' % ('public' if shared else 'private')
+  response['Vary'] = 'Accept, Cookie'
+
+def get_authenticated_user(request):
+  """Gets the user that is logged in.
+     
+     Args:
+       request: the HTTP request.
+     
+     Returns: the user, or None if no user is logged in.
+  """
+  user = getattr(request, 'user', None)
+  if user == None or not user.is_authenticated():
+    return None
+  return user
 
 class PublicThoughtView(View):
   """An interface to make Thoughts public or private."""
@@ -111,10 +295,13 @@ class ThoughtView(View):
   """Serves Thoughts via a RESTful API.
   """
   
+  http_method_names = View.http_method_names + ['patch']
+  
   def get(self, request, *args, **kwargs):
     """Simply returns a specific Thought.
     """
     thought_id = self.request.GET[Names.id] if Names.id in self.request.GET else None
+    bbox = self.request.GET[Names.bbox] if Names.bbox in self.request.GET else None
     thought_name = self.request.GET[Names.name] if Names.name in self.request.GET else None
     collection = self.request.GET[Names.collection] if Names.collection in self.request.GET else None
     type = self.request.GET[Names.type] if Names.type in self.request.GET else None
@@ -126,90 +313,94 @@ class ThoughtView(View):
       self.error(400) # Bad Request
       return
     
+    box = None
+    if not is_none_or_empty(bbox):
+      try:
+        box = parse_box(bbox)
+      except ValueError, e:
+        return HttpResponseBadRequest()
+    
     body = {} 
-    session_id = "fake_session_id_to_avoid_authentication_for_the_time_being" #get_session_id(self.request)
        
     if not is_none_or_empty(collection):
       # Get a collection for the user.
-      # Validate session id.
-      if is_none_or_empty(session_id):
-        body['success'] = False
-        body['errorMsg'] = 'You are not logged in.'
-        self.response.out.write(simplejson.JSONEncoder().encode(body))
-        return
-      # Authenticate User.
-      user = "fake user" #authenticate_user_session(session_id)
+      user = get_authenticated_user(self.request)
       if user == None:
         body['success'] = False
-        body['errorMsg'] = 'Your session has expired.'
-        self.response.out.write(simplejson.JSONEncoder().encode(body))
-        return
+        body['errorMsg'] = 'You are not logged in.'
+        return json_response(body)
       # Check which type of collection.
       if collection == Names.all:
-        # Get collection all.
-        body['thoughtDescriptions'] = get_thought_descriptions_for_user(user)
+        # Get a page of collection all.
+        try:
+          descriptions, next_cursor = get_thought_descriptions_for_user(user,
+            sort=self.request.GET.get(Names.sort, SORT_BY_NAME),
+            cursor=self.request.GET.get(Names.cursor) or None,
+            limit=self.request.GET.get(Names.limit, DEFAULT_PAGE_SIZE))
+        except ValueError, e:
+          return HttpResponseBadRequest()
+        body['thoughtDescriptions'] = descriptions
+        body[Names.next_cursor] = next_cursor
         body['success'] = True
+        return json_response(body)
       else:
-        self.error(400) # Bad Request
-        return
+        return HttpResponseBadRequest()
 
     elif not is_none_or_empty(thought_id) or not is_none_or_empty(thought_name):
-      thought_viewable = None
-      user_can_view_thought = None
-      get_thought = None
-      identifier = None
-      
       # Take a generic approach for id and name.
       if not is_none_or_empty(thought_id):
-        thought_viewable = thought_viewable_by_all_using_id
-        user_can_view_thought = user_can_view_thought_using_id
-        get_thought = get_thought_using_id
-        identifier = thought_id
-      elif not is_none_or_empty(thought_name):
-        thought_viewable = thought_viewable_by_all_using_name
-        user_can_view_thought = user_can_view_thought_using_name
-        get_thought = get_thought_using_name
-        identifier = thought_name
+        thought = get_thought_using_id(thought_id)
+      else:
+        thought = get_thought_using_name(thought_name)
       
       # Get the user info.
-      user = None
-      if not is_none_or_empty(session_id):
-	#TODO: fix this up
-        user = None #authenticate_user_session(session_id)
-
-      if not thought_viewable(identifier):
-        # Check session.
-        if is_none_or_empty(session_id):
-          body['success'] = False
-          body['errorMsg'] = 'You are not logged in.'
-          self.response.out.write(simplejson.JSONEncoder().encode(body))
-          return
-        
+      user = get_authenticated_user(self.request)
+      
+      # Resolve all of the user's rights to the thought at once.
+      rights = None
+      if thought != None:
+        rights = get_thought_rights(user, thought, self.request)
+      if rights == None or not rights.view:
+        body['success'] = False
         if user == None:
-          body['success'] = False
-          body['errorMsg'] = 'Your session has expired.'
-          self.response.out.write(simplejson.JSONEncoder().encode(body))
-          return
-        
-        # Check that the user can view the thought.
-        if not user_can_view_thought(user, identifier):
-          body['success'] = False
+          body['errorMsg'] = 'You are not logged in.'
+        else:
           body['errorMsg'] = 'No such thought exists.'
-          self.response.out.write(simplejson.JSONEncoder().encode(body))
-          return
-        # The user can view the thought at this point in the code.
-      
-      thought = get_thought(identifier)
-      if thought == None:
-        self.error(400)
-        return
+        return json_response(body)
+      # The user can view the thought at this point in the code.
+      is_public = rights.public
+      modifiable = rights.modify
       
-      body['success'] = True
-      body[Names.thought] = thought_to_dict(thought)
-      # Move the following lines into the function above.
-      permissionType = get_permission_type(thought, user)
-      body[Names.thought][Names.modifiable] = permissionType == permit_modify
-      body[Names.thought][Names.is_public] = thought_viewable_by_all_using_name(thought.name)
+      # Answer conditional requests before the nodes and connections are loaded.
+      format = get_thought_format(self.request)
+      etag = get_thought_etag(thought, modifiable, format)
+      if thought_not_modified(self.request, thought, etag):
+        response = HttpResponseNotModified()
+      elif box != None:
+        # Only send the part of the thought inside the client's viewport.
+        nodes, connections = get_thought_nodes_in_box(thought, box)
+        data = get_thought_properties(thought)
+        data[Names.modifiable] = modifiable
+        data[Names.bbox] = list(box)
+        data['nodes'] = [node_values_to_dict(*values) for values in nodes]
+        data['connections'] = [connection_ids_to_dict(*values) for values in connections]
+        response = json_response({'success': True, Names.thought: data})
+      elif format != json_content_type:
+        properties = get_thought_properties(thought)
+        properties[Names.modifiable] = modifiable
+        if format == COLUMNAR_JSON_CONTENT_TYPE:
+          response = HttpResponse('{"success": true, "%s": %s}' % (Names.thought, encode_columnar_json(thought, properties)))
+        else:
+          response = HttpResponse(encode_columnar_binary(thought, properties))
+        response[content_type_name] = format
+      elif self.request.GET.get(Names.stream):
+        # Stream very large thoughts instead of encoding them in memory. Streamed thoughts bypass the thought cache.
+        response = HttpResponse(streamed_thought_response_content(thought, modifiable))
+        response[content_type_name] = json_content_type
+      else:
+        response = encoded_thought_response(get_encoded_thought(thought), modifiable)
+      set_thought_cache_headers(response, thought, etag, is_public and not modifiable)
+      return response
     else:
       raise "LogicError"
         
@@ -220,63 +411,103 @@ class ThoughtView(View):
   def post(self, *args, **kwargs):
     """Creates a thought based on the input in the POST request.
     """
-    self.create_or_update_thought()
+    return self.create_or_update_thought()
   
   def put(self, *args, **kwargs):
     """Creates or updates a thought based on the input in the PUT request.
+       
+       An update may be made conditional on the revision the client last loaded; see get_expected_revision.
     """
-    self.create_or_update_thought()
+    return self.create_or_update_thought()
+  
+  def patch(self, *args, **kwargs):
+    """Applies a list of operations to a saved thought, so that only the edits made since the last save are uploaded.
+       
+       The request body is a JSON dictionary containing the id of the thought and a list of operations. See think.thought.patchThought.
+       The patch may be made conditional on the revision the client last loaded; see get_expected_revision.
+    """
+    try:
+      args = simplejson.loads(self.request.body)
+      thought_id = args[Names.id]
+      operations = args[Names.operations]
+      expected_revision = get_expected_revision(self.request, args, thought_id)
+    except (ValueError, KeyError, TypeError), e:
+      return HttpResponseBadRequest()
+    
+    body = {}
+    user = get_authenticated_user(self.request)
+    if user == None:
+      body['success'] = False
+      body['errorMsg'] = 'You are not logged in.'
+      return json_response(body)
+    
+    thought = get_thought_using_id(thought_id)
+    if thought == None:
+      return HttpResponseBadRequest()
+    
+    if not is_user_permitted_to_modify_thought(user, thought):
+      body['success'] = False
+      body['errorMsg'] = 'You are not permmited to modify the thought.'
+      return json_response(body)
+    
+    try:
+      node_ids = patchThought(thought, operations, user, expected_revision)
+    except RevisionConflictError, e:
+      return revision_conflict_response(thought, e.expected_revision)
+    except (ValueError, KeyError, TypeError), e:
+      return HttpResponseBadRequest()
+    
+    body['success'] = True
+    body['id'] = get_thought_id(thought)
+    body[Names.revision] = thought.revision
+    body[Names.node_ids] = node_ids
+    return json_response(body)
   
   def delete(self, *args, **kwargs):
-    """Deletes a thought based on the input in the PUT request.
+    """Deletes a thought based on the parameters of the DELETE request.
     """
-    thought_id = self.request.get(Names.id)
+    thought_id = self.request.GET.get(Names.id)
+    if is_none_or_empty(thought_id) or not thought_id.isdigit():
+      return HttpResponseBadRequest()
+    asynchronous = self.request.GET.get(Names.asynchronous) in ('1', 'true')
     body = {} 
-    session_id = get_session_id(self.request)
     
     # Get the user info.
-    user = authenticate_user_session(session_id)
+    user = get_authenticated_user(self.request)
     if user == None:
       body['success'] = False
-      body['errorMsg'] = 'Your session has expired.'
-      self.response.out.write(simplejson.JSONEncoder().encode(body))
-      return
+      body['errorMsg'] = 'You are not logged in.'
+      return json_response(body)
     
-    if user_can_modify_thought_using_id(user, thought_id):
-      deleteThoughtUsingId(thought_id)
+    if get_thought_rights(user, thought_id, self.request).modify:
+      delete_thought_using_id(thought_id, asynchronous=asynchronous)
       body['success'] = True
-      self.response.out.write(simplejson.JSONEncoder().encode(body))
-      return
+      return json_response(body)
     else:
       body['success'] = False
       body['errorMsg'] = 'You do not have permission to delete this thought.'
-      self.response.out.write(simplejson.JSONEncoder().encode(body))
-      return  
+      return json_response(body)
     
   def create_or_update_thought(self):
     """Creates or updates a thought based on the HTTP request.
     """
-    args = simplejson.loads(self.request.body)
-    json_thought = args[Names.thought] # This is not a JSON string but rather a dictionary.
+    try:
+      args = simplejson.loads(self.request.body)
+      json_thought = args[Names.thought] # This is not a JSON string but rather a dictionary.
+      expected_revision = get_expected_revision(self.request, args, json_thought.get(Names.id))
+    except (ValueError, KeyError, TypeError), e:
+      return HttpResponseBadRequest()
     
     body = {
       'success': None,
       'errorMsg': None
     }
     
-    session_id = get_session_id(self.request)
-    if is_none_or_empty(session_id):
-      body['success'] = False
-      body['errorMsg'] = 'You are not logged in.'
-      self.response.out.write(simplejson.JSONEncoder().encode(body))
-      return
-
-    user = authenticate_user_session(session_id)
+    user = get_authenticated_user(self.request)
     if user == None:
       body['success'] = False
-      body['errorMsg'] = 'Your session has expired.'
-      self.response.out.write(simplejson.JSONEncoder().encode(body))
-      return
+      body['errorMsg'] = 'You are not logged in.'
+      return json_response(body)
       
     thought_has_been_saved = False
     thought = None
@@ -289,25 +520,25 @@ class ThoughtView(View):
         thought_has_been_saved = True
     
     if not thought_has_been_saved:
-      id = create_and_save_thought(json_thought, user)
+      id = createAndSaveThought(json_thought, user)
         
-      self.response.headers[content_type_name] = json_content_type
       body['success'] = True
       body['id'] = id
-      self.response.out.write(simplejson.JSONEncoder().encode(body))
+      body[Names.revision] = 0
+      return json_response(body)
     else:
       # Check that the user has permission to update the thought
       if not is_user_permitted_to_modify_thought(user, thought):
         body['success'] = False
         body['errorMsg'] = 'You are not permmited to modify the thought.'
-        self.response.out.write(simplejson.JSONEncoder().encode(body))
-        return
-        
-      update_thought(thought, json_thought, user)
+        return json_response(body)
+      
+      try:
+        updateThought(thought, json_thought, user, expected_revision)
+      except RevisionConflictError, e:
+        return revision_conflict_response(thought, e.expected_revision)
       
-      self.response.headers[content_type_name] = json_content_type
       body['success'] = True
-      body['id'] = get_thoughtId(thought)
-      self.response.out.write(simplejson.JSONEncoder().encode(body))
-
-  
+      body['id'] = get_thought_id(thought)
+      body[Names.revision] = thought.revision
+      return json_response(body)
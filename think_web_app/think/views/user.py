@@ -3,6 +3,7 @@ A collection of HTTP handlers that provide handle requests related to user sessi
 """
 
 from django.contrib.auth import logout
+from django.http import HttpResponse
 
 
 def log_out(request):
@@ -0,0 +1,16 @@
+"""
+The URLconf of the admin site, included by think_web_app.urls. The admin modules of the installed apps are discovered when it
+is imported.
+"""
+
+from django.conf.urls import patterns, include, url
+
+from django.contrib import admin
+admin.autodiscover()
+
+urlpatterns = patterns('',
+    # Uncomment the admin/doc line below to enable admin documentation:
+    # url(r'^doc/', include('django.contrib.admindocs.urls')),
+
+    url(r'', include(admin.site.urls)),
+)
@@ -25,6 +25,42 @@ DATABASES = {
     }
 }
 
+# The 'thoughts' cache holds encoded Thoughts keyed by revision (see think/cache.py). To share it between processes, replace
+# its BACKEND and LOCATION with a shared backend, e.g. 'django.core.cache.backends.memcached.MemcachedCache' and '127.0.0.1:11211'.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'thoughts': {
+        'BACKEND': 'think.cache.LRUCache',
+        'LOCATION': 'thoughts',
+        'TIMEOUT': 24 * 60 * 60,
+        'OPTIONS': {
+            'MAX_ENTRIES': 500,
+        },
+    },
+}
+
+# Each process keeps every Theme in memory (see think/theme.py). When the 'thoughts' cache is shared, set this to the number
+# of seconds a process may use its themes after another process has modified them.
+THEME_REGISTRY_CHECK_INTERVAL = None
+
+# The number of processes each worker starts to render exported thoughts (see think/render.py), or 0 to render them in the
+# worker itself. The pool is forked when the first thought is rendered, so only set this for single threaded workers: forking a
+# process that runs other threads can copy locks they hold.
+EXPORT_PROCESSES = 0
+
+# The number of seconds a request waits for a render process before it is answered with 503 and Retry-After. The render carries
+# on and its image is cached, so the retry gets it.
+EXPORT_TIMEOUT = 5
+
+# The index used to search the text of nodes (see think/search.py): 'fts' for an SQLite FTS5 table or 'terms' for the NodeTerm
+# table. None uses FTS5 when the database is SQLite built with it.
+SEARCH_INDEX = None
+
+# The number of seconds a worker may take to boot; checked by boottime.py.
+BOOT_TIME_BUDGET = 1.0
+
 # Local time zone for this installation. Choices can be found here:
 # http://en.wikipedia.org/wiki/List_of_tz_zones_by_name
 # although not all choices may be available on all operating systems.
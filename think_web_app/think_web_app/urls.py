@@ -1,32 +1,33 @@
 from django.conf.urls import patterns, include, url
 
-from django.contrib import admin
-admin.autodiscover()
-
 from django.views.generic import TemplateView
 
-from think.views.thought import ThoughtView, PublicThoughtView
-from think.views.theme import ThemeView
-from think.views.user import log_out
+from utilities.lazy import lazy_view
 
+# The views are imported when they are first requested, which keeps starting a worker fast.
 urlpatterns = patterns('',
     # Examples:
     # url(r'^$', 'think_web_app.views.home', name='home'),
     # url(r'^think_web_app/', include('think_web_app.foo.urls')),
 
-    # Uncomment the admin/doc line below to enable admin documentation:
-    # url(r'^admin/doc/', include('django.contrib.admindocs.urls')),
-
-    url(r'^admin/', include(admin.site.urls)),
-
     (r'^$', TemplateView.as_view(template_name='think/think.html')),
     (r'^think/tab-thoughts.html$', TemplateView.as_view(template_name='think/tab-thoughts.html')),
     (r'^think/newuser-dialog.html$', TemplateView.as_view(template_name='think/newuser-dialog.html')),
     (r'^think/tab-login.html$', TemplateView.as_view(template_name='think/tab-login.html')),
     (r'^think/tab-register.html$', TemplateView.as_view(template_name='think/tab-register.html')),
     (r'^think/tab-about.html$', TemplateView.as_view(template_name='think/tab-about.html')),
-    (r'^thought$', ThoughtView.as_view()),
-    (r'^theme$', ThemeView.as_view()),
-    (r'^public$', PublicThoughtView.as_view()),
-    (r'^logout$', log_out),
+    (r'^thought$', lazy_view('think.views.thought.ThoughtView')),
+    (r'^thought/export$', lazy_view('think.views.export.ExportThoughtView')),
+    (r'^thought/graph$', lazy_view('think.views.graph.ThoughtGraphView')),
+    (r'^thought/archive$', lazy_view('think.views.archive.ThoughtArchiveView')),
+    (r'^thought/changes$', lazy_view('think.views.feed.ThoughtChangesView')),
+    (r'^thought/history$', lazy_view('think.views.history.ThoughtHistoryView')),
+    (r'^thought/import$', lazy_view('think.views.importer.ImportThoughtView')),
+    (r'^thought/layout$', lazy_view('think.views.layout.ThoughtLayoutView')),
+    (r'^theme$', lazy_view('think.views.theme.ThemeView')),
+    (r'^search$', lazy_view('think.views.search.SearchView')),
+    (r'^public$', lazy_view('think.views.thought.PublicThoughtView')),
+    (r'^logout$', 'think.views.user.log_out'),
+
+    url(r'^admin/', include('think_web_app.admin_urls')),
 )
@@ -3,6 +3,7 @@ A collection of generic utility methods.
 """
 
 
+import itertools
 import os
 import re
 import sys
@@ -110,3 +111,33 @@ def request_args_to_dict(request):
   """
   req = request
   return dict([(arg, req.get(arg)) for arg in req.arguments()])
+
+def chunk_list(list, size):
+  """Splits a list into consecutive chunks.
+  
+     Args:
+       list: the list to split.
+       size: the maximum number of elements in each chunk.
+    
+     Returns:
+       a generator of lists, each containing at most size elements.
+  """
+  for i in xrange(0, len(list), size):
+    yield list[i:i + size]
+
+def chunk_iterable(iterable, size):
+  """Splits an iterable into consecutive chunks without reading all of it into memory.
+  
+     Args:
+       iterable: the iterable to split.
+       size: the maximum number of elements in each chunk.
+    
+     Returns:
+       a generator of lists, each containing at most size elements.
+  """
+  iterator = iter(iterable)
+  while True:
+    chunk = list(itertools.islice(iterator, size))
+    if not chunk:
+      return
+    yield chunk
@@ -0,0 +1,57 @@
+"""
+Views that are only imported when they are first requested, so that starting a worker does not import every view module.
+"""
+
+
+from __future__ import with_statement
+
+import threading
+
+from django.utils.importlib import import_module
+
+
+class LazyView:
+  """A view function that imports the real view the first time it is called or one of its attributes is read.
+     
+     Middleware reads attributes that decorators set on views, such as csrf_exempt, before calling them, so those are read
+     from the real view.
+  """
+  
+  def __init__(self, path, initkwargs):
+    self.module_name, self.attribute = path.rsplit('.', 1)
+    self.initkwargs = initkwargs
+    self.views = []
+    self.lock = threading.Lock()
+    self.__name__ = self.attribute
+    self.__module__ = self.module_name
+  
+  def get_view(self):
+    """Gets the real view, importing it if it has not been imported."""
+    with self.lock:
+      if not self.views:
+        view = getattr(import_module(self.module_name), self.attribute)
+        if hasattr(view, 'as_view'):
+          view = view.as_view(**self.initkwargs)
+        self.views.append(view)
+    return self.views[0]
+  
+  def __call__(self, request, *args, **kwargs):
+    return self.get_view()(request, *args, **kwargs)
+  
+  def __getattr__(self, name):
+    # Only called for attributes the lazy view does not have itself.
+    if name.startswith('__'):
+      raise AttributeError(name)
+    return getattr(self.get_view(), name)
+
+
+def lazy_view(path, **initkwargs):
+  """Creates a view that imports the real view the first time it is called.
+     
+     Args:
+       path: the dotted path of a view function or a class based view, e.g. 'think.views.thought.ThoughtView'.
+       initkwargs: the keyword arguments passed to as_view if the path is a class based view.
+     
+     Returns: a LazyView.
+  """
+  return LazyView(path, initkwargs)